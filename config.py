@@ -1,6 +1,6 @@
 import configparser
 import datetime
-import importlib
+import importlib.util
 import logging
 import traceback
 from collections import deque
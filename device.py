@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 import logging
+import queue
 import threading
 import time
 import traceback
 from collections import deque
-from typing import Any, Deque, Dict, List, Set, Tuple, Union
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple, Union
 
 import numpy as np
 import numpy.typing as npt
@@ -13,6 +14,143 @@ import numpy.typing as npt
 from config import DeviceConfig
 
 
+def sample_nbytes(data: Any) -> int:
+    """Approximate size in bytes of a ReadValue() return value."""
+    try:
+        if isinstance(data[0], np.ndarray):
+            # fast data: [array of records, list of attributes]
+            return data[0].nbytes
+        # slow data: a row of numbers
+        return 8 * len(data)
+    except (TypeError, IndexError, KeyError):
+        return 0
+
+
+class RingBuffer:
+    """
+    The last `capacity` values (scalars or rows of a fixed width) appended, as a
+    contiguous NumPy array. The buffer holds twice the capacity; when it is full,
+    the last values are copied to a new buffer, so views handed out earlier are
+    never overwritten.
+    """
+
+    def __init__(self, capacity: int, dtype: Any = float, width: Optional[int] = None):
+        self.capacity = max(int(capacity), 1)
+        shape = (2 * self.capacity,) if width is None else (2 * self.capacity, width)
+        self.buffer = np.empty(shape, dtype=dtype)
+        self.end = 0
+        self.size = 0
+
+    def append(self, value: Any):
+        if self.end == len(self.buffer):
+            buffer = np.empty_like(self.buffer)
+            keep = self.capacity - 1
+            buffer[:keep] = self.buffer[self.end - keep : self.end]
+            self.buffer = buffer
+            self.end = keep
+        self.buffer[self.end] = value
+        self.end += 1
+        self.size = min(self.size + 1, self.capacity)
+
+    def last(self, n: int) -> npt.NDArray:
+        n = min(n, self.size)
+        view = self.buffer[self.end - n : self.end]
+        view.flags.writeable = False
+        return view
+
+
+class SnapshotCache:
+    """
+    The most recent samples of a device (as many as the plots_queue holds),
+    numbered by the sequence number Device.push_data() gives them. All consumers
+    (plots, networking, monitoring, meta devices) read from here instead of each
+    converting and scanning the plots_queue. Slow data rows are converted to
+    floats once, when pushed, and kept in a 2-D array; the timestamps of slow and
+    fast data are kept in a 1-D array. Arrays handed out are read-only views that
+    stay valid while the device keeps pushing.
+
+    since(seq) returns everything pushed after sequence number seq, so consumers
+    do not need to detect new data by comparing timestamps or hashes.
+    """
+
+    def __init__(self, maxlen: int, slow_data: bool):
+        self.lock = threading.Lock()
+        self.maxlen = max(int(maxlen), 1)
+        self.slow_data = slow_data
+        self.sequence = 0
+        self.samples: Deque[Tuple[int, Any]] = deque(maxlen=self.maxlen)
+        self.seqs = RingBuffer(self.maxlen, dtype=np.int64)
+        self.times = RingBuffer(self.maxlen)
+        self.rows: Optional[RingBuffer] = None
+
+    @staticmethod
+    def to_float(value: Any) -> float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+
+    def append(self, seq: int, data: Any):
+        if self.slow_data:
+            row = [self.to_float(v) for v in data]
+            timestamp = row[0]
+        else:
+            row = None
+            try:
+                timestamp = float(data[1][0]["timestamp"])
+            except (IndexError, KeyError, TypeError, ValueError):
+                timestamp = np.nan
+
+        with self.lock:
+            # slow data rows of a different length start a new array
+            if row is not None and (
+                self.rows is None or len(row) != self.rows.buffer.shape[1]
+            ):
+                self.rows = RingBuffer(self.maxlen, width=len(row))
+                self.seqs = RingBuffer(self.maxlen, dtype=np.int64)
+                self.times = RingBuffer(self.maxlen)
+            self.samples.append((seq, data))
+            self.seqs.append(seq)
+            self.times.append(timestamp)
+            if row is not None:
+                self.rows.append(row)
+            self.sequence = seq
+
+    def count_since(self, seq: Optional[int]) -> int:
+        if seq is None:
+            return self.seqs.size
+        return int(min(max(self.sequence - seq, 0), self.seqs.size))
+
+    def latest(self) -> Optional[Tuple[int, Any]]:
+        """The last sample pushed and its sequence number."""
+        with self.lock:
+            return self.samples[-1] if self.samples else None
+
+    def since(self, seq: Optional[int] = None) -> List[Tuple[int, Any]]:
+        """
+        The (sequence number, sample) pairs pushed after seq (all samples held
+        if seq is None). If the first sequence number returned is larger than
+        seq + 1, the samples in between have already been dropped.
+        """
+        with self.lock:
+            n = min(self.count_since(seq), len(self.samples))
+            return [
+                self.samples[i] for i in range(len(self.samples) - n, len(self.samples))
+            ]
+
+    def arrays_since(
+        self, seq: Optional[int] = None
+    ) -> Tuple[npt.NDArray, npt.NDArray, Optional[npt.NDArray]]:
+        """
+        Sequence numbers, timestamps and (for slow data) rows as floats of the
+        samples pushed after seq.
+        """
+        with self.lock:
+            n = self.count_since(seq)
+            rows = self.rows.last(n) if self.rows is not None else None
+            return self.seqs.last(n), self.times.last(n), rows
+
+
 def restart_device(device: Device, time_offset: float) -> Device:
     logging.info(f"{device.name}: restart")
     device.active.clear()
@@ -21,6 +159,22 @@ def restart_device(device: Device, time_offset: float) -> Device:
     data_queue = device.data_queue
     events_queue = device.events_queue
     plots_queue = device.config["plots_queue"]
+    snapshot_cache = device.snapshot_cache
+
+    # the HDF_writer and publisher notification settings, state of the data
+    # queue, and number of samples pushed so far
+    hdf_state = {
+        attr: getattr(device, attr)
+        for attr in [
+            "sequence",
+            "publish_queue",
+            "hdf_notify",
+            "hdf_notify_rows",
+            "hdf_notify_bytes",
+            "data_queue_bytes",
+            "time_oldest_unwritten",
+        ]
+    }
 
     device = Device(device.config)
     device.setup_connection(time_offset)
@@ -28,6 +182,9 @@ def restart_device(device: Device, time_offset: float) -> Device:
     device.data_queue = data_queue
     device.events_queue = events_queue
     device.config["plots_queue"] = plots_queue
+    device.snapshot_cache = snapshot_cache
+    for attr, val in hdf_state.items():
+        setattr(device, attr, val)
 
     device.start()
 
@@ -55,7 +212,7 @@ class Device(threading.Thread):
         self.last_event: List[Tuple[float, str, Any]] = []
         self.monitoring_commands: Set[str] = set()
         self.sequencer_commands: List[Tuple[int, str]] = []
-        self.networking_commands: List[Tuple[int, str]] = []
+        self.networking_commands: Deque[Tuple[int, str]] = deque()
 
         # for warnings about device abnormal condition
         self.warnings: List[Tuple[float, Dict[str, str]]] = []
@@ -74,6 +231,28 @@ class Device(threading.Thread):
         # allow for unique ids if multiple network clients are connected
         self.networking_events_queue: Dict[int, Any] = {}
 
+        # number of samples pushed to the queues; plots use it to tell whether
+        # there is new data since they were last drawn
+        self.sequence = 0
+
+        # the recent samples by sequence number, shared by all consumers
+        self.snapshot_cache = SnapshotCache(
+            self.config["plots_queue_maxlen"], self.config["slow_data"]
+        )
+
+        # for waking up the HDF_writer when data is waiting to be written: the
+        # event is set on the first sample after the queue was emptied, and when
+        # the queue holds more than hdf_notify_rows rows or hdf_notify_bytes bytes
+        self.hdf_notify: Optional[threading.Event] = None
+        self.hdf_notify_rows = 0
+        self.hdf_notify_bytes = 0
+        self.data_queue_bytes = 0
+        self.time_oldest_unwritten: Optional[float] = None
+
+        # for the Networking publisher: every sample pushed is put on the queue
+        # as (device name, sequence number, sample)
+        self.publish_queue: Optional[queue.SimpleQueue] = None
+
         # the variable for counting the number of NaN returns
         self.nan_count = 0
 
@@ -143,10 +322,43 @@ class Device(threading.Thread):
 
         # create a new deque with a different maxlen
         self.config["plots_queue"] = deque(maxlen=self.config["plots_queue_maxlen"])
+        self.snapshot_cache = SnapshotCache(
+            self.config["plots_queue_maxlen"], self.config["slow_data"]
+        )
 
     def clear_queues(self):
         self.data_queue.clear()
         self.events_queue.clear()
+        self.data_queue_bytes = 0
+        self.time_oldest_unwritten = None
+
+    def push_data(self, data: Any):
+        """Put a new ReadValue() return value into the data and plots queues."""
+        first = self.time_oldest_unwritten is None
+        if first:
+            self.time_oldest_unwritten = time.time()
+        self.data_queue.append(data)
+        self.config["plots_queue"].append(data)
+        self.sequence += 1
+        self.snapshot_cache.append(self.sequence, data)
+        self.data_queue_bytes += sample_nbytes(data)
+
+        # publish on the network while the device is fully enabled; checked for
+        # every sample since it can be enabled or disabled while running
+        if (
+            self.publish_queue is not None
+            and self.config["control_params"]["enabled"]["value"] == 2
+        ):
+            self.publish_queue.put((self.config["name"], self.sequence, data))
+
+        if self.hdf_notify is None:
+            return
+        if (
+            first
+            or 0 < self.hdf_notify_rows <= len(self.data_queue)
+            or 0 < self.hdf_notify_bytes <= self.data_queue_bytes
+        ):
+            self.hdf_notify.set()
 
     def run(self):
         # check connection to the device was successful
@@ -160,6 +372,9 @@ class Device(threading.Thread):
         # main control loop
         try:
             with self.config["driver_class"](*self.constr_params) as device:
+                # drivers that buffer samples between reads, e.g. the networking
+                # client, return all of them with ReadValues()
+                read_values = getattr(device, "ReadValues", None)
                 while self.active.is_set():
                     # get and sanity check loop delay
                     try:
@@ -194,8 +409,7 @@ class Device(threading.Thread):
                             logging.warning(traceback.format_exc())
                             ret_val = str(err)
                         if (c == "ReadValue()") and ret_val:
-                            self.data_queue.append(ret_val)
-                            self.config["plots_queue"].append(ret_val)
+                            self.push_data(ret_val)
                             self.events_queue.append(
                                 (time.time() - self.time_offset, c, "")
                             )
@@ -220,8 +434,7 @@ class Device(threading.Thread):
                             self.sequencer_errors_queue.append(e)
                             ret_val = e
                         if (c == "ReadValue()") and ret_val:
-                            self.data_queue.append(ret_val)
-                            self.config["plots_queue"].append(ret_val)
+                            self.push_data(ret_val)
                             self.events_queue.append(
                                 [time.time() - self.time_offset, c, ""]
                             )
@@ -253,8 +466,10 @@ class Device(threading.Thread):
                         )
 
                     # send networking commands, if any, to the device, and record return
-                    # values
-                    for uid, cmd in self.networking_commands:
+                    # values; pop them one by one since the networking workers
+                    # append commands from other threads
+                    while self.networking_commands:
+                        uid, cmd = self.networking_commands.popleft()
                         try:
                             ret_val = eval("device." + cmd.strip())
                         except Exception as err:
@@ -262,7 +477,6 @@ class Device(threading.Thread):
                             logging.warning(traceback.format_exc())
                             ret_val = str(err)
                         self.networking_events_queue[uid] = ret_val
-                    self.networking_commands = []
 
                     # level 2: check device is enabled for periodic ReadValue
                     if self.config["control_params"]["enabled"]["value"] < 2:
@@ -270,7 +484,12 @@ class Device(threading.Thread):
 
                     # record numerical values
                     if time.time() - self.time_last_read >= dt:
-                        last_data = device.ReadValue()
+                        if read_values is not None:
+                            samples = read_values()
+                            last_data = samples[-1] if samples else np.nan
+                        else:
+                            last_data = device.ReadValue()
+                            samples = [last_data]
                         self.time_last_read = time.time()
 
                         # keep track of the number of (sequential and total) NaN returns
@@ -287,9 +506,9 @@ class Device(threading.Thread):
                             self.sequential_nan_count = 0
                         self.previous_data = last_data
 
-                        if last_data and not isinstance(last_data, float):
-                            self.data_queue.append(last_data)
-                            self.config["plots_queue"].append(last_data)
+                        for data in samples:
+                            if data and not isinstance(data, float):
+                                self.push_data(data)
 
                         # issue a warning if there's been too many sequential NaN
                         # returns
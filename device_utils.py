@@ -1,24 +1,54 @@
+import functools
 import importlib
 import inspect
+import json
+from typing import Dict, Tuple, Union
 
 from device import Device
 
+# metadata of the devices of networking servers, retrieved by NetworkingClient
+# devices and kept while the run id of the server is unchanged
+remote_metadata: Dict[Tuple[str, str, str, str], dict] = {}
+
+
+def remote_metadata_key(connection: Union[str, dict]) -> Tuple[str, str, str, str]:
+    if isinstance(connection, str):
+        connection = json.loads(connection)
+    return (
+        str(connection["server"]),
+        str(connection["port_control"]),
+        str(connection["publisher_name"]),
+        str(connection["device_name"]),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def load_driver(driver_name: str) -> type:
+    driver_spec = importlib.util.spec_from_file_location(
+        driver_name,
+        "drivers/" + driver_name + ".py",
+    )
+
+    driver_module = importlib.util.module_from_spec(driver_spec)
+    driver_spec.loader.exec_module(driver_module)
+    return getattr(driver_module, driver_name)
+
 
 def get_device_methods(device: str, devices: dict[str, Device]) -> list[str]:
     if devices[device].config["driver_class"].__name__ != "NetworkingClient":
         driver = devices[device].config["driver_class"]
 
     else:
-        driver_name = devices[device].config["control_params"]["driver"]["value"]
-
-        driver_spec = importlib.util.spec_from_file_location(
-            driver_name,
-            "drivers/" + driver_name + ".py",
-        )
-
-        driver_module = importlib.util.module_from_spec(driver_spec)
-        driver_spec.loader.exec_module(driver_module)
-        driver = getattr(driver_module, driver_name)
+        # the methods of the remote device if a client retrieved them, otherwise
+        # those of the local copy of its driver, imported once
+        control_params = devices[device].config["control_params"]
+        try:
+            key = remote_metadata_key(control_params["connection"]["value"])
+        except (KeyError, TypeError, ValueError):
+            key = None
+        if key in remote_metadata:
+            return list(remote_metadata[key]["methods"])
+        driver = load_driver(control_params["driver"]["value"])
 
     methods = [m[0] for m in inspect.getmembers(driver, predicate=inspect.isfunction)]
     return methods
@@ -1,105 +1,16 @@
 import logging
 import time
 import traceback
-from copy import copy
-from typing import Dict, Sequence, Tuple, Union
 
 import numpy as np
-import numpy.typing as npt
 
-
-def split(string, separator=","):
-    return [x.strip() for x in string.split(separator)]
-
-
-class Histogram:
-    def __init__(self, bin_edges: Union[Sequence[int], Sequence[float]]):
-        self.bin_edges = bin_edges
-        self.bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
-
-        self.data: Dict[int, Tuple[int, float]] = dict(
-            [(i, (0, 0)) for i in range(1, len(bin_edges))]
-        )
-
-    def __len__(self) -> int:
-        return len(self.data)
-
-    def update(
-        self,
-        x: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
-        y: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
-    ):
-        try:
-            bin_numbers = np.digitize(x, bins=self.bin_edges, right=True)
-        except Exception as e:
-            logging.error(e)
-            print(self.bin_edges)
-            print(x)
-            print(y)
-            logging.error(traceback.format_exc())
-            return
-
-        for bin_number in np.unique(bin_numbers):
-            if bin_number == 0:
-                continue
-            elif bin_number >= len(self.bin_edges):
-                continue
-            m = bin_numbers == bin_number
-            current_data = self.data.get(bin_number)
-            assert current_data is not None, f"{bin_number=}, {len(self.data)=}"
-            mean = (current_data[0] * current_data[1] + np.sum(y[m])) / (
-                current_data[0] + m.sum()
-            )
-            self.data[bin_number] = (current_data[0] + m.sum(), mean)
-
-    @property
-    def x(self) -> Union[npt.NDArray[np.int_], npt.NDArray[np.float_]]:
-        return self.bin_centers
-
-    @property
-    def y(self) -> Union[npt.NDArray[np.int_], npt.NDArray[np.float_]]:
-        return np.array([v[1] for v in self.data.values()])
-
-
-def create_bins(
-    scan_values: Union[npt.NDArray[np.float_], npt.NDArray[np.int_]], maxsize: int = 100
-) -> Tuple[npt.NDArray[np.float_], npt.NDArray[np.float_]]:
-    bin_centers = np.unique(scan_values)
-    if len(bin_centers) == 1:
-        bins = np.array([bin_centers[0] * 0.9, bin_centers[0] * 1.1])
-    elif len(bin_centers) > maxsize:
-        bin_centers = np.linspace(bin_centers.min(), bin_centers.max(), maxsize)
-        bins = bin_centers.copy()
-        bin_width = bins[1] - bins[0]
-        bins -= bin_width / 2
-        bins = np.append(bins, bins.max() + bin_width / 2)
-
-    else:
-        bin_diffs = np.diff(bin_centers)
-        bins = np.append(
-            [bin_centers[0] - bin_diffs[0] / 2], bin_centers[1:] - bin_diffs / 2
-        )
-        bins = np.append(bins, [bin_centers[-1] + bin_diffs[-1] / 2])
-    return bin_centers, bins
-
-
-def check_bins_update(
-    x: Union[npt.NDArray[np.float_], npt.NDArray[np.int_]],
-    binned_data: Histogram,
-    nbins_max: int,
-) -> bool:
-    if len(binned_data) == 0:
-        return True
-    elif (x.min() < np.min(binned_data.bin_edges)) or (
-        x.max() > np.max(binned_data.bin_edges)
-    ):
-        return True
-    elif not np.all(np.isin(x, binned_data.bin_centers)) and (
-        len(binned_data) < nbins_max
-    ):
-        return True
-    else:
-        return False
+from histogram import (
+    BaseHistogram,
+    Histogram,
+    TraceFetcher,
+    check_bins_update,
+    create_bins,
+)
 
 
 class HistogramPlotter:
@@ -132,15 +43,19 @@ class HistogramPlotter:
 
         self.verification_string = "histogram_plotter"
 
-        # lists to store matched slow (x), fast (unprocessed_data) and processed fast
-        # (y) data in
-        self.x_ts = []
-        self.x_data = []
-        self.y_data = []
+        # number of traces processed, and the matched slow (x) and processed
+        # fast (y) data of the traces not binned yet
+        self.n_points = 0
         self.x_data_new = []
         self.y_data_new = []
 
-        self.timestamp_last_fetched = 0.0
+        # statistics of y per scan value of all traces, from which the histogram
+        # is rebinned
+        self.base_histogram = BaseHistogram()
+
+        # fetches the new traces of the fast device, matched to the slow device
+        # rows by timestamp, and evaluates the processing expressions
+        self.fetcher = TraceFetcher(parent, "HistogramPlotter")
 
         self.warnings = []
         self.new_attributes = []
@@ -188,12 +103,14 @@ class HistogramPlotter:
         y_data = np.array(self.y_data_new)
 
         # return zeros if no data present
-        if len(self.x_data) < 10:
+        if self.n_points < 10:
             data = np.concatenate(
                 (np.linspace(-1, 1, self.shape[-1]), np.zeros(self.shape[-1]))
             ).reshape(self.shape)
             return [data, [{"timestamp": time.time() - self.time_offset}]]
         elif len(x_data) > 0:
+            self.base_histogram.update(x_data, y_data)
+
             # check if new bins are required
             if (
                 check_bins_update(
@@ -202,23 +119,19 @@ class HistogramPlotter:
                     self.nbins_max,
                 )
                 or self.redo_binning_flag
-            ):
+            ) and len(self.base_histogram) > 0:
                 logging.info("HistogramPlotter: redo binning")
                 self.redo_binning_flag = False
                 _, bin_edges = create_bins(
-                    self.x_data, maxsize=self.nbins_max
+                    self.base_histogram.values, maxsize=self.nbins_max
                 )
-                self.binned_data = Histogram(bin_edges)
+                self.binned_data = self.base_histogram.rebin(bin_edges)
                 self.shape = (1, 2, len(self.binned_data))
-                self.binned_data.update(np.array(self.x_data), np.array(self.y_data))
-
-                self.x_data_new.clear()
-                self.y_data_new.clear()
             else:
                 self.binned_data.update(x_data, y_data)
 
-                self.x_data_new.clear()
-                self.y_data_new.clear()
+            self.x_data_new.clear()
+            self.y_data_new.clear()
 
         data = np.concatenate((self.binned_data.x, self.binned_data.y)).reshape(
             self.shape
@@ -249,11 +162,16 @@ class HistogramPlotter:
         self.redo_binning_flag = True
         self.nbins_max = int(nbins_max)
 
+    def set_match_tolerance(self, match_tolerance: float):
+        """Maximum time [s] between a trace and the slow device row it is binned by."""
+        self.fetcher.set_tolerance(match_tolerance)
+
     def ClearData(self):
-        self.x_data.clear()
-        self.y_data.clear()
+        self.n_points = 0
         self.x_data_new.clear()
         self.y_data_new.clear()
+        self.base_histogram = BaseHistogram()
+        self.fetcher.reset()
 
     #################################################
     # Device Commands
@@ -262,112 +180,34 @@ class HistogramPlotter:
     def FetchData(self):
         """
         Attempting to fetch data from the specified fast and slow device.
+        Returns the new traces and the slow device value matched to each.
         """
-        try:
-            data1_queue = list(self.parent.devices[self.dev1].config["plots_queue"])
-        except KeyError:
-            logging.warning(f"HistogramPlotterNorm: device {self.dev1} not found")
-            return
-        try:
-            data2_queue = np.asarray(
-                self.parent.devices[self.dev2].config["plots_queue"]
-            )
-        except KeyError:
-            logging.warning(f"HistogramPlotterNorm: device {self.dev} not found")
-            return
-
-        if len(data2_queue) == 0 or len(data1_queue) == 0:
-            return
-
-        timestamps1 = np.asarray([d[-1][0]["timestamp"] for d in data1_queue])
-        timestamps2 = np.asarray([d[0] for d in data2_queue])
-
-        dt = timestamps2[:, np.newaxis] - timestamps1
-        dt[dt > 0] = 1e3
-        indices2 = np.argmin(np.abs(dt), axis=0)
-
-        timestamps2 = timestamps2[indices2]
-        data2_queue = data2_queue[indices2]
-
-        if self.timestamp_last_fetched == 0:
-            mask = np.ones(len(data1_queue), dtype=bool)
-        else:
-            mask = timestamps1 > self.timestamp_last_fetched
-
-        if (len(mask) == 0) or (mask.sum() == 0):
-            return []
-
-        self.timestamp_last_fetched = timestamps1[mask][-1]
-
-        # extract the desired parameter 1 and 2
-        col_names1 = split(
-            self.parent.devices[self.dev1].config["attributes"]["column_names"]
-        )
-        col_names2 = split(
-            self.parent.devices[self.dev2].config["attributes"]["column_names"]
+        (unprocessed_data,), x = self.fetcher.fetch(
+            self.dev1, [self.param1], [(self.dev2, self.param2)]
         )
-        try:
-            idx1 = col_names1.index(self.param1)
-        except IndexError:
-            logging.error("Error in HistogramPlotter: param not found: " + self.param1)
-            return
-        try:
-            idx2 = col_names2.index(self.param2)
-        except IndexError:
-            logging.error("Error in HistogramPlotter: param not found: " + self.param2)
-            return
-
-        data1_queue = [data1_queue[idx] for idx, m in enumerate(mask) if m]
-        if self.timestamp_last_fetched == 0:
-            unprocessed_data = [d[0][0][idx1] for d in data1_queue]
-            x = [d[idx2] for d in data2_queue[mask]]
-            self.x_data = copy(x)
-            self.x_data_new = copy(x)
-        else:
-            unprocessed_data = []
-            for idd, d in enumerate(data1_queue):
-                # d is a list with at 0 the arrays and at 1 the timestamps
-                d = d[0]
-                if d.shape[0] > 1:
-                    for di in d:
-                        unprocessed_data.append(di[0][idx1])
-                        x = data2_queue[mask][idd][idx2]
-                        self.x_data.append(x)
-                        self.x_data_new.append(x)
-                else:
-                    unprocessed_data.append(d[0][idx1])
-                    x = data2_queue[mask][idd][idx2]
-                    self.x_data.append(x)
-                    self.x_data_new.append(x)
-
-        return unprocessed_data
+        return unprocessed_data, x[:, 0]
 
     def ProcessData(self):
         """
         Processing data from the fast device
         """
-        unprocessed_data = self.FetchData()
-
-        if unprocessed_data is None:
-            return
+        unprocessed_data, x = self.FetchData()
 
         if self.processed_changed:
-            self.x_data.clear()
-            self.y_data.clear()
+            self.n_points = 0
             self.x_data_new.clear()
             self.y_data_new.clear()
+            self.base_histogram = BaseHistogram()
             self.processed_changed = False
             self.redo_binning_flag = True
             return
 
-        if len(self.x_data) == 0:
-            return
-        elif len(unprocessed_data) == 0:
+        if len(unprocessed_data) == 0:
             return
 
-        for idx in reversed(range(len(unprocessed_data))):
-            # self.processing string contains y which is then evaluated
-            y = unprocessed_data[-idx - 1]  # noqa: F841
-            y = eval(self.processing)
-            self.y_data.append(y)
-            self.y_data_new.append(y)
+        # self.processing string contains y which is then evaluated, for all new
+        # traces at once if possible
+        y = self.fetcher.process("processing", self.processing, unprocessed_data)
+        self.n_points += len(y)
+        self.x_data_new.extend(x)
+        self.y_data_new.extend(y)
@@ -1,99 +1,17 @@
 import logging
 import time
 import traceback
-from copy import copy
-from typing import Dict, Sequence, Tuple, Union
 
 import numpy as np
-import numpy.typing as npt
-
-
-def split(string, separator=","):
-    return [x.strip() for x in string.split(separator)]
-
-
-class Histogram:
-    def __init__(self, bin_edges: Union[Sequence[int], Sequence[float]]):
-        self.bin_edges = bin_edges
-
-        self.bin_centers = bin_edges[:-1] + np.diff(bin_edges) / 2
-
-        self.data: Dict[int, Tuple[int, float]] = dict(
-            [(i, (0, 0)) for i in range(1, len(bin_edges))]
-        )
-
-    def __len__(self) -> int:
-        return len(self.data)
-
-    def update(
-        self,
-        x: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
-        y: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
-    ):
-        bin_numbers = np.digitize(x, bins=self.bin_edges, right=True)
-        for bin_number in np.unique(bin_numbers):
-            if bin_number == 0:
-                continue
-            elif bin_number >= len(self.bin_edges):
-                continue
-            m = bin_numbers == bin_number
-            current_data = self.data.get(bin_number)
-            assert current_data is not None, f"{bin_number=}, {len(self.data)=}"
-            mean = (current_data[0] * current_data[1] + np.sum(y[m])) / (
-                current_data[0] + m.sum()
-            )
-            self.data[bin_number] = (current_data[0] + m.sum(), mean)
-
-    @property
-    def x(self) -> Union[npt.NDArray[np.int_], npt.NDArray[np.float_]]:
-        return self.bin_centers
-
-    @property
-    def y(self) -> Union[npt.NDArray[np.int_], npt.NDArray[np.float_]]:
-        return np.array([v[1] for v in self.data.values()])
-
-
-
-
-def create_bins(
-    scan_values: Union[npt.NDArray[np.float_], npt.NDArray[np.int_]], maxsize: int = 100
-) -> Tuple[npt.NDArray[np.float_], npt.NDArray[np.float_]]:
-    bin_centers = np.unique(scan_values)
-    if len(bin_centers) == 1:
-        bins = np.array([bin_centers[0] * 0.9, bin_centers[0] * 1.1])
-    elif len(bin_centers) > maxsize:
-        bin_centers = np.linspace(bin_centers.min(), bin_centers.max(), maxsize)
-        bins = bin_centers.copy()
-        bin_width = bins[1] - bins[0]
-        bins -= bin_width / 2
-        bins = np.append(bins, bins.max() + bin_width / 2)
-
-    else:
-        bin_diffs = np.diff(bin_centers)
-        bins = np.append(
-            [bin_centers[0] - bin_diffs[0] / 2], bin_centers[1:] - bin_diffs / 2
-        )
-        bins = np.append(bins, [bin_centers[-1] + bin_diffs[-1] / 2])
-    return bin_centers, bins
-
-def check_bins_update(
-    x: Union[npt.NDArray[np.float_], npt.NDArray[np.int_]],
-    binned_data: Histogram,
-    nbins_max: int,
-) -> bool:
-    if len(binned_data) == 0:
-        return True
-    elif (x.min() < np.min(binned_data.bin_edges)) or (
-        x.max() > np.max(binned_data.bin_edges)
-    ):
-        return True
-    elif not np.all(np.isin(x, binned_data.bin_centers)) and (
-        len(binned_data) < nbins_max
-    ):
-        return True
-    else:
-        return False
 
+from histogram import (
+    BaseHistogram,
+    Histogram,
+    TraceFetcher,
+    check_bins_update,
+    create_bins,
+)
+from utils import GrowableArray
 
 
 class HistogramPlotterAbsorptionNormalized:
@@ -134,16 +52,23 @@ class HistogramPlotterAbsorptionNormalized:
         self.processingnorm = self.Strip(self.processingnorm, '"')
 
         self.verification_string = "histogram_plotter"
-        # lists to store matched slow (x), fast (unprocessed_data) and processed fast
-        # (y) data in
-        self.x_data = []
-        self.y_data = []
-        self.y_data_norm = []
+        # matched slow (x), processed fast (y) and normalization (y_norm) data of
+        # the last max_history traces, and of the traces not binned yet
+        self.max_history = 1_000_000
+        self.x_data = GrowableArray(max_size=self.max_history)
+        self.y_data = GrowableArray(max_size=self.max_history)
+        self.y_data_norm = GrowableArray(max_size=self.max_history)
         self.x_data_new = []
         self.y_data_new = []
         self.y_data_norm_new = []
 
-        self.timestamp_last_fetched = 0.0
+        # statistics of the normalized y per scan value of all traces, from which
+        # the histogram is rebinned
+        self.base_histogram = BaseHistogram()
+
+        # fetches the new traces of the fast device, matched to the slow device
+        # rows by timestamp, and evaluates the processing expressions
+        self.fetcher = TraceFetcher(parent, "HistogramPlotterAbsorptionNormalized")
 
         self.warnings = []
         self.new_attributes = []
@@ -154,6 +79,7 @@ class HistogramPlotterAbsorptionNormalized:
 
         self.processed_changed = False
         self.redo_binning_flag = False
+        self.rebuild_base_flag = False
 
         self.binned_data: Histogram = Histogram([])
 
@@ -202,6 +128,22 @@ class HistogramPlotterAbsorptionNormalized:
             return [data, [{"timestamp": time.time() - self.time_offset}]]
 
         elif len(x_data[m]) > 0:
+            if self.rebuild_base_flag:
+                # the cutoff changed, so the statistics are computed again from the
+                # traces kept (which include the new ones)
+                self.rebuild_base_flag = False
+                self.base_histogram = BaseHistogram()
+                m_all = self.y_data_norm.data >= self.absorption_cutoff
+                self.base_histogram.update(
+                    self.x_data.data[m_all],
+                    self.y_data.data[m_all] / self.y_data_norm.data[m_all],
+                )
+            else:
+                self.base_histogram.update(x_data[m], y_data[m] / y_data_norm[m])
+            self.x_data_new.clear()
+            self.y_data_new.clear()
+            self.y_data_norm_new.clear()
+
             # check if new bins are required
             if (
                 check_bins_update(
@@ -213,34 +155,23 @@ class HistogramPlotterAbsorptionNormalized:
             ):
                 logging.info("HistogramPlotterAbsorptionNormalized: redo binning")
 
-                m = np.array(self.y_data_norm) >= self.absorption_cutoff
-                if len(m) == 0 or m.sum() == 0:
+                if len(self.base_histogram) == 0:
                     data = np.concatenate(
                         (np.linspace(-1, 1, self.shape[-1]), np.zeros(self.shape[-1]))
                     ).reshape(self.shape)
                     return [data, [{"timestamp": time.time() - self.time_offset}]]
 
                 self.redo_binning_flag = False
-                _, bin_edges = create_bins(self.x_data, maxsize=self.nbins_max)
-                self.binned_data = Histogram(bin_edges)
-                self.shape = (1, 2, len(self.binned_data))
-                self.binned_data.update(
-                    np.asarray(self.x_data)[m],
-                    np.asarray(self.y_data)[m] / np.asarray(self.y_data_norm)[m],
+                _, bin_edges = create_bins(
+                    self.base_histogram.values, maxsize=self.nbins_max
                 )
-
-                self.x_data_new.clear()
-                self.y_data_new.clear()
-                self.y_data_norm_new.clear()
+                self.binned_data = self.base_histogram.rebin(bin_edges)
+                self.shape = (1, 2, len(self.binned_data))
             else:
                 self.binned_data.update(
                     x_data[m],
                     y_data[m] / y_data_norm[m],
                 )
-
-                self.x_data_new.clear()
-                self.y_data_new.clear()
-                self.y_data_norm_new.clear()
         elif len(self.binned_data) == 0:
             data = np.concatenate(
                 (np.linspace(-1, 1, self.shape[-1]), np.zeros(self.shape[-1]))
@@ -285,9 +216,14 @@ class HistogramPlotterAbsorptionNormalized:
         self.redo_binning_flag = True
         self.nbins_max = int(nbins_max)
 
+    def set_match_tolerance(self, match_tolerance: float):
+        """Maximum time [s] between a trace and the slow device row it is binned by."""
+        self.fetcher.set_tolerance(match_tolerance)
+
     def set_absorption_cutoff(self, absorption_cutoff: float):
         self.redo_binning_flag = True
-        self.absorption_cutoff = absorption_cutoff
+        self.rebuild_base_flag = True
+        self.absorption_cutoff = float(absorption_cutoff)
 
     def ClearData(self):
         self.x_data.clear()
@@ -296,6 +232,8 @@ class HistogramPlotterAbsorptionNormalized:
         self.x_data_new.clear()
         self.y_data_new.clear()
         self.y_data_norm_new.clear()
+        self.base_histogram = BaseHistogram()
+        self.fetcher.reset()
 
     #################################################
     # Device Commands
@@ -304,131 +242,55 @@ class HistogramPlotterAbsorptionNormalized:
     def FetchData(self):
         """
         Attempting to fetch data from the specified fast and slow device.
+        Returns the new traces, their normalization traces and the slow device
+        value matched to each.
         """
-        try:
-            data1_queue = list(self.parent.devices[self.dev1].config["plots_queue"])
-        except KeyError:
-            logging.warning(f"HistogramPlotterNorm: device {self.dev1} not found")
-            return [], []
-        try:
-            data2_queue = np.asarray(
-                self.parent.devices[self.dev2].config["plots_queue"]
-            )
-        except KeyError:
-            logging.warning(f"HistogramPlotterNorm: device {self.dev} not found")
-            return [], []
-
-        if len(data2_queue) == 0 or len(data1_queue) == 0:
-            return [], []
-
-        timestamps1 = np.asarray([d[-1][0]["timestamp"] for d in data1_queue])
-        timestamps2 = np.asarray([d[0] for d in data2_queue])
-
-        dt = timestamps2[:, np.newaxis] - timestamps1
-        dt[dt > 0] = 1e3
-        indices2 = np.argmin(np.abs(dt), axis=0)
-
-        timestamps2 = timestamps2[indices2]
-        data2_queue = data2_queue[indices2]
-
-        if self.timestamp_last_fetched == 0:
-            mask = np.ones(len(data1_queue), dtype=bool)
-        else:
-            mask = timestamps1 > self.timestamp_last_fetched
-
-        if (len(mask) == 0) or (mask.sum() == 0):
-            return [], []
-
-        self.timestamp_last_fetched = timestamps1[mask][-1]
-
-        # extract the desired parameter 1 and 2
-        col_names1 = split(
-            self.parent.devices[self.dev1].config["attributes"]["column_names"]
-        )
-        col_names2 = split(
-            self.parent.devices[self.dev2].config["attributes"]["column_names"]
+        (unprocessed_data, traces_abs, traces_absnorm), x = self.fetcher.fetch(
+            self.dev1,
+            [self.param1, self.paramabs, self.paramabsnorm],
+            [(self.dev2, self.param2)],
         )
-        try:
-            idx1 = col_names1.index(self.param1)
-            idx1abs = col_names1.index(self.paramabs)
-            idx1absnorm = col_names1.index(self.paramabsnorm)
-        except IndexError:
-            logging.error("Error in HistogramPlotter: param not found: " + self.param1)
-            return [], []
-        try:
-            idx2 = col_names2.index(self.param2)
-        except IndexError:
-            logging.error("Error in HistogramPlotter: param not found: " + self.param2)
-            return [], []
-
-        data1_queue = [data1_queue[idx] for idx, m in enumerate(mask) if m]
-
-        if self.timestamp_last_fetched == 0:
-            unprocessed_data = [d[0][0][idx1] for d in data1_queue]
-            unprocessed_data_norm = [
-                d[0][0][idx1abs].astype(float) / d[0][0][idx1absnorm].astype(float)
-                for d in data1_queue
-            ]
-            x = [d[idx2] for d in data2_queue[mask]]
-            self.x_data = copy(x)
-            self.x_data_new = copy(x)
-        else:
-            unprocessed_data = []
-            unprocessed_data_norm = []
-            for idd, d in enumerate(data1_queue):
-                d = d[0]
-                if d.shape[0] > 1:
-                    self.x_data_new.clear()
-                    print("hit d.shape[0] > 1")
-                    for di in d:
-                        unprocessed_data.append(di[0][idx1])
-                        unprocessed_data_norm.append(
-                            di[0][idx1abs].astype(float)
-                            / di[0][idx1absnorm].astype(float)
-                        )
-                        x = data2_queue[mask][idd][idx2]
-                        self.x_data.append(x)
-                        self.x_data_new.append(x)
-                else:
-                    unprocessed_data.append(d[0][idx1])
-                    unprocessed_data_norm.append(
-                        d[0][idx1abs].astype(float) / d[0][idx1absnorm].astype(float)
-                    )
-                    x = data2_queue[mask][idd][idx2]
-                    self.x_data.append(x)
-                    self.x_data_new.append(x)
-        return unprocessed_data, unprocessed_data_norm
+
+        # the normalization trace is the absorption trace normalized by its
+        # reference and by its mean over the last 1500 samples
+        unprocessed_data_norm = []
+        for trace_abs, trace_absnorm in zip(traces_abs, traces_absnorm):
+            norm = trace_abs.astype(float) / trace_absnorm.astype(float)
+            unprocessed_data_norm.append(norm / norm[-1500:].mean())
+        return unprocessed_data, unprocessed_data_norm, x[:, 0]
 
     def ProcessData(self):
         """
         Processing data from the fast device
         """
         # most time spent in FetchData()
-        unprocessed_data, unprocessed_data_norm = self.FetchData()
+        unprocessed_data, unprocessed_data_norm, x = self.FetchData()
 
         if self.processed_changed:
+            self.x_data.clear()
             self.y_data.clear()
-            self.y_data.clear()
+            self.y_data_norm.clear()
             self.x_data_new.clear()
             self.y_data_new.clear()
             self.y_data_norm_new.clear()
+            self.base_histogram = BaseHistogram()
             self.processed_changed = False
             self.redo_binning_flag = True
             return
 
-        if len(self.x_data) == 0:
-            return
-        elif len(unprocessed_data) == 0:
+        if len(unprocessed_data) == 0:
             return
 
-        for idx in reversed(range(len(unprocessed_data))):
-            # self.processing string contains y which is then evaluated
-            y = unprocessed_data[-idx - 1].astype(float)  # noqa: F841
-            y_norm = unprocessed_data_norm[-idx - 1]  # noqa: F841
-            y_norm /= y_norm[-1500:].mean()
-            yi = eval(self.processing)
-            yin = eval(self.processingnorm)
-            self.y_data.append(yi)
-            self.y_data_norm.append(yin)
-            self.y_data_new.append(yi)
-            self.y_data_norm_new.append(yin)
+        # the self.processing and self.processingnorm strings contain y and
+        # y_norm which are then evaluated, for all new traces at once if possible
+        rows = {"y_norm": unprocessed_data_norm}
+        yi = self.fetcher.process("processing", self.processing, unprocessed_data, rows)
+        yin = self.fetcher.process(
+            "processingnorm", self.processingnorm, unprocessed_data, rows
+        )
+        self.x_data.extend(x)
+        self.y_data.extend(yi)
+        self.y_data_norm.extend(yin)
+        self.x_data_new.extend(x)
+        self.y_data_new.extend(yi)
+        self.y_data_norm_new.extend(yin)
@@ -0,0 +1,176 @@
+import logging
+import time
+import traceback
+from typing import List, Tuple
+
+import numpy as np
+import numpy.typing as npt
+
+from histogram import SparseHistogram, TraceFetcher, create_bins
+
+
+class HistogramPlotterND:
+    """
+    Driver takes data from a fast device and two (or more) slow scan parameters,
+    processes the traces from the fast device like HistogramPlotter and bins the
+    processed data against all scan parameters at once, enabling live maps of
+    2-D scans.
+
+    The scan parameters are given as (device, column) pairs after nbins_max, and
+    may come from the same or from different devices. ReadValue() returns one
+    record with a row per scan parameter holding the bin centers, followed by
+    the mean and the count of each bin, for all bins of the N-D grid flattened
+    in C order; the shape of the grid is in the "image_shape" attribute.
+    """
+
+    def __init__(self, parent, time_offset, *params):
+        self.parent = parent
+        self.time_offset = time_offset
+        (self.dev1, self.param1), self.processing, self.nbins_max, *scan = params
+
+        self.nbins_max = int(self.nbins_max)
+
+        # Need the " marks surrounding the expression otherwise the CeNTREX DAQ
+        # enter_cmd fails due to the eval inside main, this is a workaround
+        # that's only necessary on startup, to remove the quotation marks
+        self.dev1 = self.Strip(self.dev1, '"')
+        self.param1 = self.Strip(self.param1, '"')
+        self.processing = self.Strip(self.processing, '"')
+        self.scan: List[Tuple[str, str]] = [
+            (self.Strip(dev, '"'), self.Strip(param, '"')) for dev, param in scan
+        ]
+
+        self.verification_string = "histogram_plotter"
+
+        # statistics of y per visited point of the scan parameters
+        self.sparse_histogram = SparseHistogram(len(self.scan))
+
+        # fetches the new traces of the fast device, matched to the rows of each
+        # scan device by timestamp, and evaluates the processing expression
+        self.fetcher = TraceFetcher(parent, "HistogramPlotterND")
+
+        self.warnings = []
+        self.new_attributes = []
+
+        # shape and type of the array of returned data
+        self.shape = (1, len(self.scan) + 2, self.nbins_max)
+        self.dtype = float
+
+        self.processed_changed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    #################################################
+    # Helper Functions
+    #################################################
+
+    def Strip(self, string, to_strip):
+        return string.strip(to_strip)
+
+    def empty_record(self) -> list:
+        data = np.zeros(self.shape)
+        return [data, [{"timestamp": time.time() - self.time_offset}]]
+
+    #################################################
+    # CeNTREX DAQ Commands
+    #################################################
+
+    def GetWarnings(self):
+        return []
+
+    def ReadValue(self):
+        """
+        Binning the fast and slow data on an N-D grid to enable plotting of maps
+        """
+        try:
+            self.ProcessData()
+        except Exception as exception:
+            logging.error(exception)
+            logging.error(traceback.format_exc())
+
+        # return zeros if no data present
+        if self.sparse_histogram.counts.sum() < 10:
+            return self.empty_record()
+
+        # bins along each axis from the distinct values of the scan parameter,
+        # as HistogramPlotter does for one parameter
+        bin_centers, bin_edges = [], []
+        for axis in range(len(self.scan)):
+            _, edges = create_bins(
+                self.sparse_histogram.points[:, axis], maxsize=self.nbins_max
+            )
+            bin_centers.append(edges[:-1] + np.diff(edges) / 2)
+            bin_edges.append(edges)
+        counts, sums, _ = self.sparse_histogram.image(bin_edges)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(counts > 0, sums / counts, 0.0)
+        grid = np.meshgrid(*bin_centers, indexing="ij")
+        data = np.stack([g.ravel() for g in grid] + [mean.ravel(), counts.ravel()])
+        data = data[np.newaxis, :, :]
+        self.shape = data.shape
+
+        attrs = {
+            "timestamp": time.time() - self.time_offset,
+            "image_shape": np.array(counts.shape),
+        }
+        return [data, [attrs]]
+
+    def SetProcessing(self, processing):
+        self.processing = processing
+        self.processed_changed = True
+
+    def SetDevice1(self, dev1):
+        self.dev1 = dev1
+        self.ClearData()
+
+    def SetParam1(self, param1):
+        self.param1 = param1
+        self.ClearData()
+
+    def set_nbins_max(self, nbins_max: int):
+        self.nbins_max = int(nbins_max)
+
+    def set_match_tolerance(self, match_tolerance: float):
+        """Maximum time [s] between a trace and the scan device rows it is binned by."""
+        self.fetcher.set_tolerance(match_tolerance)
+
+    def ClearData(self):
+        self.sparse_histogram = SparseHistogram(len(self.scan))
+        self.fetcher.reset()
+
+    #################################################
+    # Device Commands
+    #################################################
+
+    def FetchData(self) -> Tuple[list, npt.NDArray]:
+        """
+        Attempting to fetch data from the specified fast and scan devices.
+        Returns the new traces and the scan parameter values matched to each, one
+        row per trace.
+        """
+        (unprocessed_data,), x = self.fetcher.fetch(self.dev1, [self.param1], self.scan)
+        return unprocessed_data, x
+
+    def ProcessData(self):
+        """
+        Processing data from the fast device
+        """
+        unprocessed_data, x = self.FetchData()
+
+        if self.processed_changed:
+            self.sparse_histogram = SparseHistogram(len(self.scan))
+            self.processed_changed = False
+            return
+
+        if len(unprocessed_data) == 0:
+            return
+
+        # self.processing string contains y which is then evaluated, for all new
+        # traces at once if possible
+        y = self.fetcher.process("processing", self.processing, unprocessed_data)
+        self.sparse_histogram.update(x, y)
@@ -38,8 +38,9 @@ class MonitorSignal:
         self.nshots = int(nshots)
         self.max_spots = int(max_spots)
 
-        # storing hash to ensure only new data is checked after
-        self.data_hash = [None for _ in range(nshots)]
+        # sequence number of the last shot checked, to ensure only new data is
+        # checked after
+        self.last_seq = None
 
         self.latest_integral = np.nan
 
@@ -97,22 +98,17 @@ class MonitorSignal:
     #################################################
 
     def FetchData(self):
-        try:
-            data = []
-            for idx in range(self.nshots + 1, 0, -1):
-                d = self.parent.devices[self.pxie].config["plots_queue"][-idx][0]
-                data.append(d)
-            data = np.array(data)
-
-            # checking if all new retrieved shots are new data
-            data_hash = [hash(d[0, 0][:10].tostring()) for d in data]
-            for hn, ho in zip(data_hash, self.data_hash):
-                if hn == ho:
-                    return -1
-            self.data_hash = data_hash
-        except IndexError:
-            logging.error("MonitorSignal error in FetchData(): IndexError")
-            return
+        cache = self.parent.devices[self.pxie].snapshot_cache
+        new = cache.since(self.last_seq)
+        if len(new) < self.nshots + 1:
+            # checking if enough shots are held at all, or only not new yet
+            if cache.count_since(None) < self.nshots + 1:
+                logging.error("MonitorSignal error in FetchData(): not enough shots")
+                return
+            return -1
+        new = new[-(self.nshots + 1) :]
+        self.last_seq = new[-1][0]
+        data = [d[0] for _, d in new]
 
         col_names = split(
             self.parent.devices[self.pxie].config["attributes"]["column_names"]
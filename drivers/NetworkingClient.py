@@ -3,14 +3,17 @@ import importlib
 import inspect
 import json
 import logging
-import threading
 import time
-from pathlib import Path
+from collections import deque
 from types import FunctionType
+from typing import Deque, Dict, List, Optional, Tuple
 
 import numpy as np
-import zmq
-import zmq.auth
+import numpy.typing as npt
+
+from device_utils import remote_metadata, remote_metadata_key
+from networking_connections import close_connection, open_connection
+from networking_messages import decode_history, decode_sample
 
 
 def wrapperNetworkClientMethods(func):
@@ -44,7 +47,16 @@ def NetworkingClassDecorator(cls):
         "OpenConnection",
         "CloseConnection",
         "ExecuteNetworkCommand",
+        "ExecuteNetworkCommands",
+        "SendNetworkCommands",
+        "ReceiveNetworkReply",
+        "SendNetworkRequest",
+        "ReceiveNetworkFrames",
+        "QueryHistory",
+        "QueryMetadata",
+        "CheckRunId",
         "ReadValue",
+        "ReadValues",
         "Decode",
         "GetWarnings",
     ]
@@ -63,48 +75,75 @@ def NetworkingClassDecorator(cls):
     return cls
 
 
-class ReadValueThread(threading.Thread):
-    def __init__(self, parent):
-        super(ReadValueThread, self).__init__()
+class ReadoutBuffer:
+    def __init__(self, parent, maxlen: int = 1000):
         self.parent = parent
-        self.value = None
-        self.daemon = True
-        self.active = threading.Event()
-        self.finished = False
 
-    def run(self):
+        # every sample received and not read yet, with its sequence number on
+        # the server (None for json messages, which are not numbered); the
+        # oldest samples are dropped when the buffer is full
+        self.buffer: Deque[Tuple[Optional[int], list]] = deque(maxlen=maxlen)
+
+        # sequence number of the last sample received, and number of samples
+        # missed (not received) and dropped (received but overwritten before
+        # being read)
+        self.last_seq: Optional[int] = None
+        self.missed = 0
+        self.dropped = 0
+        self.dropping = False
+
+    def receive(self, frames: list):
         """
-        Keep listening on the readout port for new messages from the
-        server in a separate thread, such that the parent class can issue
-        control commands while waiting for a message.
+        Called by the readout thread of the server connection for each message
+        on the topic of the device.
         """
-        while self.active.is_set():
-            # wrap in try-except because the context is sometimes terminated
-            # upon stopping the program before the while loop reaches the
-            # cleared thread event active
-            try:
-                # need the timeout because REP-REQ will wait indefinitely for a
-                # reply, need to handle when a server stops or a message isn't
-                # received for some other reason
-                if (
-                    self.parent.socket_readout.poll(self.parent.timeout) & zmq.POLLIN
-                ) != 0:
-                    data = self.parent.socket_readout.recv_string()
-                    retval = self.parent.Decode(data)
-                    retval[0] -= self.parent.time_offset
-                    self.value = retval
-            except zmq.error.ContextTerminated:
-                warning_dict = {
-                    "message": "stopped ReadValueThread because context was terminated"
-                }
-                self.parent.warnings.append([time.time(), warning_dict])
-                logging.info(
-                    f"{self.parent.device_name} networking info in "
-                    + "ReadValueThread : stopped subscription"
+        if len(frames) == 1:
+            # json encoded slow data from servers predating the binary messages
+            retval = self.parent.Decode(frames[0].bytes.decode())
+            retval[0] -= self.parent.time_offset
+            self.append(None, retval)
+        else:
+            seq, value = decode_sample(frames, self.parent.time_offset)
+            self.check_sequence(seq)
+            self.append(seq, value)
+
+    def check_sequence(self, seq: int):
+        """Report samples published by the server but not received."""
+        # a lower sequence number means the server device was restarted
+        if self.last_seq is not None and seq > self.last_seq + 1:
+            missed = seq - self.last_seq - 1
+            self.missed += missed
+            self.report(f"missed {missed} samples (seq {self.last_seq + 1}-{seq - 1})")
+        self.last_seq = seq
+
+    def append(self, seq: Optional[int], value: list):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            # report the first drop until the buffer is read again
+            if not self.dropping:
+                self.dropping = True
+                self.report(
+                    f"receive buffer full ({self.buffer.maxlen} samples), dropping"
+                    " the oldest samples"
                 )
-            # sleep to release to other threads
-            time.sleep(1e-4)
-            self.finished = True
+        self.buffer.append((seq, value))
+
+    def report(self, message: str):
+        logging.warning(
+            f"{self.parent.device_name} networking warning in ReadoutBuffer :"
+            f" {message}"
+        )
+        self.parent.warnings.append(
+            [time.time(), {"message": f"{self.parent.device_name}: {message}"}]
+        )
+
+    def pop_all(self) -> List[list]:
+        """Return all samples received since the last call, oldest first."""
+        values = []
+        self.dropping = False
+        while self.buffer:
+            values.append(self.buffer.popleft()[1])
+        return values
 
 
 def NetworkingClient(time_offset, driver, connection, *args):
@@ -132,31 +171,37 @@ def NetworkingClient(time_offset, driver, connection, *args):
             self.port_control = connection["port_control"]
             self.publisher = connection["publisher_name"]
             self.device_name = connection["device_name"]
+            self.keys_dir = connection.get("keys_dir")
+            self.metadata_key = remote_metadata_key(connection)
 
-            # set the control connection timeout
+            # set the control connection timeout [ms]
             self.timeout = 10e3
+
+            # the commands of each request waiting for a reply
+            self.pending_commands: Dict[int, List[str]] = {}
+
+            self.warnings = []
+
+            # every sample received from the server until read
+            self.readout_buffer = ReadoutBuffer(
+                self, int(connection.get("buffer_length", 1000))
+            )
+
             # open connections to the server
             self.topicfilter = f"{self.publisher}-{self.device_name}"
             self.OpenConnection()
 
-            self.warnings = []
-
-            self.verification_string = self.ExecuteNetworkCommand("verification_string")
+            # verification string, dtype and shape of the remote device in a
+            # single request, or from the cache if the server run is unchanged
+            metadata = self.QueryMetadata() or {}
+            self.verification_string = metadata.get("verification_string", np.nan)
+            self.dtype = metadata.get("dtype", np.nan)
+            self.shape = metadata.get("shape", np.nan)
             logging.info(
                 "NetworkingClientClass: retrieved verification_string"
-                f" {self.verification_string}"
+                f" {self.verification_string}, dtype {self.dtype}, shape {self.shape}"
             )
 
-            self.dtype = self.ExecuteNetworkCommand("dtype")
-            logging.info(f"NetworkingClientClass: retrieved dtype {self.dtype}")
-
-            self.shape = self.ExecuteNetworkCommand("shape")
-            logging.info(f"NetworkingClientClass: retrieved shape {self.shape}")
-
-            self.readvalue_thread = ReadValueThread(self)
-            self.readvalue_thread.active.set()
-            self.readvalue_thread.start()
-
             self.new_attributes = []
 
             self.is_networking_client = True
@@ -172,61 +217,17 @@ def NetworkingClient(time_offset, driver, connection, *args):
             return warnings
 
         def OpenConnection(self):
-            # starting the context
-            self.context = zmq.Context()
-
-            # opening the sockets
-            self.socket_control = self.context.socket(zmq.REQ)
-            self.socket_readout = self.context.socket(zmq.SUB)
-
-            # loading authentication keys
-            file_path = Path(__file__).resolve()
-            public_keys_dir = file_path.parent.parent / "authentication" / "public_keys"
-            secret_keys_dir = (
-                file_path.parent.parent / "authentication" / "private_keys"
+            # the sockets are shared with the other clients of the same server
+            self.connection = open_connection(
+                self.server, self.port_readout, self.port_control, self.keys_dir
             )
-            server_public_file = public_keys_dir / "server.key"
-            client_secret_file = secret_keys_dir / "client.key_secret"
-
-            server_public, _ = zmq.auth.load_certificate(str(server_public_file))
-            client_public, client_secret = zmq.auth.load_certificate(
-                str(client_secret_file)
-            )
-
-            self.socket_control.curve_secretkey = client_secret
-            self.socket_control.curve_publickey = client_public
-            self.socket_control.curve_serverkey = server_public
-
-            # starting readout
-            self.socket_readout.setsockopt_string(zmq.SUBSCRIBE, self.topicfilter)
-            self.socket_readout.connect(f"tcp://{self.server}:{self.port_readout}")
-            logging.info("NetworkingClientClass: connected to readout socket")
-
-            # starting control
-            self.socket_control.connect(f"tcp://{self.server}:{self.port_control}")
-            logging.info("NetworkingClientClass: connected to control socket")
-
+            self.connection.subscribe(self.topicfilter, self.readout_buffer.receive)
             logging.info("NetworkingClientClass: connection opened")
 
         def CloseConnection(self):
-            # close all connections
-            self.readvalue_thread.active.clear()
-            while not self.readvalue_thread.finished:
-                time.sleep(1e-3)
-            logging.debug("NetworkingClient: stopped ReadValue thread")
-
-            self.socket_readout.setsockopt(zmq.LINGER, 0)
-            logging.debug("NetworkingClient: socket_readout linger = 0")
-            self.socket_control.setsockopt(zmq.LINGER, 0)
-            logging.debug("NetworkingClient: socket_control linger = 0")
-
-            self.socket_readout.close()
-            logging.debug("NetworkingClient: socket_readout closed")
-            self.socket_control.close()
-            logging.debug("NetworkingClient: socket_control closed")
-
-            self.context.term()
-            logging.debug("NetworkingClient: context terminated")
+            self.connection.unsubscribe(self.topicfilter)
+            close_connection(self.connection)
+            logging.debug("NetworkingClient: connection closed")
 
         def Decode(self, message):
             """
@@ -237,55 +238,201 @@ def NetworkingClient(time_offset, driver, connection, *args):
             retval = json.loads(dat)
             return retval
 
-        def ExecuteNetworkCommand(self, command):
-            # send command to the server hosting the device
-            self.socket_control.send_json([self.device_name, command])
+        def SendNetworkRequest(
+            self, request: dict, timeout: Optional[float] = None
+        ) -> int:
+            """
+            Send a request to the server without waiting for the reply, and
+            return the request id to pass to ReceiveNetworkFrames(). The server
+            gives up on the request after timeout [ms].
+            """
+            timeout = self.timeout if timeout is None else timeout
+            return self.connection.send(request, timeout / 1e3)
+
+        def ReceiveNetworkFrames(self, request_id: int) -> Optional[list]:
+            """
+            Wait for the reply to a request, up to its timeout, and return its
+            frames, starting with the json header; None if there was no reply.
+            """
+            frames = self.connection.receive(request_id)
+            if frames is None:
+                # error handling if no reply received withing timeout
+                logging.warning(
+                    f"{self.device_name} networking warning in"
+                    " ReceiveNetworkFrames : no response from server"
+                )
+                warning_dict = {
+                    "message": (
+                        f"ExecuteNetworkCommand for {self.device_name}: no response"
+                        " from server"
+                    )
+                }
+                self.warnings.append([time.time(), warning_dict])
+            return frames
+
+        def SendNetworkCommands(
+            self, commands: List[str], timeout: Optional[float] = None
+        ) -> int:
+            """
+            Send a batch of commands for the device to the server without
+            waiting for the reply, and return the request id to pass to
+            ReceiveNetworkReply(). The server executes the commands in order and
+            gives up on them after timeout [ms]. Several requests can be in
+            flight at once; they are handled by different server workers, so
+            commands that depend on each other's order go in the same batch.
+            """
+            request = {
+                "commands": [[self.device_name, command] for command in commands]
+            }
+            request_id = self.SendNetworkRequest(request, timeout)
+            self.pending_commands[request_id] = list(commands)
             logging.info(
-                f"ExecuteNetworkCommand : {command} to {self.device_name} at"
+                f"SendNetworkCommands : {commands} to {self.device_name} at"
                 f" {self.server}:{self.port_control}"
             )
+            return request_id
 
-            # need the timeout because REP-REQ will wait indefinitely for a
-            # reply, need to handle when a server stops or a message isn't
-            # received for some other reason
-            if (self.socket_control.poll(self.timeout) & zmq.POLLIN) != 0:
-                status, retval = self.socket_control.recv_json()
+        def ReceiveNetworkReply(self, request_id: int) -> list:
+            """
+            Wait for the reply to a request sent with SendNetworkCommands(), up
+            to its timeout, and return the return value of each command, or NaN
+            for commands that failed or were not executed.
+            """
+            commands = self.pending_commands.pop(request_id)
+            frames = self.ReceiveNetworkFrames(request_id)
+            if frames is None:
+                return [np.nan] * len(commands)
+            reply = None
+            try:
+                reply = json.loads(frames[0].bytes)
+                results = reply["results"]
+            except (TypeError, KeyError, ValueError):
+                if isinstance(reply, dict) and "message" in reply:
+                    logging.warning(
+                        f"{self.device_name} networking warning in "
+                        + f"ExecuteNetworkCommand : {reply['message']}"
+                    )
+                return [np.nan] * len(commands)
+            self.CheckRunId(reply.get("run_id"))
+
+            values = []
+            for command, (status, retval) in zip(commands, results):
                 if status == "OK":
-                    return retval
+                    values.append(retval)
                 else:
                     logging.warning(
                         f"{self.device_name} networking warning in "
                         + f"ExecuteNetworkCommand : error for {command} -> {retval}"
                     )
-                    return np.nan
-
-            # error handling if no reply received withing timeout
-            logging.warning(
-                f"{self.device_name} networking warning in ExecuteNetworkCommand : no"
-                " response from server"
+                    values.append(np.nan)
+            return values
+
+        def QueryHistory(
+            self,
+            start: Optional[float] = None,
+            stop: Optional[float] = None,
+            last: Optional[int] = None,
+            max_rows: Optional[int] = None,
+            method: str = "mean",
+            source: str = "auto",
+            timeout: Optional[float] = None,
+        ) -> Optional[npt.NDArray]:
+            """
+            Rows of the device on the server with the time between start and
+            stop (absolute times), or the last `last` of those, as a 2-D float
+            array with the absolute time in the first column. The rows come from
+            the memory of the server device or from the storage of the current
+            run (source "memory", "storage", or "auto"), and are decimated on
+            the server to at most max_rows ("mean" or "stride" method). Returns
+            None if the query failed.
+            """
+            query = {
+                "device": self.device_name,
+                "start": start,
+                "stop": stop,
+                "last": last,
+                "max_rows": max_rows,
+                "method": method,
+                "source": source,
+            }
+            frames = self.ReceiveNetworkFrames(
+                self.SendNetworkRequest({"history": query}, timeout)
             )
-            warning_dict = {
-                "message": (
-                    f"ExecuteNetworkCommand for {self.device_name}: no response from"
-                    " server"
+            if frames is None:
+                return None
+            header, rows = decode_history(frames)
+            if rows is None:
+                logging.warning(
+                    f"{self.device_name} networking warning in QueryHistory :"
+                    f" {header.get('message')}"
                 )
+            return rows
+
+        def QueryMetadata(self, timeout: Optional[float] = None) -> Optional[dict]:
+            """
+            Metadata of the device on the server: the verification string, dtype
+            and shape of its driver, its attributes and column names, and the
+            signature of each driver method. The metadata is cached for all
+            clients of the device and only sent again by the server when its run
+            id changed. Returns None if the query failed.
+            """
+            cached = remote_metadata.get(self.metadata_key)
+            query = {
+                "device": self.device_name,
+                "run_id": None if cached is None else cached["run_id"],
             }
-            self.warnings.append([time.time(), warning_dict])
-            self.socket_control.setsockopt(zmq.LINGER, 0)
-            self.socket_control.close()
-            # reconnect upon failure
-            self.socket_control = self.context.socket(zmq.REQ)
-            self.socket_control.connect(f"tcp://{self.server}:{self.port_control}")
-            return np.nan
+            frames = self.ReceiveNetworkFrames(
+                self.SendNetworkRequest({"metadata": query}, timeout)
+            )
+            if frames is None:
+                return None
+            reply = json.loads(frames[0].bytes)
+            if reply.get("status") != "OK":
+                logging.warning(
+                    f"{self.device_name} networking warning in QueryMetadata :"
+                    f" {reply.get('message')}"
+                )
+                remote_metadata.pop(self.metadata_key, None)
+                return None
+            if not reply.get("unchanged"):
+                remote_metadata[self.metadata_key] = dict(
+                    reply["metadata"], run_id=reply["run_id"]
+                )
+            return remote_metadata.get(self.metadata_key)
+
+        def CheckRunId(self, run_id: Optional[str]):
+            """Drop the cached metadata if the server was restarted since."""
+            cached = remote_metadata.get(self.metadata_key)
+            if cached is not None and run_id is not None and cached["run_id"] != run_id:
+                logging.info(
+                    f"{self.device_name} networking info : server run changed,"
+                    " dropping the cached metadata"
+                )
+                remote_metadata.pop(self.metadata_key, None)
+
+        def ExecuteNetworkCommands(
+            self, commands: List[str], timeout: Optional[float] = None
+        ) -> list:
+            """Execute a batch of commands on the server in a single round trip."""
+            return self.ReceiveNetworkReply(self.SendNetworkCommands(commands, timeout))
+
+        def ExecuteNetworkCommand(self, command):
+            return self.ExecuteNetworkCommands([command])[0]
 
         def ReadValue(self):
-            if self.readvalue_thread.value:
-                value = self.readvalue_thread.value
-                self.readvalue_thread.value = None
-                return value
+            values = self.readout_buffer.pop_all()
+            if values:
+                return values[-1]
             else:
                 return np.nan
 
+        def ReadValues(self):
+            """
+            Return all samples received since the last read, oldest first, so
+            that no sample published faster than the device dt is lost.
+            """
+            return self.readout_buffer.pop_all()
+
     return NetworkingClientClass(time_offset, connection, *args)
 
 
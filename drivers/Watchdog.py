@@ -12,6 +12,9 @@ class Watchdog:
         self.dev1, self.param1, self.comp1, self.number1, self.dev2, self.function, self.message = params
         self.watchdog_active = True
 
+        # sequence number of the last row of data checked
+        self.last_seq = None
+
         # convert numbers from str to float
         try:
             self.number1 = float(self.number1)
@@ -46,11 +49,11 @@ class Watchdog:
             self.CheckConditions()
 
     def CheckConditions(self):
-        # get the latest row of data
-        try:
-            latest_data = self.parent.devices[self.dev1].config["plots_queue"][-1]
-        except IndexError:
+        # get the latest row of data, if it has not been checked yet
+        latest = self.parent.devices[self.dev1].snapshot_cache.latest()
+        if latest is None or latest[0] == self.last_seq:
             return
+        self.last_seq, latest_data = latest
 
         # extract the desired parameter 1
         col_names = split(self.parent.devices[self.dev1].config["attributes"]["column_names"])
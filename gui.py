@@ -25,6 +25,7 @@ from device_utils import get_device_methods
 from hdf_writer import HDF_writer
 from monitoring import Monitoring
 from networking import Networking
+from networking_connections import shared_context
 from plots import PlotsGUI
 from sequencer import SequencerGUI
 from utils import split
@@ -1696,10 +1697,17 @@ class ControlGUI(qt.QWidget):
         self.devices_frame.clear()
         self.place_device_controls()
 
+        # the plots cannot keep the HDF file open while it is written to
+        self.parent.PlotsGUI.hdf_cache.close()
+
         # start the thread that writes to HDF
         self.HDF_writer = HDF_writer(self.parent, self.parent.hdf_clear)
         self.HDF_writer.start()
 
+        # create the ZMQ context shared by the networking server and clients
+        # before the networking client devices start
+        shared_context(int(self.parent.config["networking"].get("io_threads", 1)))
+
         # start control for all devices
         for dev_name, dev in self.parent.devices.items():
             if dev.config["control_params"]["enabled"]["value"]:
@@ -5,12 +5,13 @@ import threading
 import time
 import traceback
 from pathlib import Path
-from typing import Deque
+from typing import Deque, Optional
 
-import h5py
 import numpy as np
 
+from device import sample_nbytes
 from protocols import CentrexGUIProtocol
+from storage import ProcessBackend, StorageBackend, make_backend
 
 
 class HDF_writer(threading.Thread):
@@ -29,7 +30,17 @@ class HDF_writer(threading.Thread):
             + str(self.parent.config["general"]["run_name"])
         )
 
-        if clear:
+        # storage backend for the run
+        self.backend_kind: str = self.parent.config["files"].get(
+            "storage_backend", "hdf"
+        )
+
+        # run the storage backend in a separate process
+        self.use_process = self.parent.config["general"].get(
+            "hdf_writer_process", "False"
+        ) in ["1", "True"]
+
+        if clear and self.backend_kind == "hdf":
             file = Path(self.filename)
             if file.is_file():
                 ret = subprocess.call(f"h5clear -s {self.filename}", shell=True)
@@ -39,83 +50,129 @@ class HDF_writer(threading.Thread):
         # time since last write
         self.time_last_write = datetime.datetime.now().replace(microsecond=0)
 
+        # set by the devices when data is waiting to be written
+        self.data_ready = threading.Event()
+        self.idle_timeout = 1.0
+
+        # age of the oldest sample waiting to be written [s]
+        self.writer_lag = 0.0
+
         # create/open HDF file, groups, and datasets
         try:
-            with h5py.File(self.filename, "a", libver="latest") as f:
-                root = f.create_group(self.parent.run_name)
-
+            self.backend = make_backend(
+                self.backend_kind, self.filename, self.parent.run_name
+            )
+            with self.backend as backend:
                 # write run attributes
-                root.attrs["time_offset"] = self.parent.config["time_offset"]
-                for key, val in self.parent.config["run_attributes"].items():
-                    root.attrs[key] = val
+                attrs = {"time_offset": self.parent.config["time_offset"]}
+                attrs.update(self.parent.config["run_attributes"])
+                backend.create_run(attrs)
 
                 for dev_name, dev in self.parent.devices.items():
                     # check device is enabled
                     if dev.config["control_params"]["enabled"]["value"] < 1:
                         continue
 
-                    grp = root.require_group(dev.config["path"])
-
-                    # create dataset for data if only one is needed
-                    # (fast devices create a new dataset for each acquisition)
                     if dev.config["slow_data"]:
-                        if isinstance(dev.config["dtype"], (list, tuple, np.ndarray)):
-                            dtype = np.dtype(
-                                [
-                                    (name.strip(), dtype)
-                                    for name, dtype in zip(
-                                        dev.config["attributes"]["column_names"].split(
-                                            ","
-                                        ),
-                                        dev.config["dtype"],
-                                    )
-                                ]
-                            )
-                        else:
-                            dtype = np.dtype(
-                                [
-                                    (name.strip(), dev.config["dtype"])
-                                    for name in dev.config["attributes"][
-                                        "column_names"
-                                    ].split(",")
-                                ]
-                            )
-                        dset = grp.create_dataset(
-                            dev.config["name"], (0,), maxshape=(None,), dtype=dtype
-                        )
-                        for attr_name, attr in dev.config["attributes"].items():
-                            dset.attrs[attr_name] = attr
+                        dtype = self.slow_data_dtype(dev)
                     else:
-                        for attr_name, attr in dev.config["attributes"].items():
-                            grp.attrs[attr_name] = attr
-
-                    # create dataset for events
-                    grp.create_dataset(
-                        dev.config["name"] + "_events",
-                        (0, 3),
-                        maxshape=(None, 3),
-                        dtype=h5py.special_dtype(vlen=str),
+                        dtype = dev.config["dtype"]
+
+                    backend.create_stream(
+                        dev.config["path"],
+                        dev.config["name"],
+                        dev.config["attributes"],
+                        dtype,
+                        dev.config["slow_data"],
                     )
 
         except Exception as e:
             self.hdf_error.set()
             logging.error(f"HDF_witer error: {e}")
 
+    def fast_streams(self) -> bool:
+        """Whether the run has streams of fast data, created for enabled devices."""
+        return any(
+            dev.config["control_params"]["enabled"]["value"] >= 1
+            and not dev.config["slow_data"]
+            for dev in self.parent.devices.values()
+        )
+
+    def slow_data_dtype(self, dev) -> np.dtype:
+        if isinstance(dev.config["dtype"], (list, tuple, np.ndarray)):
+            return np.dtype(
+                [
+                    (name.strip(), dtype)
+                    for name, dtype in zip(
+                        dev.config["attributes"]["column_names"].split(","),
+                        dev.config["dtype"],
+                    )
+                ]
+            )
+        else:
+            return np.dtype(
+                [
+                    (name.strip(), dev.config["dtype"])
+                    for name in dev.config["attributes"]["column_names"].split(",")
+                ]
+            )
+
     def run(self):
         self.active.set()
         if self.hdf_error.is_set():
             return
-        with h5py.File(self.filename, "a", libver="latest") as file:
+        if self.use_process and self.backend_kind == "hdf" and self.fast_streams():
+            # the writer process opens the HDF file in SWMR mode so the plots
+            # and history requests can read it, but datasets cannot be created
+            # in SWMR mode, as fast data needs for every record
+            logging.warning(
+                "HDF_writer: fast devices are recorded, writing in a thread"
+                " instead of a separate process"
+            )
+            self.use_process = False
+        if self.use_process:
+            backend = ProcessBackend(
+                self.backend_kind,
+                self.filename,
+                self.parent.run_name,
+                swmr=self.backend_kind == "hdf",
+            )
+            try:
+                backend.open()
+            except Exception as err:
+                self.hdf_error.set()
+                logging.error(f"HDF_writer error: {err}")
+                logging.error(traceback.format_exc())
+                return
+        else:
+            backend = self.backend
+        with backend:
             time_last_flush = time.time()
+            bytes_since_flush = 0
             while self.active.is_set():
+                # wait until there is enough data to write, or the oldest sample
+                # in the queues has waited for the maximum latency
+                self.wait_for_data()
+
                 # update the last write time
-                self.time_last_write = datetime.datetime.now().replace(microsecond=0)
+                if self.use_process:
+                    if not self.check_process(backend):
+                        break
+                else:
+                    self.time_last_write = datetime.datetime.now().replace(
+                        microsecond=0
+                    )
 
                 # empty queues to HDF
                 try:
-                    self.write_all_queues_to_HDF(file)
-                    if time.time() - time_last_flush > 10.0:
-                        file.flush()
+                    bytes_since_flush += self.write_all_queues_to_HDF(backend)
+                    if (
+                        bytes_since_flush >= self.flush_bytes
+                        or time.time() - time_last_flush > self.flush_interval
+                    ):
+                        backend.flush()
+                        time_last_flush = time.time()
+                        bytes_since_flush = 0
                 except OSError as err:
                     if (
                         str(err)
@@ -126,30 +183,113 @@ class HDF_writer(threading.Thread):
                         logging.warning(f"HDF_writer error: {err}")
                         logging.warning(traceback.format_exc())
 
-                # loop delay
-                try:
-                    dt = float(self.parent.config["general"]["hdf_loop_delay"])
-                    if dt < 0.002:
-                        logging.warning("Plot dt too small.")
-                        logging.warning("hdf_loop_delay too small.")
-                        raise ValueError
-                    time.sleep(dt)
-                except ValueError as e:
-                    logging.warning(e)
-                    logging.warning(traceback.format_exc())
-                    time.sleep(float(self.parent.config["general"]["default_hdf_dt"]))
-
             # make sure everything is written to HDF when the thread terminates
             try:
-                self.write_all_queues_to_HDF(file)
-                file.flush()
+                self.write_all_queues_to_HDF(backend)
+                backend.flush()
             except OSError as err:
                 logging.warning("HDF_writer error: ", err)
                 logging.warning(traceback.format_exc())
         logging.info("HDF_writer: stopped")
 
-    def write_all_queues_to_HDF(self, file: h5py.File):
-        root = file[self.parent.run_name]
+    def read_loop_parameters(self):
+        conf = self.parent.config["general"]
+
+        # maximum time a sample waits in the queue before it is written
+        try:
+            self.max_latency = float(conf["hdf_loop_delay"])
+            if self.max_latency < 0.002:
+                logging.warning("hdf_loop_delay too small.")
+                raise ValueError
+        except ValueError as e:
+            logging.warning(e)
+            logging.warning(traceback.format_exc())
+            self.max_latency = float(conf["default_hdf_dt"])
+
+        # write early when a device queue holds this many rows or bytes, flush
+        # after this many bytes written or seconds passed
+        try:
+            self.write_rows = int(conf.get("hdf_write_rows", 1000))
+            self.write_bytes = int(float(conf.get("hdf_write_bytes", 10e6)))
+            self.flush_bytes = int(float(conf.get("hdf_flush_bytes", 100e6)))
+            self.flush_interval = float(conf.get("hdf_flush_interval", 10.0))
+        except ValueError as e:
+            logging.warning(e)
+            logging.warning(traceback.format_exc())
+            self.write_rows, self.write_bytes = 1000, int(10e6)
+            self.flush_bytes, self.flush_interval = int(100e6), 10.0
+
+        for dev in self.parent.devices.values():
+            dev.hdf_notify = self.data_ready
+            dev.hdf_notify_rows = self.write_rows
+            dev.hdf_notify_bytes = self.write_bytes
+
+    def writing_devices(self):
+        for dev in self.parent.devices.values():
+            if not dev.control_started:
+                continue
+            if not int(dev.config["control_params"]["HDF_enabled"]["value"]):
+                continue
+            yield dev
+
+    def oldest_unwritten(self) -> Optional[float]:
+        times = [
+            dev.time_oldest_unwritten
+            for dev in self.writing_devices()
+            if dev.time_oldest_unwritten is not None
+        ]
+        return min(times) if times else None
+
+    def queues_over_threshold(self) -> bool:
+        for dev in self.writing_devices():
+            if len(dev.data_queue) >= self.write_rows:
+                return True
+            if dev.data_queue_bytes >= self.write_bytes:
+                return True
+        return False
+
+    def wait_for_data(self):
+        """
+        Sleep until a device queue crosses the row or byte threshold, or the
+        oldest unwritten sample has waited for max_latency. Without any data, wake
+        up every idle_timeout to write events and report the writer is alive.
+        """
+        self.read_loop_parameters()
+        while self.active.is_set():
+            self.data_ready.clear()
+            oldest = self.oldest_unwritten()
+            if oldest is None:
+                self.writer_lag = 0.0
+                timeout = self.idle_timeout
+            else:
+                self.writer_lag = time.time() - oldest
+                timeout = self.max_latency - self.writer_lag
+                if timeout <= 0:
+                    return
+            if self.queues_over_threshold():
+                return
+            if not self.data_ready.wait(min(timeout, self.idle_timeout)):
+                return
+
+    def check_process(self, backend: ProcessBackend) -> bool:
+        """
+        Report errors from the writer process and take the last write time from
+        its status messages. Returns False if the process is no longer running.
+        """
+        for error in backend.poll_status():
+            logging.warning(f"HDF_writer process error: {error}")
+        self.time_last_write = datetime.datetime.fromtimestamp(
+            backend.time_last_write
+        ).replace(microsecond=0)
+        if not backend.is_alive():
+            logging.error("HDF_writer: writer process stopped unexpectedly")
+            self.hdf_error.set()
+            return False
+        return True
+
+    def write_all_queues_to_HDF(self, backend: StorageBackend) -> int:
+        """Empty the device queues to the backend; returns the bytes written."""
+        nbytes = 0
         for dev_name, dev in self.parent.devices.items():
             # check device has had control started
             if not dev.control_started:
@@ -159,57 +299,34 @@ class HDF_writer(threading.Thread):
             if not int(dev.config["control_params"]["HDF_enabled"]["value"]):
                 continue
 
+            path, name = dev.config["path"], dev.config["name"]
+
             # get events, if any, and write them to HDF
             events = self.get_data(dev.events_queue)
             if len(events) != 0:
                 # make sure all are strings
                 events = [[str(v) for v in e] for e in events]
-                grp = root[dev.config["path"]]
-                events_dset = grp[dev.config["name"] + "_events"]
-                events_dset.resize(events_dset.shape[0] + len(events), axis=0)
-                events_dset[-len(events) :, :] = events
+                backend.append_events(path, name, events)
 
             # get data
+            dev.time_oldest_unwritten = None
+            dev.data_queue_bytes = 0
             data = self.get_data(dev.data_queue)
             if len(data) == 0:
                 continue
-
-            grp = root[dev.config["path"]]
+            nbytes += sum(sample_nbytes(d) for d in data)
 
             # if writing all data from a single device to one dataset
             if dev.config["slow_data"]:
-                dset = grp[dev.config["name"]]
-                # check if one queue entry has multiple rows
-                if np.shape(data)[0] >= 2:
-                    list_len = len(data)
-                    dset.resize(dset.shape[0] + list_len, axis=0)
-                    # iterate over queue entries with multiple rows and append
-                    for idx, d in enumerate(data):
-                        idx_start = -list_len + idx
-                        idx_stop = -list_len + idx + 1
-                        try:
-                            d = np.array([tuple(d)], dtype=dset.dtype)
-                            if idx_stop == 0:
-                                dset[idx_start:] = d
-                            else:
-                                dset[idx_start:idx_stop] = d
-                        except Exception as err:
-                            logging.error(
-                                f"Error in write_all_queues_to_HDF: {dev_name};"
-                                f" {str(err)}"
-                            )
-                else:
-                    dset.resize(dset.shape[0] + len(data), axis=0)
-                    try:
-                        data = np.array([tuple(data[0])], dtype=dset.dtype)
-                        dset[-len(data) :] = data
-                    except (ValueError, TypeError) as err:
-                        logging.error(
-                            "Error in write_all_queues_to_HDF(): "
-                            + f"{dev_name}; "
-                            + str(err)
-                        )
-                        logging.error(traceback.format_exc())
+                try:
+                    backend.append_rows(path, name, data)
+                except (ValueError, TypeError) as err:
+                    logging.error(
+                        "Error in write_all_queues_to_HDF(): "
+                        + f"{dev_name}; "
+                        + str(err)
+                    )
+                    logging.error(traceback.format_exc())
 
             # if writing each acquisition record to a separate dataset
             else:
@@ -220,16 +337,10 @@ class HDF_writer(threading.Thread):
                 # parse and write the data
                 for record, all_attrs in data:
                     for waveforms, attrs in zip(record, all_attrs):
-                        # data
-                        dset = grp.create_dataset(
-                            name=dev.config["name"] + "_" + str(len(grp)),
-                            data=waveforms.T,
-                            dtype=dev.config["dtype"],
-                            compression=None,
+                        backend.append_block(
+                            path, name, waveforms.T, attrs, dtype=dev.config["dtype"]
                         )
-                        # metadata
-                        for key, val in attrs.items():
-                            dset.attrs[key] = val
+        return nbytes
 
     def get_data(self, fifo: Deque):
         data = []
@@ -0,0 +1,429 @@
+import logging
+import traceback
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+
+from utils import AsofMatcher, Expression, split
+
+
+class Histogram:
+    """
+    Count, sum and sum of squares of the y values falling in each bin of x, kept
+    in arrays and updated with np.bincount, so an update costs O(points)
+    regardless of the number of bins. Shared by the histogram plotter drivers.
+    """
+
+    def __init__(self, bin_edges: Union[Sequence[int], Sequence[float]]):
+        self.bin_edges = np.asarray(bin_edges, dtype=float)
+        self.bin_centers = self.bin_edges[:-1] + np.diff(self.bin_edges) / 2
+
+        nbins = len(self.bin_centers)
+        self.counts = np.zeros(nbins, dtype=np.int64)
+        self.sums = np.zeros(nbins)
+        self.sums_sq = np.zeros(nbins)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def update(
+        self,
+        x: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
+        y: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
+    ):
+        """Add the points (x, y); points outside the bins or with y NaN are ignored."""
+        if len(self) == 0:
+            return
+        try:
+            x = np.asarray(x, dtype=float).ravel()
+            y = np.asarray(y, dtype=float).ravel()
+            # bin i is (bin_edges[i], bin_edges[i + 1]]
+            indices = np.digitize(x, bins=self.bin_edges, right=True) - 1
+        except (TypeError, ValueError):
+            logging.error("Histogram: cannot bin data")
+            logging.error(traceback.format_exc())
+            return
+
+        m = (indices >= 0) & (indices < len(self)) & np.isfinite(y)
+        indices, y = indices[m], y[m]
+        nbins = len(self)
+        self.counts += np.bincount(indices, minlength=nbins)
+        self.sums += np.bincount(indices, weights=y, minlength=nbins)
+        self.sums_sq += np.bincount(indices, weights=y * y, minlength=nbins)
+
+    @property
+    def mean(self) -> npt.NDArray[np.float_]:
+        """Mean of y per bin, NaN for empty bins."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sums / self.counts
+
+    @property
+    def std(self) -> npt.NDArray[np.float_]:
+        """Sample standard deviation of y per bin, NaN for bins with < 2 points."""
+        counts = self.counts.astype(float)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            var = (self.sums_sq - self.sums**2 / counts) / (counts - 1)
+        var[counts < 2] = np.nan
+        # rounding can make the variance of identical values slightly negative
+        return np.sqrt(np.clip(var, 0, None))
+
+    @property
+    def sem(self) -> npt.NDArray[np.float_]:
+        """Standard error of the mean of y per bin, NaN for bins with < 2 points."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.std / np.sqrt(self.counts)
+
+    @property
+    def x(self) -> Union[npt.NDArray[np.int_], npt.NDArray[np.float_]]:
+        return self.bin_centers
+
+    @property
+    def y(self) -> Union[npt.NDArray[np.int_], npt.NDArray[np.float_]]:
+        """Mean of y per bin, 0 for empty bins (as plotted)."""
+        return np.where(self.counts > 0, self.mean, 0.0)
+
+
+class BaseHistogram:
+    """
+    Count, sum and sum of squares of y for each distinct value of x (the scan
+    values), kept sorted by x. The Histogram for any set of coarser bins is
+    derived from these sufficient statistics by rebin() in O(distinct values),
+    without going back to the individual points.
+
+    If there are more than max_values distinct values (a continuous rather than
+    a stepped scan), they are merged onto a grid of max_values / 2 points.
+    """
+
+    def __init__(self, max_values: int = 10_000):
+        self.max_values = max_values
+        self.values = np.empty(0)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0)
+        self.sums_sq = np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def update(
+        self,
+        x: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
+        y: Union[npt.NDArray[np.int_], npt.NDArray[np.float_]],
+    ):
+        """Add the points (x, y); points with x or y NaN are ignored."""
+        x = np.asarray(x, dtype=float).ravel()
+        y = np.asarray(y, dtype=float).ravel()
+        m = np.isfinite(x) & np.isfinite(y)
+        self.merge(
+            np.concatenate((self.values, x[m])),
+            np.concatenate((self.counts, np.ones(m.sum(), dtype=np.int64))),
+            np.concatenate((self.sums, y[m])),
+            np.concatenate((self.sums_sq, y[m] ** 2)),
+        )
+        if len(self) > self.max_values:
+            grid = np.linspace(self.values[0], self.values[-1], self.max_values // 2)
+            # index of the nearest grid point
+            step = grid[1] - grid[0]
+            indices = np.rint((self.values - grid[0]) / step).astype(np.int64)
+            self.merge(grid[indices], self.counts, self.sums, self.sums_sq)
+
+    def merge(
+        self,
+        values: npt.NDArray[np.float_],
+        counts: npt.NDArray[np.int_],
+        sums: npt.NDArray[np.float_],
+        sums_sq: npt.NDArray[np.float_],
+    ):
+        """Set the statistics from entries with possibly repeated values."""
+        self.values, indices = np.unique(values, return_inverse=True)
+        n = len(self.values)
+        self.counts = np.bincount(indices, weights=counts, minlength=n).astype(np.int64)
+        self.sums = np.bincount(indices, weights=sums, minlength=n)
+        self.sums_sq = np.bincount(indices, weights=sums_sq, minlength=n)
+
+    def rebin(self, bin_edges: Union[Sequence[int], Sequence[float]]) -> Histogram:
+        """The Histogram with the given bin edges of all points added so far."""
+        histogram = Histogram(bin_edges)
+        nbins = len(histogram)
+        if nbins == 0:
+            return histogram
+        indices = np.digitize(self.values, bins=histogram.bin_edges, right=True) - 1
+        m = (indices >= 0) & (indices < nbins)
+        indices = indices[m]
+        histogram.counts += np.bincount(
+            indices, weights=self.counts[m], minlength=nbins
+        ).astype(np.int64)
+        histogram.sums += np.bincount(indices, weights=self.sums[m], minlength=nbins)
+        histogram.sums_sq += np.bincount(
+            indices, weights=self.sums_sq[m], minlength=nbins
+        )
+        return histogram
+
+
+class SparseHistogram:
+    """
+    N-dimensional counterpart of BaseHistogram for scans of several parameters:
+    count, sum and sum of squares of y for each distinct point of the N scan
+    values visited, so that only the visited points are stored. image() bins
+    them onto a dense grid in O(points visited).
+
+    If more than max_points distinct points are visited, each axis is merged
+    onto a grid so that at most about max_points / 2 points remain.
+    """
+
+    def __init__(self, ndim: int, max_points: int = 10_000):
+        self.ndim = ndim
+        self.max_points = max_points
+        self.points = np.empty((0, ndim))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0)
+        self.sums_sq = np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def update(self, x: npt.NDArray[np.float_], y: npt.NDArray[np.float_]):
+        """Add the points x (one row of N scan values per y); NaNs are ignored."""
+        x = np.asarray(x, dtype=float).reshape(-1, self.ndim)
+        y = np.asarray(y, dtype=float).ravel()
+        m = np.all(np.isfinite(x), axis=1) & np.isfinite(y)
+        self.merge(
+            np.concatenate((self.points, x[m])),
+            np.concatenate((self.counts, np.ones(m.sum(), dtype=np.int64))),
+            np.concatenate((self.sums, y[m])),
+            np.concatenate((self.sums_sq, y[m] ** 2)),
+        )
+        if len(self) > self.max_points:
+            npoints = max(int((self.max_points / 2) ** (1 / self.ndim)), 2)
+            points = self.points.copy()
+            for axis in range(self.ndim):
+                lo, hi = points[:, axis].min(), points[:, axis].max()
+                if hi > lo:
+                    step = (hi - lo) / (npoints - 1)
+                    points[:, axis] = lo + np.rint((points[:, axis] - lo) / step) * step
+            self.merge(points, self.counts, self.sums, self.sums_sq)
+
+    def merge(
+        self,
+        points: npt.NDArray[np.float_],
+        counts: npt.NDArray[np.int_],
+        sums: npt.NDArray[np.float_],
+        sums_sq: npt.NDArray[np.float_],
+    ):
+        """Set the statistics from entries with possibly repeated points."""
+        self.points, indices = np.unique(points, axis=0, return_inverse=True)
+        indices = indices.ravel()
+        n = len(self.points)
+        self.counts = np.bincount(indices, weights=counts, minlength=n).astype(np.int64)
+        self.sums = np.bincount(indices, weights=sums, minlength=n)
+        self.sums_sq = np.bincount(indices, weights=sums_sq, minlength=n)
+
+    def image(
+        self, bin_edges: Sequence[npt.NDArray[np.float_]]
+    ) -> Tuple[npt.NDArray[np.int_], npt.NDArray[np.float_], npt.NDArray[np.float_]]:
+        """
+        Count, sum and sum of squares of y in the bins with the given edges along
+        each axis, as dense arrays of shape (bins along axis 0, axis 1, ...).
+        """
+        shape = tuple(max(len(edges) - 1, 0) for edges in bin_edges)
+        size = int(np.prod(shape))
+        if size == 0:
+            return np.zeros(shape, dtype=np.int64), np.zeros(shape), np.zeros(shape)
+        indices = []
+        m = np.ones(len(self), dtype=bool)
+        for axis, edges in enumerate(bin_edges):
+            idx = np.digitize(self.points[:, axis], bins=edges, right=True) - 1
+            m &= (idx >= 0) & (idx < shape[axis])
+            indices.append(idx)
+        flat = np.ravel_multi_index(tuple(idx[m] for idx in indices), shape)
+        counts = np.bincount(flat, weights=self.counts[m], minlength=size)
+        sums = np.bincount(flat, weights=self.sums[m], minlength=size)
+        sums_sq = np.bincount(flat, weights=self.sums_sq[m], minlength=size)
+        return (
+            counts.astype(np.int64).reshape(shape),
+            sums.reshape(shape),
+            sums_sq.reshape(shape),
+        )
+
+
+def create_bins(
+    scan_values: Union[npt.NDArray[np.float_], npt.NDArray[np.int_]], maxsize: int = 100
+) -> Tuple[npt.NDArray[np.float_], npt.NDArray[np.float_]]:
+    bin_centers = np.unique(scan_values)
+    if len(bin_centers) == 1:
+        bins = np.array([bin_centers[0] * 0.9, bin_centers[0] * 1.1])
+    elif len(bin_centers) > maxsize:
+        bin_centers = np.linspace(bin_centers.min(), bin_centers.max(), maxsize)
+        bins = bin_centers.copy()
+        bin_width = bins[1] - bins[0]
+        bins -= bin_width / 2
+        bins = np.append(bins, bins.max() + bin_width / 2)
+
+    else:
+        bin_diffs = np.diff(bin_centers)
+        bins = np.append(
+            [bin_centers[0] - bin_diffs[0] / 2], bin_centers[1:] - bin_diffs / 2
+        )
+        bins = np.append(bins, [bin_centers[-1] + bin_diffs[-1] / 2])
+    return bin_centers, bins
+
+
+def check_bins_update(
+    x: Union[npt.NDArray[np.float_], npt.NDArray[np.int_]],
+    binned_data: Histogram,
+    nbins_max: int,
+) -> bool:
+    if len(binned_data) == 0:
+        return True
+    elif (x.min() < np.min(binned_data.bin_edges)) or (
+        x.max() > np.max(binned_data.bin_edges)
+    ):
+        return True
+    elif not np.all(np.isin(x, binned_data.bin_centers)) and (
+        len(binned_data) < nbins_max
+    ):
+        return True
+    else:
+        return False
+
+
+def process_traces(
+    expression: Expression,
+    traces: List[npt.NDArray],
+    rows: Optional[Dict[str, List[npt.NDArray]]] = None,
+) -> npt.NDArray[np.float_]:
+    """
+    Evaluate a processing expression of y for each trace. The traces (and the
+    traces in rows, e.g. y_norm) are stacked into 2-D arrays and evaluated in
+    one NumPy call if the expression supports it, otherwise (or if the traces
+    differ in length) trace by trace.
+    """
+    rows = {} if rows is None else rows
+    try:
+        block = np.array(traces, dtype=float)
+        block_rows = {k: np.array(v, dtype=float) for k, v in rows.items()}
+    except ValueError:
+        return expression.evaluate_each(traces, rows)
+    if block.ndim != 2 or any(v.ndim != 2 for v in block_rows.values()):
+        return expression.evaluate_each(traces, rows)
+    return expression.evaluate_batch(block, block_rows)
+
+
+class TraceFetcher:
+    """
+    Fetches the traces of a fast device pushed since the previous fetch from the
+    snapshot caches of the devices, with the values of the scan parameters
+    (columns of slow devices) at each trace: every trace is matched to the last
+    row of each scan device taken at or before it, by an AsofMatcher per scan
+    device, and all records of a trace are matched to the same row.
+
+    Shared by the histogram plotters, which also evaluate their processing
+    expressions with process().
+    """
+
+    def __init__(self, parent, name: str):
+        self.parent = parent
+        # name of the plotter, for logging
+        self.name = name
+        self.tolerance = np.inf
+
+        # sequence number of the last trace of the fast device fetched
+        self.seq_last_fetched: Optional[int] = None
+
+        # the processing expressions by name, compiled when first used after a
+        # change
+        self.expressions: Dict[str, Expression] = {}
+
+        self.reset()
+
+    def reset(self):
+        """Forget the rows of the scan devices, e.g. when a scan parameter changed."""
+        self.matchers: Dict[str, AsofMatcher] = {}
+        self.seqs_last_fetched: Dict[str, Optional[int]] = {}
+
+    def set_tolerance(self, tolerance: float):
+        """Maximum time [s] between a trace and the scan device rows matched to it."""
+        self.tolerance = float(tolerance)
+        for matcher in self.matchers.values():
+            matcher.tolerance = self.tolerance
+
+    def column_index(self, device: str, param: str) -> int:
+        column_names = self.parent.devices[device].config["attributes"]["column_names"]
+        return split(column_names).index(param)
+
+    def fetch(
+        self, device: str, params: Sequence[str], scan: Sequence[Tuple[str, str]]
+    ) -> Tuple[List[List[npt.NDArray]], npt.NDArray[np.float_]]:
+        """
+        Fetch the new traces of the params (channels) of the fast device and the
+        (device, column) scan parameters. Returns the traces of each param, one
+        per record, and the scan values matched to each record, one row per
+        record; traces that no row of a scan device matched are skipped.
+        """
+        no_data = [[] for _ in params], np.empty((0, len(scan)))
+        try:
+            cache1 = self.parent.devices[device].snapshot_cache
+            caches2 = {dev: self.parent.devices[dev].snapshot_cache for dev, _ in scan}
+        except KeyError as err:
+            logging.warning(f"{self.name}: device {err} not found")
+            return no_data
+
+        # add the rows of the scan devices pushed since the last fetch to the
+        # matchers
+        for dev, cache2 in caches2.items():
+            if dev not in self.matchers:
+                self.matchers[dev] = AsofMatcher(self.tolerance)
+                self.seqs_last_fetched[dev] = None
+            seqs2, timestamps2, rows2 = cache2.arrays_since(self.seqs_last_fetched[dev])
+            if rows2 is not None and len(seqs2) > 0:
+                self.seqs_last_fetched[dev] = seqs2[-1]
+                self.matchers[dev].add(timestamps2, rows2)
+            if len(self.matchers[dev]) == 0:
+                return no_data
+
+        # match the traces of the fast device pushed since the last fetch
+        new1 = cache1.since(self.seq_last_fetched)
+        if len(new1) == 0:
+            return no_data
+        self.seq_last_fetched = new1[-1][0]
+        timestamps1 = np.asarray([d[-1][0]["timestamp"] for _, d in new1])
+
+        try:
+            indices1 = [self.column_index(device, param) for param in params]
+            x = np.full((len(new1), len(scan)), np.nan)
+            matched = np.ones(len(new1), dtype=bool)
+            for axis, (dev, param) in enumerate(scan):
+                m, rows2 = self.matchers[dev].match(timestamps1)
+                matched &= m
+                if m.any():
+                    x[m, axis] = rows2[:, self.column_index(dev, param)]
+        except ValueError as err:
+            logging.error(f"Error in {self.name}: param not found: {err}")
+            return no_data
+
+        traces: List[List[npt.NDArray]] = [[] for _ in params]
+        points = []
+        for i in np.flatnonzero(matched):
+            # the data of a trace is a list with at 0 the array of records and at
+            # 1 their attributes; every record is binned by the same scan values
+            records = new1[i][1][0]
+            for traces_param, idx in zip(traces, indices1):
+                traces_param.extend(records[:, idx])
+            points.extend([x[i]] * len(records))
+        return traces, np.array(points).reshape(-1, len(scan))
+
+    def process(
+        self,
+        name: str,
+        processing: str,
+        traces: List[npt.NDArray],
+        rows: Optional[Dict[str, List[npt.NDArray]]] = None,
+    ) -> npt.NDArray[np.float_]:
+        """
+        Evaluate the processing expression of y called name (e.g. "processing")
+        for the traces with process_traces(), compiling it when it changed.
+        """
+        expression = self.expressions.get(name)
+        if expression is None or expression.source != processing:
+            expression = self.expressions[name] = Expression(processing)
+        return process_traces(expression, traces, rows)
@@ -0,0 +1,285 @@
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional
+
+import numpy as np
+
+
+def escape(string: str, characters: str = ", =") -> str:
+    string = str(string).replace("\\", "\\\\")
+    for character in characters:
+        string = string.replace(character, "\\" + character)
+    return escape_newlines(string)
+
+
+def escape_newlines(string: str) -> str:
+    # a point is a single line, also in the spool file
+    return string.replace("\n", "\\n").replace("\r", "\\r")
+
+
+def format_field(value: Any) -> Optional[str]:
+    """The value of a field in line protocol, None for NaN and inf."""
+    if isinstance(value, (bool, np.bool_)):
+        return "true" if value else "false"
+    if isinstance(value, (int, np.integer)):
+        return f"{int(value)}i"
+    if isinstance(value, (float, np.floating)):
+        if not math.isfinite(value):
+            return None
+        return repr(float(value))
+    if isinstance(value, bytes):
+        value = value.decode(errors="replace")
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return '"' + escape_newlines(value) + '"'
+
+
+def format_line(
+    measurement: str, tags: Dict[str, Any], fields: Dict[str, Any], timestamp: float
+) -> Optional[str]:
+    """
+    A point in InfluxDB line protocol, with the timestamp (unix time [s]) in ns;
+    None if no field has a value that can be written.
+    """
+    field_set = []
+    for key, value in fields.items():
+        value = format_field(value)
+        if value is not None:
+            field_set.append(f"{escape(key)}={value}")
+    if len(field_set) == 0:
+        return None
+    tag_set = "".join(
+        f",{escape(key)}={escape(value)}"
+        for key, value in sorted(tags.items())
+        if value is not None and str(value) != ""
+    )
+    return (
+        f"{escape(measurement, ', ')}{tag_set} {','.join(field_set)}"
+        f" {int(round(timestamp * 1e9))}"
+    )
+
+
+class InfluxDBWriter(threading.Thread):
+    """
+    Writes points to InfluxDB in a separate thread, so that a slow or unreachable
+    server does not hold up monitoring. Points are formatted in line protocol
+    when added with write(), and sent in batches of up to batch_size lines, at
+    the latest flush_interval seconds after the previous batch.
+
+    Batches that cannot be sent are appended to the spool file, and sending is
+    retried after an interval doubling on each failure up to max_retry_interval;
+    meanwhile new batches go to the spool file too. Once the server accepts
+    writes again, the spool file is replayed before any new batch, including
+    the spool file left by a previous run. The spool file keeps at most
+    max_spool_lines points: beyond that, the oldest points are dropped down to
+    90% of max_spool_lines, so that the file is not rewritten on every flush.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        org: str,
+        bucket: str,
+        token: str,
+        batch_size: int = 5000,
+        flush_interval: float = 1.0,
+        spool_fname: str = "influxdb_spool.txt",
+        timeout: float = 10.0,
+        max_retry_interval: float = 60.0,
+        max_spool_lines: int = 1_000_000,
+    ):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.active = threading.Event()
+
+        if "://" not in url:
+            url = "http://" + url
+        query = urllib.parse.urlencode(
+            {"org": org, "bucket": bucket, "precision": "ns"}
+        )
+        self.write_url = f"{url.rstrip('/')}/api/v2/write?{query}"
+        self.token = token
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_file = Path(spool_fname)
+        self.timeout = timeout
+        self.max_retry_interval = max_retry_interval
+        self.max_spool_lines = max_spool_lines
+
+        # number of lines in the spool file, counted once when first spooling
+        self.spool_lines: Optional[int] = None
+
+        # lines waiting to be sent, appended by the monitoring thread
+        self.lines: Deque[str] = deque()
+
+        # time of the next attempt to send while the server is unavailable, and
+        # the interval before the attempt after that
+        self.time_retry = 0.0
+        self.retry_interval = 1.0
+
+    def write(
+        self,
+        measurement: str,
+        tags: Dict[str, Any],
+        fields: Dict[str, Any],
+        timestamp: float,
+    ):
+        """Queue a point for writing, with the timestamp as unix time [s]."""
+        line = format_line(measurement, tags, fields, timestamp)
+        if line is not None:
+            self.lines.append(line)
+
+    def run(self):
+        self.active.set()
+        time_last_flush = time.time()
+        while self.active.is_set():
+            if (
+                len(self.lines) < self.batch_size
+                and time.time() - time_last_flush < self.flush_interval
+            ):
+                time.sleep(0.05)
+                continue
+            time_last_flush = time.time()
+            self.flush()
+
+        # send or spool what is left when stopping
+        while self.lines:
+            self.flush()
+        logging.info("InfluxDBWriter: stopped")
+
+    def flush(self):
+        batch = self.next_batch()
+        if time.time() < self.time_retry:
+            self.spool(batch)
+            return
+
+        # the lines spooled while the server was unavailable are sent first
+        if self.spool_file.exists() and not self.replay():
+            self.spool(batch)
+            return
+        if batch and not self.send(batch):
+            self.spool(batch)
+
+    def next_batch(self) -> List[str]:
+        batch = []
+        while self.lines and len(batch) < self.batch_size:
+            batch.append(self.lines.popleft())
+        return batch
+
+    def send(self, lines: List[str]) -> bool:
+        """
+        Post the lines to InfluxDB; returns False if they should be sent again
+        later.
+        """
+        request = urllib.request.Request(
+            self.write_url,
+            data="\n".join(lines).encode(),
+            headers={
+                "Authorization": f"Token {self.token}",
+                "Content-Type": "text/plain; charset=utf-8",
+            },
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+        except urllib.error.HTTPError as err:
+            # the server rejected the data itself, sending it again won't help
+            if 400 <= err.code < 500 and err.code != 429:
+                body = err.read().decode(errors="replace")
+                logging.error(
+                    f"InfluxDBWriter: dropped {len(lines)} points: {err.code} {body}"
+                )
+                self.retry_interval = 1.0
+                return True
+            self.retry_later(err)
+            return False
+        except (urllib.error.URLError, OSError) as err:
+            self.retry_later(err)
+            return False
+        self.time_retry = 0.0
+        self.retry_interval = 1.0
+        return True
+
+    def retry_later(self, err: Exception):
+        logging.warning(
+            f"InfluxDBWriter: cannot write to InfluxDB ({err}), spooling to"
+            f" {self.spool_file} and retrying in {self.retry_interval:.0f} s"
+        )
+        self.time_retry = time.time() + self.retry_interval
+        self.retry_interval = min(2 * self.retry_interval, self.max_retry_interval)
+
+    def spool(self, lines: List[str]):
+        if not lines:
+            return
+        if self.spool_lines is None:
+            self.spool_lines = self.count_spooled()
+        with open(self.spool_file, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        self.spool_lines += len(lines)
+
+        # drop the oldest points so that the spool file does not fill the disk
+        # while the server is unavailable for long
+        if self.spool_lines > self.max_spool_lines:
+            excess = self.spool_lines - int(0.9 * self.max_spool_lines)
+            self.drop_spooled(excess)
+            self.spool_lines -= excess
+            logging.warning(
+                f"InfluxDBWriter: dropped the {excess} oldest spooled points,"
+                f" {self.spool_file} is limited to {self.max_spool_lines} points"
+            )
+
+    def count_spooled(self) -> int:
+        if not self.spool_file.exists():
+            return 0
+        with open(self.spool_file, encoding="utf-8") as f:
+            return sum(1 for line in f if line.strip())
+
+    def drop_spooled(self, n_lines: int):
+        """Remove the first lines of the spool file, copying the rest line by line."""
+        tmp_file = self.spool_file.with_name(self.spool_file.name + ".tmp")
+        with open(self.spool_file, encoding="utf-8") as f_in, open(
+            tmp_file, "w", encoding="utf-8"
+        ) as f_out:
+            f_out.writelines(itertools.islice(f_in, n_lines, None))
+        os.replace(tmp_file, self.spool_file)
+
+    def replay(self) -> bool:
+        """
+        Send the spooled lines in batches, read from the spool file one batch at
+        a time; returns False if some could not be sent, which stay in the
+        spool file.
+        """
+        sent, n_read = 0, 0
+        failed = False
+        with open(self.spool_file, encoding="utf-8") as f:
+            while True:
+                chunk = list(itertools.islice(f, self.batch_size))
+                if not chunk:
+                    break
+                batch = [line.rstrip("\n") for line in chunk if line.strip()]
+                if batch and not self.send(batch):
+                    failed = True
+                    break
+                sent += len(batch)
+                n_read += len(chunk)
+        if failed:
+            # keep the batch that failed and the lines after it
+            if n_read > 0:
+                self.drop_spooled(n_read)
+                self.spool_lines = None
+            return False
+        self.spool_file.unlink()
+        self.spool_lines = 0
+        if sent:
+            logging.info(f"InfluxDBWriter: replayed {sent} spooled points")
+        return True
@@ -1,4 +1,3 @@
-import datetime
 import logging
 import threading
 import time
@@ -9,13 +8,10 @@ from typing import Any, Dict, List, Tuple
 import numpy as np
 import PyQt5
 import PyQt5.QtWidgets as qt
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
-from influxdb_client.domain.write_precision import WritePrecision
-
 from config import DeviceConfig
 from device import Device as DeviceProtocol
 from device import restart_device
+from influxdb_writer import InfluxDBWriter
 from protocols import CentrexGUIProtocol
 
 
@@ -34,16 +30,25 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
 
         self.time_last_monitored = 0.0
 
-        # connect to InfluxDB
+        # sequence number of the last sample displayed, per device
+        self.last_seq_displayed: Dict[str, int] = {}
+
+        # write to InfluxDB in batches from a separate thread
         conf = self.parent.config["influxdb"]
-        self.influxdb_client = InfluxDBClient(
-            url=f"{conf['host']}:{conf['port']}", token=conf["token"], org=conf["org"]
+        self.influxdb_writer = InfluxDBWriter(
+            url=f"{conf['host']}:{conf['port']}",
+            org=conf["org"],
+            bucket=conf["bucket"],
+            token=conf["token"],
+            batch_size=int(conf.get("batch_size", 5000)),
+            flush_interval=float(conf.get("flush_interval", 1.0)),
+            spool_fname=conf.get("spool_fname", "influxdb_spool.txt"),
+            max_retry_interval=float(conf.get("max_retry_interval", 60.0)),
+            max_spool_lines=int(conf.get("max_spool_lines", 1_000_000)),
         )
-        self.influxdb_org: str = conf["org"]
-        self.influxdb_bucket: str = conf["bucket"]
-        self.write_api = self.influxdb_client.write_api(write_options=SYNCHRONOUS)
 
     def run(self):
+        self.influxdb_writer.start()
         while self.active.is_set():
             # check amount of remaining free disk space
             self.parent.ControlGUI.check_free_disk_space()
@@ -54,7 +59,8 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
             if self.parent.ControlGUI.HDF_writer.active.is_set():
                 time_last_write = self.parent.ControlGUI.HDF_writer.time_last_write
                 hdf_time = time.mktime(time_last_write.timetuple())
-                status = time_last_write.isoformat()
+                lag = self.parent.ControlGUI.HDF_writer.writer_lag
+                status = time_last_write.isoformat() + f" (lag {lag:.2f} s)"
             else:
                 hdf_time = 0
                 status = "disabled"
@@ -139,16 +145,16 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
                 # this crashes the GUI, not sure why yet, happens for random devices
                 self.display_monitoring_events(dev)
 
-                # get the last row of data from the plots_queue
-                if len(dev.config["plots_queue"]) > 0:
-                    data = dev.config["plots_queue"][-1]
-                else:
-                    data = None
+                # get the last row of data from the snapshot cache
+                latest = dev.snapshot_cache.latest()
+                seq, data = latest if latest is not None else (None, None)
 
-                # format the data
+                # format the data, unless it is already displayed
                 if isinstance(data, list):
                     try:
-                        if dev.config["slow_data"]:
+                        if self.last_seq_displayed.get(dev_name) == seq:
+                            formatted_data = None
+                        elif dev.config["slow_data"]:
                             formatted_data = [
                                 np.format_float_scientific(x, precision=3)
                                 if not isinstance(x, str)
@@ -164,9 +170,11 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
                         logging.warning("Warning in Monitoring: " + str(err))
                         logging.warning(traceback.format_exc())
                         continue
-                    dev.config["monitoring_GUI_elements"]["data"].setText(
-                        "\n".join(formatted_data)
-                    )
+                    if formatted_data is not None:
+                        dev.config["monitoring_GUI_elements"]["data"].setText(
+                            "\n".join(formatted_data)
+                        )
+                        self.last_seq_displayed[dev_name] = seq
 
                     # write slow data to InfluxDB
                     if time.time() - self.time_last_monitored >= dt:
@@ -174,8 +182,7 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
 
                 # if writing to HDF is disabled, empty the queues
                 if not bool(int(dev.config["control_params"]["HDF_enabled"]["value"])):
-                    dev.events_queue.clear()
-                    dev.data_queue.clear()
+                    dev.clear_queues()
 
             # reset the timer for setting the slow monitoring loop delay
             if time.time() - self.time_last_monitored >= dt:
@@ -183,6 +190,9 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
 
             # fixed monitoring fast loop delay
             time.sleep(0.5)
+
+        self.influxdb_writer.active.clear()
+        self.influxdb_writer.join()
         logging.info("Monitoring: stopped")
 
     def write_to_influxdb(self, dev: DeviceProtocol, data):
@@ -260,23 +270,13 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
                     logging.warning(f"Error in write_to_influxdb: {str(e2)}")
             return
 
-        # format the message for InfluxDB
-        p = (
-            Point(dev.config["driver"])
-            .tag("run_name", self.parent.run_name)
-            .tag("name", dev.config["name"])
-        )
-        p = p.time(
-            time=datetime.datetime.utcfromtimestamp(
-                data[0] + self.parent.config["time_offset"]
-            ).isoformat()
-        )
-        for k, v in fields.items():
-            p = p.field(k, v)
-        # push to InfluxDB
+        # queue the point for the InfluxDB writer
         try:
-            self.write_api.write(
-                bucket=self.influxdb_bucket, record=p, org=self.influxdb_org
+            self.influxdb_writer.write(
+                dev.config["driver"],
+                {"run_name": self.parent.run_name, "name": dev.config["name"]},
+                fields,
+                data[0] + self.parent.config["time_offset"],
             )
         except Exception as err:
             logging.warning(f"Error in write_to_influxdb: {err}")
@@ -379,18 +379,13 @@ class Monitoring(threading.Thread, PyQt5.QtCore.QObject):
     def push_warnings_to_influxdb(
         self, dev_config: DeviceConfig, warning: Tuple[float, Dict[str, str]]
     ):
-        json_body = [
+        self.influxdb_writer.write(
+            "warnings",
             {
-                "measurement": "warnings",
-                "tags": {
-                    "run_name": self.parent.run_name,
-                    "name": dev_config["name"],
-                    "driver": dev_config["driver"],
-                },
-                "time": int(1000 * warning[0]),
-                "fields": warning[1],
-            }
-        ]
-        self.write_api.write(
-            self.influxdb_bucket, json_body, write_precision=WritePrecision.MS
+                "run_name": self.parent.run_name,
+                "name": dev_config["name"],
+                "driver": dev_config["driver"],
+            },
+            warning[1],
+            warning[0],
         )
@@ -1,30 +1,65 @@
+import inspect
+import itertools
 import json
 import logging
+import queue
 import threading
 import time
 import uuid
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+import numpy.typing as npt
 import zmq
 import zmq.auth
 from zmq.auth.thread import ThreadAuthenticator
-from zmq.devices import Device
 
+from device import Device as DeviceThread
+from networking_connections import shared_context
+from networking_messages import (
+    decimate_rows,
+    encode_aggregate,
+    encode_history,
+    encode_sample,
+    json_default,
+)
 from protocols import CentrexGUIProtocol
+from storage import read_slow_rows
+
+# unique keys for the return values of commands in the networking_events_queue
+# of the devices, shared by all workers
+command_keys = itertools.count()
 
 
 class NetworkingDeviceWorker(threading.Thread):
-    def __init__(self, parent: CentrexGUIProtocol, backend_port: int):
+    def __init__(
+        self,
+        parent: CentrexGUIProtocol,
+        backend_address: str,
+        timeout: float = 10.0,
+        run_id: Optional[str] = None,
+    ):
         super(NetworkingDeviceWorker, self).__init__()
         self.active = threading.Event()
         self.daemon = True
         self.parent = parent
-        self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
-        self.socket.connect(f"tcp://localhost:{backend_port}")
+        self.socket = shared_context().socket(zmq.REP)
+        self.socket.connect(backend_address)
+
+        # default time [s] to wait for the devices to execute the commands of a
+        # request
+        self.timeout = timeout
+
+        # id of the networking server run, sent with the replies so clients can
+        # tell when the metadata they cached is stale
+        self.run_id = run_id
 
-        # each worker has an unique id for the return value queue
+        # keys of commands that timed out, with their device, to drop the return
+        # value if the device executes them after all
+        self.abandoned: Dict[int, DeviceThread] = {}
+
+        # each worker has an unique id for logging
         self.uid = uuid.uuid1().int >> 64
 
         logging.info(f"NetworkingDeviceWorker: initialized worker {self.uid}")
@@ -36,108 +71,498 @@ class NetworkingDeviceWorker(threading.Thread):
             # receive the request from a client, have a timeout so the thread can be
             # closed
             if self.socket.poll(200, zmq.POLLIN):
-                device, command = self.socket.recv_json()
+                request = self.socket.recv_json()
             else:
                 continue
-            logging.info(f"{self.uid} : {device} {command}")
 
-            # strip both to prevent whitespace errors during eval on device
-            device.strip()
-            command.strip()
-            # check if device present
-            if device not in self.parent.devices:
-                self.socket.send_json(["ERROR", "device not present"])
+            # a history request gets a json header followed by the rows in
+            # binary chunks
+            if isinstance(request, dict) and "history" in request:
+                self.socket.send_multipart(self.history(request), copy=False)
                 continue
-            dev = self.parent.devices[device]
-            # check if device control is started
-            if not dev.control_started:
-                self.socket.send_json(["ERROR", "device not started"])
+
+            if isinstance(request, dict) and "metadata" in request:
+                self.send_reply(request, self.metadata(request))
                 continue
-            # check if device is enabled
-            elif not dev.config["control_params"]["enabled"]["value"] == 2:
-                self.socket.send_json(["ERROR", "device not enabled"])
+
+            # a request from a DEALER client is a dict with the request id, a
+            # list of [device, command] pairs and optionally a timeout in
+            # seconds, and gets the request id and a [status, return value] pair
+            # per command; the reply always carries the request id, so the
+            # client can match it even if the request was invalid
+            if isinstance(request, dict):
+                reply = {"id": request.get("id"), "run_id": self.run_id}
+                try:
+                    timeout = request.get("timeout")
+                    results = self.execute(
+                        request["commands"],
+                        self.timeout if timeout is None else float(timeout),
+                    )
+                    reply["results"] = [self.serializable(r) for r in results]
+                except Exception as err:
+                    logging.warning(f"NetworkingDeviceWorker: invalid request: {err}")
+                    reply.update(status="ERROR", message=f"invalid request: {err}")
+                self.send_reply(request, reply)
                 continue
-            # check if device is slow data
-            # ndarrays are not serializable by default, and fast devices return
-            # ndarrays on ReadValue()
-            elif not dev.config["slow_data"] and command == "ReadValue()":
-                self.socket.send_json(["ERROR", "device does not support slow data"])
-            else:
-                # put command into the networking queue
-                dev.networking_commands.append((self.uid, command))
-                while True:
-                    # check if uid is present in return val dictionary and pop
-                    # if present
-                    if self.uid in dev.networking_events_queue:
-                        ret_val = dev.networking_events_queue.pop(self.uid)
-                        # serialize with json and send back to client
-                        self.socket.send_json(["OK", ret_val])
-                        break
-            # need a sleep to release to other threads
-            time.sleep(1e-4)
+
+            # a request from a REQ client is a single [device, command] pair and
+            # gets a single [status, return value] reply
+            try:
+                reply = self.execute([request], self.timeout)[0]
+            except Exception as err:
+                logging.warning(f"NetworkingDeviceWorker: invalid request: {err}")
+                reply = ["ERROR", f"invalid request: {err}"]
+
+            # serialize with json and send back to client
+            try:
+                self.socket.send_string(json.dumps(reply, default=json_default))
+            except (TypeError, ValueError) as err:
+                self.socket.send_json(["ERROR", f"cannot serialize reply: {err}"])
         logging.info(f"NetworkingDeviceWorker: stopped worker {self.uid}")
         self.socket.setsockopt(zmq.LINGER, 0)
         self.socket.close()
-        self.context.term()
+
+    def serializable(self, result: list) -> list:
+        """The [status, return value] pair, or an error if it cannot be sent."""
+        try:
+            json.dumps(result, default=json_default)
+        except (TypeError, ValueError) as err:
+            return ["ERROR", f"cannot serialize return value: {err}"]
+        return result
+
+    def send_reply(self, request: dict, reply: dict):
+        try:
+            self.socket.send_string(json.dumps(reply, default=json_default))
+        except (TypeError, ValueError) as err:
+            reply = {
+                "id": request.get("id"),
+                "run_id": self.run_id,
+                "status": "ERROR",
+                "message": f"cannot serialize reply: {err}",
+            }
+            self.socket.send_string(json.dumps(reply))
+
+    def check_command(self, device: str, command: str) -> Optional[str]:
+        """Return the error message if the command cannot be sent to the device."""
+        # check if device present
+        if device not in self.parent.devices:
+            return "device not present"
+        dev = self.parent.devices[device]
+        # check if device control is started
+        if not dev.control_started:
+            return "device not started"
+        # check if device is enabled
+        elif not dev.config["control_params"]["enabled"]["value"] == 2:
+            return "device not enabled"
+        # check if device is slow data
+        # ndarrays are not serializable by default, and fast devices return
+        # ndarrays on ReadValue(); their data is published on the readout
+        # port instead
+        elif not dev.config["slow_data"] and command == "ReadValue()":
+            return "device does not support slow data"
+        return None
+
+    def execute(self, commands: List[List[str]], timeout: float) -> List[list]:
+        """
+        Put all commands into the networking queues of their devices at once and
+        wait up to timeout seconds for the return values, so that a device
+        executes all commands for it in a single iteration of its loop.
+        """
+        self.drop_abandoned()
+
+        results: List[list] = [["ERROR", "timeout"]] * len(commands)
+        pending: Dict[int, Tuple[int, DeviceThread, str]] = {}
+        for idx, (device, command) in enumerate(commands):
+            # strip both to prevent whitespace errors during eval on device
+            device = device.strip()
+            command = command.strip()
+            logging.info(f"{self.uid} : {device} {command}")
+            error = self.check_command(device, command)
+            if error:
+                results[idx] = ["ERROR", error]
+                continue
+            # put command into the networking queue
+            dev = self.parent.devices[device]
+            key = next(command_keys)
+            pending[key] = (idx, dev, command)
+            dev.networking_commands.append((key, command))
+
+        deadline = time.time() + timeout
+        while pending and self.active.is_set():
+            # check if the key is present in the return value dictionary and
+            # pop if present
+            for key, (idx, dev, _) in list(pending.items()):
+                if key in dev.networking_events_queue:
+                    results[idx] = ["OK", dev.networking_events_queue.pop(key)]
+                    del pending[key]
+            if not pending or time.time() > deadline:
+                break
+            # need a sleep to release to other threads
+            time.sleep(1e-4)
+
+        # withdraw the commands that were not executed in time
+        for key, (idx, dev, command) in pending.items():
+            try:
+                dev.networking_commands.remove((key, command))
+            except ValueError:
+                self.abandoned[key] = dev
+        return results
+
+    def metadata(self, request: dict) -> dict:
+        """
+        Reply to a metadata request, a dict with the request id and under
+        "metadata" the device name and the run id of the metadata the client
+        holds, if any. Unless that run id is the current one, the reply holds the
+        verification string, dtype and shape of the device driver, the device
+        attributes and column names, and the signature of each driver method.
+        """
+        reply = {"id": request.get("id"), "run_id": self.run_id, "status": "OK"}
+        try:
+            query = request["metadata"]
+            device = query["device"].strip()
+            if self.run_id is not None and query.get("run_id") == self.run_id:
+                reply["unchanged"] = True
+                return reply
+
+            # the driver attributes are read by the device, in a single iteration
+            # of its loop
+            results = self.execute(
+                [[device, "verification_string"], [device, "dtype"], [device, "shape"]],
+                self.timeout,
+            )
+            for status, value in results:
+                if status != "OK":
+                    raise ValueError(value)
+            (_, verification_string), (_, dtype), (_, shape) = results
+
+            dev = self.parent.devices[device]
+            methods = inspect.getmembers(
+                dev.config["driver_class"], predicate=inspect.isfunction
+            )
+            reply["metadata"] = {
+                "verification_string": verification_string,
+                "dtype": dtype,
+                "shape": shape,
+                "attributes": dict(dev.config["attributes"]),
+                "column_names": [
+                    col.strip()
+                    for col in dev.config["attributes"]
+                    .get("column_names", "")
+                    .split(",")
+                ],
+                "methods": {
+                    name: str(inspect.signature(method)) for name, method in methods
+                },
+            }
+        except Exception as err:
+            logging.warning(f"NetworkingDeviceWorker: metadata request failed: {err}")
+            reply.update(status="ERROR", message=str(err))
+        return reply
+
+    def history(self, request: dict) -> list:
+        """
+        Reply to a history request, a dict with the request id and under
+        "history" the query:
+
+            device      name of a slow device
+            start, stop time range (absolute) of the rows to return
+            last        return only the last `last` rows of the range
+            max_rows    decimate the rows to at most max_rows
+            method      decimation method, "mean" (default) or "stride"
+            source      "memory" for the rows held by the device, "storage" for
+                        the rows recorded in the current run, or "auto"
+                        (default) for memory if it holds the whole range
+            chunk_rows  number of rows per binary chunk
+
+        The rows are returned as floats, with absolute times in the first
+        column, by encode_history().
+        """
+        header = {"id": request.get("id"), "status": "OK"}
+        try:
+            query = request["history"]
+            device = query["device"].strip()
+            if device not in self.parent.devices:
+                raise ValueError("device not present")
+            dev = self.parent.devices[device]
+            if not dev.config["slow_data"]:
+                raise ValueError("history is only available for slow data")
+
+            # times in the query are absolute, times in the rows relative to the
+            # time offset of the run
+            time_offset = self.parent.config["time_offset"]
+            start = query.get("start")
+            stop = query.get("stop")
+            start = -np.inf if start is None else float(start) - time_offset
+            stop = np.inf if stop is None else float(stop) - time_offset
+            last = query.get("last")
+            last = None if last is None else int(last)
+            source = query.get("source", "auto")
+            if source not in ["auto", "memory", "storage"]:
+                raise ValueError(f"unknown source {source}")
+
+            rows, complete = None, False
+            if source in ["auto", "memory"]:
+                seqs, times, rows = dev.snapshot_cache.arrays_since(None)
+                if rows is not None:
+                    i0 = np.searchsorted(times, start, side="left")
+                    i1 = np.searchsorted(times, stop, side="right")
+                    if last is not None:
+                        i0 = max(i0, i1 - last)
+                    # the rows held are complete if the range starts after the
+                    # oldest one, or nothing was dropped yet
+                    complete = (
+                        i0 > 0 or (last is not None and i1 - i0 == last) or seqs[0] == 1
+                    )
+                    rows = rows[i0:i1]
+                if source == "memory" and rows is None:
+                    raise ValueError("no rows in memory")
+            if source == "storage" or (source == "auto" and not complete):
+                try:
+                    rows = self.read_storage(dev, start, stop, last)
+                    source = "storage"
+                except Exception as err:
+                    # fall back to the rows held in memory, if any
+                    if source == "storage" or rows is None:
+                        raise
+                    logging.warning(
+                        f"NetworkingDeviceWorker: reading history from storage"
+                        f" failed, returning the rows in memory: {err}"
+                    )
+            if source != "storage":
+                source = "memory"
+
+            rows = decimate_rows(
+                rows, query.get("max_rows"), query.get("method", "mean")
+            )
+            rows = np.array(rows, dtype=float)
+            if rows.ndim == 2 and rows.shape[1] > 0:
+                rows[:, 0] += time_offset
+            header["source"] = source
+            header["columns"] = [
+                col.strip()
+                for col in dev.config["attributes"]["column_names"].split(",")
+            ]
+            return encode_history(header, rows, int(query.get("chunk_rows", 100_000)))
+        except Exception as err:
+            logging.warning(f"NetworkingDeviceWorker: history request failed: {err}")
+            header.update(status="ERROR", message=str(err))
+            return [json.dumps(header).encode()]
+
+    def read_storage(
+        self, dev: DeviceThread, start: float, stop: float, last: Optional[int]
+    ) -> npt.NDArray:
+        """The slow data rows of the device recorded in the current run, as floats."""
+        run_name = getattr(self.parent, "run_name", None)
+        if run_name is None:
+            raise ValueError("no run recorded")
+        files = self.parent.config["files"]
+        data = read_slow_rows(
+            files.get("storage_backend", "hdf"),
+            files["hdf_fname"],
+            run_name,
+            dev.config["path"],
+            dev.config["name"],
+            start,
+            stop,
+            last,
+        )
+        rows = np.full((len(data), len(data.dtype.names)), np.nan)
+        for idx, name in enumerate(data.dtype.names):
+            try:
+                rows[:, idx] = data[name].astype(float)
+            except (TypeError, ValueError):
+                pass
+        return rows
+
+    def drop_abandoned(self):
+        for key, dev in list(self.abandoned.items()):
+            if key in dev.networking_events_queue:
+                dev.networking_events_queue.pop(key)
+                del self.abandoned[key]
 
 
 class NetworkingBroker(threading.Thread):
-    def __init__(self, outward_port: int, allowed: List[str]):
+    def __init__(
+        self, outward_port: int, allowed: List[str], keys_dir: Optional[str] = None
+    ):
         super(NetworkingBroker, self).__init__()
         self.daemon = True
-        device = Device(zmq.QUEUE, zmq.XREP, zmq.XREQ)
-        device.bind_in(f"tcp://*:{outward_port}")
-        device.daemon = True
+        context = shared_context()
 
         logging.info(f"NetworkingBroker: allowed addresses {allowed}")
 
-        self.backend_port = device.bind_out_to_random_port("tcp://127.0.0.1")
-        self.device = device
-
         # setup authentication
-        self.auth = ThreadAuthenticator()
+        self.auth = ThreadAuthenticator(context)
         self.auth.start()
         self.auth.allow_any = True
         # self.auth.allow(*allowed)
 
-        # load authentication keys
+        # load authentication keys, from ./authentication unless another
+        # directory with the same layout is given
         file_path = Path(__file__).resolve()
+        keys_path = Path(keys_dir) if keys_dir else file_path.parent / "authentication"
         # public_keys_dir = file_path.parent / "authentication" / "public_keys"
         # self.auth.configure_curve(domain = '*', location = str(public_keys_dir))
         self.auth.configure_curve(domain="*", location=zmq.auth.base.CURVE_ALLOW_ANY)
-        server_secret_file = (
-            file_path.parent / "authentication" / "private_keys" / "server.key_secret"
-        )
+        server_secret_file = keys_path / "private_keys" / "server.key_secret"
         server_public, server_secret = zmq.auth.load_certificate(
             str(server_secret_file)
         )
 
-        device.setsockopt_in(zmq.SocketOption.CURVE_SECRETKEY, server_secret)
-        device.setsockopt_in(zmq.SocketOption.CURVE_PUBLICKEY, server_public)
-        device.setsockopt_in(zmq.SocketOption.CURVE_SERVER, True)
+        # the clients connect to the frontend, the workers in this process to
+        # the backend over inproc
+        self.frontend = context.socket(zmq.ROUTER)
+        self.frontend.curve_secretkey = server_secret
+        self.frontend.curve_publickey = server_public
+        self.frontend.curve_server = True
+        self.frontend.bind(f"tcp://*:{outward_port}")
+
+        uid = uuid.uuid4().hex
+        self.backend_address = f"inproc://networking-workers-{uid}"
+        self.backend = context.socket(zmq.DEALER)
+        self.backend.bind(self.backend_address)
+
+        self.active = threading.Event()
 
     def run(self):
         logging.info("NetworkingBroker: started broker")
-        self.device.start()
+        self.active.set()
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        # forward requests to the workers and replies to the clients, with a
+        # timeout so the thread can be closed
+        while self.active.is_set():
+            for socket, _ in poller.poll(200):
+                other = self.backend if socket is self.frontend else self.frontend
+                while socket.poll(0, zmq.POLLIN):
+                    other.send_multipart(socket.recv_multipart(copy=False), copy=False)
+        for socket in [self.frontend, self.backend]:
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.close()
         logging.info("NetworkingBroker: stopped broker")
 
     def __exit__(self, *args):
+        self.active.clear()
         self.auth.stop()
-        for socket in self.device._sockets:
-            socket.setsockopt(zmq.LINGER, 0)
-            socket.close()
-        try:
-            self.device.context_factory().destroy()
-        except OSError as e:
-            if (
-                "An operation was attempted on something that is not a socket"
-                in e.args[0]
-            ):
-                logging.error(f"NetworkingBroker: {e.args[0]}")
-                logging.warning(e)
         return
 
 
+class DerivedTopics:
+    """
+    Streams derived from the samples published at full rate on a topic, computed
+    once on the server for subscribers that do not need every sample:
+
+        latest/<topic>  the latest sample, at most once every conflate_interval
+        minmax/<topic>  the minimum, maximum and mean of each column of the slow
+                        rows pushed in each aggregate_interval
+
+    An interval of 0 disables the stream.
+    """
+
+    def __init__(self, conflate_interval: float = 1.0, aggregate_interval: float = 1.0):
+        self.conflate_interval = conflate_interval
+        self.aggregate_interval = aggregate_interval
+
+        # topic -> [time last sent, (seq, data, time_offset) not yet sent or None]
+        self.latest: Dict[str, list] = {}
+
+        # topic -> [window start, seq of the last row, rows, mins, maxs, sums,
+        # counts]; the window start is absolute, aligned to a multiple of
+        # aggregate_interval
+        self.aggregates: Dict[str, list] = {}
+
+        # (topic, aggregate) of the windows that are complete but not yet sent
+        self.pending: List[Tuple[str, list]] = []
+
+    def add(self, topic: str, seq: int, data: list, time_offset: float) -> None:
+        if self.conflate_interval > 0:
+            state = self.latest.setdefault(topic, [-np.inf, None])
+            state[1] = (seq, data, time_offset)
+
+        if self.aggregate_interval <= 0 or isinstance(data[0], np.ndarray):
+            return
+        try:
+            values = np.asarray(data[1:], dtype=np.float64)
+        except (TypeError, ValueError):
+            return
+        timestamp = time_offset + data[0]
+        start = timestamp - timestamp % self.aggregate_interval
+        aggregate = self.aggregates.get(topic)
+        if aggregate is None or aggregate[3].shape != values.shape:
+            aggregate = self.aggregates[topic] = self.empty_aggregate(start, values)
+        elif start >= aggregate[0] + self.aggregate_interval:
+            # a row of the next window before the current window was sent
+            if aggregate[2] > 0:
+                self.pending.append((topic, aggregate))
+            aggregate = self.aggregates[topic] = self.empty_aggregate(start, values)
+        valid = ~np.isnan(values)
+        aggregate[1] = seq
+        aggregate[2] += 1
+        aggregate[3] = np.fmin(aggregate[3], values)
+        aggregate[4] = np.fmax(aggregate[4], values)
+        aggregate[5] += np.where(valid, values, 0.0)
+        aggregate[6] += valid
+
+    def empty_aggregate(self, start: float, values: npt.NDArray) -> list:
+        return [
+            start,
+            None,
+            0,
+            np.full(values.shape, np.nan),
+            np.full(values.shape, np.nan),
+            np.zeros(values.shape),
+            np.zeros(values.shape, dtype=int),
+        ]
+
+    def due(self, now: float) -> List[list]:
+        """Frames of the derived messages to send at time now."""
+        messages = []
+        for topic, state in self.latest.items():
+            if state[1] is None or now - state[0] < self.conflate_interval:
+                continue
+            seq, data, time_offset = state[1]
+            messages.append(encode_sample(f"latest/{topic}", seq, data, time_offset))
+            state[0], state[1] = now, None
+
+        for topic, aggregate in self.aggregates.items():
+            if aggregate[2] > 0 and now >= aggregate[0] + self.aggregate_interval:
+                self.pending.append((topic, aggregate))
+                self.aggregates[topic] = self.empty_aggregate(
+                    now - now % self.aggregate_interval, aggregate[3]
+                )
+        for topic, aggregate in self.pending:
+            start, seq, rows, mins, maxs, sums, counts = aggregate
+            with np.errstate(invalid="ignore", divide="ignore"):
+                means = np.where(counts > 0, sums / counts, np.nan)
+            messages.append(
+                encode_aggregate(
+                    f"minmax/{topic}",
+                    seq,
+                    start,
+                    start + self.aggregate_interval,
+                    np.stack([mins, maxs, means]),
+                    rows,
+                )
+            )
+        self.pending = []
+        return messages
+
+    def timeout(self, now: float, maximum: float) -> float:
+        """Time until the next derived message is due, at most maximum."""
+        deadlines = [
+            state[0] + self.conflate_interval
+            for state in self.latest.values()
+            if state[1] is not None
+        ]
+        deadlines += [
+            aggregate[0] + self.aggregate_interval
+            for aggregate in self.aggregates.values()
+            if aggregate[2] > 0
+        ]
+        return min(max(min(deadlines, default=np.inf) - now, 0.0), maximum)
+
+
 class Networking(threading.Thread):
     def __init__(self, parent: CentrexGUIProtocol):
         super(Networking, self).__init__()
@@ -149,32 +574,38 @@ class Networking(threading.Thread):
         # are terminated
         self.daemon = True
 
-        self.context_readout = zmq.Context()
-        self.socket_readout = self.context_readout.socket(zmq.PUB)
+        # the context is shared with the networking clients of the program
+        context = shared_context(int(self.conf.get("io_threads", 1)))
+        self.socket_readout = context.socket(zmq.PUB)
         self.socket_readout.bind(f"tcp://*:{self.conf['port_readout']}")
 
-        # dictionary with timestamps of last ReadValue update per device
-        self.devices_last_updated = {
-            dev_name: 0 for dev_name in self.parent.devices.keys()
-        }
+        # the samples pushed by the devices to publish, in the order pushed
+        self.publish_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+        # the conflated and aggregated topics derived from each device topic
+        self.derived_topics = DerivedTopics(
+            float(self.conf.get("conflate_interval", 1.0)),
+            float(self.conf.get("aggregate_interval", 1.0)),
+        )
+
+        # clients cache the metadata of the devices for as long as this id is
+        # unchanged
+        self.run_id = uuid.uuid4().hex
 
         # initialize the broker for network control of devices
         allowed = self.conf["allowed"].split(",")
-        self.control_broker = NetworkingBroker(self.conf["port_control"], allowed)
+        self.control_broker = NetworkingBroker(
+            self.conf["port_control"], allowed, self.conf.get("keys_dir")
+        )
 
         # initialize the workers used for network control of devices
-        backend_port = self.control_broker.backend_port
+        backend_address = self.control_broker.backend_address
+        timeout = float(self.conf.get("control_timeout", 10.0))
         self.workers = [
-            NetworkingDeviceWorker(parent, backend_port)
+            NetworkingDeviceWorker(parent, backend_address, timeout, self.run_id)
             for _ in range(int(self.conf["workers"]))
         ]
 
-    def encode(self, topic, message):
-        """
-        Function encodes the message from the publisher via json serialization
-        """
-        return topic + " " + json.dumps(message)
-
     def run(self):
         logging.info("Networking: started main thread")
 
@@ -188,48 +619,38 @@ class Networking(threading.Thread):
             worker.start()
 
         for dev_name, dev in self.parent.devices.items():
-            # check device running
-            if not dev.control_started:
-                continue
-            # check device enabled
-            if not dev.config["control_params"]["enabled"]["value"] == 2:
-                continue
-
             # check if device is a network client, don't retransmit data
             # from a network client device
             if getattr(dev, "is_networking_client", None):
                 continue
+            driver_name = getattr(dev.config["driver_class"], "__name__", None)
+            if driver_name == "NetworkingClient":
+                continue
             logging.info(f"Networking: {dev_name} networking")
 
+            # the device puts every new sample on the publish queue while it is
+            # enabled, whether or not it started yet
+            dev.publish_queue = self.publish_queue
+
         while self.active.is_set():
-            for dev_name, dev in self.parent.devices.items():
-                # check device running
-                if not dev.control_started:
-                    continue
-                # check device enabled
-                if not dev.config["control_params"]["enabled"]["value"] == 2:
-                    continue
-
-                # check if device is a network client, don't retransmit data
-                # from a network client device
-                if getattr(dev, "is_networking_client", None):
-                    continue
-
-                if len(dev.config["plots_queue"]) > 0:
-                    data = dev.config["plots_queue"][-1]
-                else:
-                    data = None
-
-                if isinstance(data, list):
-                    if dev.config["slow_data"]:
-                        t_readout = data[0]
-                        if self.devices_last_updated[dev_name] != t_readout:
-                            self.devices_last_updated[dev_name] = t_readout
-                            topic = f"{self.conf['name']}-{dev_name}"
-                            message = [dev.time_offset + data[0]] + data[1:]
-                            self.socket_readout.send_string(self.encode(topic, message))
-
-                time.sleep(1e-5)
+            # wait for the next sample, with a timeout so the thread can be
+            # closed and the derived topics are sent on time
+            try:
+                dev_name, seq, data = self.publish_queue.get(
+                    timeout=self.derived_topics.timeout(time.time(), 0.2)
+                )
+            except queue.Empty:
+                data = None
+
+            if isinstance(data, list):
+                self.publish(dev_name, seq, data)
+
+            for frames in self.derived_topics.due(time.time()):
+                self.socket_readout.send_multipart(frames, copy=False)
+
+        for dev in self.parent.devices.values():
+            if dev.publish_queue is self.publish_queue:
+                dev.publish_queue = None
 
         # close the message broker and workers when stopping network control
         for worker in self.workers:
@@ -237,7 +658,6 @@ class Networking(threading.Thread):
         for worker in self.workers:
             worker.join()
 
-        # self.control_broker.active.clear()
         self.control_broker.__exit__()
         self.control_broker.join()
 
@@ -245,5 +665,15 @@ class Networking(threading.Thread):
         self.socket_readout.close()
         logging.info("Networking: stopped socket_readout")
 
-        self.context_readout.term()
-        logging.info("Networking: stopped contex_readout")
+    def publish(self, dev_name: str, seq: int, data: list) -> None:
+        # slow rows and fast waveforms are sent as a json header followed by the
+        # raw array buffer, without copying the array
+        dev = self.parent.devices[dev_name]
+        topic = f"{self.conf['name']}-{dev_name}"
+        try:
+            frames = encode_sample(topic, seq, data, dev.time_offset)
+        except Exception as err:
+            logging.warning(f"Networking: cannot publish {dev_name}: {err}")
+            return
+        self.socket_readout.send_multipart(frames, copy=False)
+        self.derived_topics.add(topic, seq, data, dev.time_offset)
@@ -0,0 +1,213 @@
+import itertools
+import json
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import zmq
+import zmq.auth
+
+from networking_messages import decode_topic
+
+
+def shared_context(io_threads: int = 1) -> zmq.Context:
+    """
+    The ZMQ context shared by the networking server and clients of the process.
+    io_threads only applies to the call that creates the context, so the program
+    creates it before starting the devices.
+    """
+    return zmq.Context.instance(io_threads)
+
+
+class ServerConnection:
+    """
+    The sockets shared by all NetworkingClient devices connected to one server:
+    a DEALER socket for control requests, which may be sent and received from
+    any thread, and a SUB socket for readout, read by a single thread that
+    passes each message to the device subscribed to its topic.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        port_readout: str,
+        port_control: str,
+        keys_dir: Optional[str] = None,
+    ):
+        self.server = server
+        context = shared_context()
+
+        # number of clients using the connection
+        self.users = 0
+
+        # the control socket is used by the threads of all clients, one at a
+        # time; requests are numbered for all clients, with the deadline of each
+        # request waiting for a reply, and the frames of replies received by
+        # another thread than the one waiting for them
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        self.pending_requests: Dict[int, float] = {}
+        self.replies: Dict[int, list] = {}
+
+        # loading authentication keys, from ./authentication unless another
+        # directory with the same layout is given
+        file_path = Path(__file__).resolve()
+        keys_path = Path(keys_dir) if keys_dir else file_path.parent / "authentication"
+        server_public_file = keys_path / "public_keys" / "server.key"
+        client_secret_file = keys_path / "private_keys" / "client.key_secret"
+        server_public, _ = zmq.auth.load_certificate(str(server_public_file))
+        client_public, client_secret = zmq.auth.load_certificate(
+            str(client_secret_file)
+        )
+
+        self.socket_control = context.socket(zmq.DEALER)
+        self.socket_control.curve_secretkey = client_secret
+        self.socket_control.curve_publickey = client_public
+        self.socket_control.curve_serverkey = server_public
+        self.socket_control.connect(f"tcp://{server}:{port_control}")
+
+        # topic -> function receiving the frames of each message on the topic;
+        # changes are queued for the readout thread, which owns the socket
+        self.receivers: Dict[str, Callable[[list], None]] = {}
+        self.subscriptions: queue.SimpleQueue = queue.SimpleQueue()
+
+        self.socket_readout = context.socket(zmq.SUB)
+        self.socket_readout.connect(f"tcp://{server}:{port_readout}")
+
+        self.active = threading.Event()
+        self.active.set()
+        self.readout_thread = threading.Thread(target=self.read, daemon=True)
+        self.readout_thread.start()
+
+    def subscribe(self, topic: str, receiver: Callable[[list], None]):
+        self.subscriptions.put((topic, receiver))
+
+    def unsubscribe(self, topic: str):
+        self.subscriptions.put((topic, None))
+
+    def read(self):
+        while self.active.is_set():
+            while not self.subscriptions.empty():
+                topic, receiver = self.subscriptions.get()
+                if receiver is not None:
+                    self.socket_readout.setsockopt_string(zmq.SUBSCRIBE, topic)
+                    self.receivers[topic] = receiver
+                elif topic in self.receivers:
+                    self.socket_readout.setsockopt_string(zmq.UNSUBSCRIBE, topic)
+                    del self.receivers[topic]
+
+            # receive all messages waiting before polling again
+            timeout = 50
+            while (self.socket_readout.poll(timeout) & zmq.POLLIN) != 0:
+                timeout = 0
+                frames = self.socket_readout.recv_multipart(copy=False)
+                try:
+                    self.dispatch(frames)
+                except Exception as err:
+                    logging.warning(f"ServerConnection: invalid message: {err}")
+
+        self.socket_readout.setsockopt(zmq.LINGER, 0)
+        self.socket_readout.close()
+
+    def dispatch(self, frames: list):
+        if len(frames) > 1:
+            receiver = self.receivers.get(decode_topic(frames))
+            if receiver is not None:
+                receiver(frames)
+            return
+        # json encoded slow data from servers predating the binary messages, a
+        # single frame starting with the topic
+        message = frames[0].bytes.decode()
+        for topic, receiver in self.receivers.items():
+            if message.startswith(topic) and message[len(topic) :].startswith("["):
+                receiver(frames)
+
+    def send(self, request: dict, timeout: float) -> int:
+        """
+        Send a request without waiting for the reply, and return its id to pass
+        to receive(). The reply is waited for up to timeout [s].
+        """
+        with self.lock:
+            request_id = next(self.request_ids)
+            request = dict(request, id=request_id, timeout=timeout)
+            # the empty frame stands in for the REQ envelope the server expects
+            self.socket_control.send_multipart([b"", json.dumps(request).encode()])
+            self.pending_requests[request_id] = time.time() + timeout
+        return request_id
+
+    def receive(self, request_id: int) -> Optional[list]:
+        """
+        Wait for the reply to a request, up to its timeout, and return its frames,
+        starting with the json header; None if there was no reply.
+        """
+        while True:
+            with self.lock:
+                if request_id in self.replies:
+                    self.pending_requests.pop(request_id)
+                    return self.replies.pop(request_id)
+                remaining = self.pending_requests[request_id] - time.time()
+                if remaining <= 0:
+                    self.pending_requests.pop(request_id)
+                    return None
+                # poll in short slices so other threads can send requests
+                # meanwhile
+                if self.socket_control.poll(min(remaining * 1e3, 1)) & zmq.POLLIN:
+                    self.receive_reply()
+                    continue
+            # need a sleep to release to other threads
+            time.sleep(1e-4)
+
+    def receive_reply(self):
+        frames = self.socket_control.recv_multipart(copy=False)
+        try:
+            reply_id = json.loads(frames[1].bytes)["id"]
+        except (ValueError, KeyError, TypeError, IndexError):
+            logging.warning(f"ServerConnection: invalid reply from {self.server}")
+            return
+        # drop late replies to requests that already timed out
+        if reply_id in self.pending_requests:
+            self.replies[reply_id] = frames[1:]
+
+    def close(self):
+        self.active.clear()
+        self.readout_thread.join()
+        with self.lock:
+            self.socket_control.setsockopt(zmq.LINGER, 0)
+            self.socket_control.close()
+
+
+# the connections in use, by server, ports and keys directory
+connections: Dict[Tuple[str, str, str, str], ServerConnection] = {}
+connections_lock = threading.Lock()
+
+
+def open_connection(
+    server: str, port_readout: str, port_control: str, keys_dir: Optional[str] = None
+) -> ServerConnection:
+    """The connection to the server, shared with the other clients of the server."""
+    key = (str(server), str(port_readout), str(port_control), str(keys_dir))
+    with connections_lock:
+        if key not in connections:
+            connections[key] = ServerConnection(
+                server, port_readout, port_control, keys_dir
+            )
+            logging.info(f"ServerConnection: connected to {server}")
+        connection = connections[key]
+        connection.users += 1
+    return connection
+
+
+def close_connection(connection: ServerConnection):
+    """Release the connection, and close it when no client uses it anymore."""
+    with connections_lock:
+        connection.users -= 1
+        if connection.users > 0:
+            return
+        for key, value in list(connections.items()):
+            if value is connection:
+                del connections[key]
+    connection.close()
+    logging.info(f"ServerConnection: disconnected from {connection.server}")
@@ -0,0 +1,201 @@
+import json
+import warnings
+from typing import Any, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+import zmq
+
+
+def json_default(obj: Any) -> Any:
+    """Convert the NumPy types found in device attributes for json.dumps()."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, bytes):
+        return obj.decode(errors="replace")
+    if isinstance(obj, (type, np.dtype)):
+        # driver dtypes given as Python or NumPy types, e.g. float
+        return np.dtype(obj).str
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def encode_sample(
+    topic: str, seq: int, data: list, time_offset: float
+) -> List[Union[bytes, np.ndarray]]:
+    """
+    Encode a sample pushed by a device as the frames of a multipart message:
+
+        [topic, header, buffer]
+
+    The header is a json dict with the kind of sample ("slow" or "fast"), the
+    device sequence number, the absolute timestamp and the dtype and shape of the
+    buffer; for fast samples it also holds the attributes of each record, with
+    absolute timestamps. The buffer is the array itself, sent without copying
+    with send_multipart(..., copy=False): the waveforms of a fast sample or the
+    values of a slow row. Slow rows that are not numeric are sent in the header
+    as "values" instead, without a buffer frame.
+    """
+    if isinstance(data[0], np.ndarray):
+        waveforms = np.ascontiguousarray(data[0])
+        attrs = [dict(attr) for attr in data[1]]
+        for attr in attrs:
+            if "timestamp" in attr:
+                attr["timestamp"] = time_offset + attr["timestamp"]
+        header = {
+            "kind": "fast",
+            "seq": seq,
+            "timestamp": attrs[-1].get("timestamp") if attrs else None,
+            "dtype": waveforms.dtype.str,
+            "shape": waveforms.shape,
+            "attrs": attrs,
+        }
+        buffer = waveforms
+    else:
+        header = {"kind": "slow", "seq": seq, "timestamp": time_offset + data[0]}
+        try:
+            buffer = np.asarray(data[1:], dtype=np.float64)
+            header["dtype"] = buffer.dtype.str
+            header["shape"] = buffer.shape
+        except (TypeError, ValueError):
+            header["values"] = data[1:]
+            buffer = None
+
+    frames = [topic.encode(), json.dumps(header, default=json_default).encode()]
+    if buffer is not None:
+        frames.append(buffer)
+    return frames
+
+
+def decode_sample(
+    frames: Sequence[Union[bytes, zmq.Frame]], time_offset: float
+) -> Tuple[int, list]:
+    """
+    Decode the frames of a message encoded with encode_sample() into the device
+    sequence number and the sample, with timestamps relative to time_offset.
+
+    The array shares the memory of the buffer frame (np.frombuffer) instead of
+    copying it.
+    """
+    header = json.loads(_bytes(frames[1]))
+    if len(frames) > 2:
+        array = np.frombuffer(_buffer(frames[2]), dtype=header["dtype"])
+        array = array.reshape(header["shape"])
+    else:
+        array = None
+
+    if header["kind"] == "fast":
+        attrs = header["attrs"]
+        for attr in attrs:
+            if "timestamp" in attr:
+                attr["timestamp"] -= time_offset
+        return header["seq"], [array, attrs]
+
+    if header["kind"] == "minmax":
+        return header["seq"], [
+            header["timestamp"] - time_offset,
+            array,
+            header["count"],
+        ]
+
+    values = array.tolist() if array is not None else header["values"]
+    return header["seq"], [header["timestamp"] - time_offset] + values
+
+
+def encode_aggregate(
+    topic: str, seq: int, start: float, stop: float, stats: npt.NDArray, count: int
+) -> List[Union[bytes, np.ndarray]]:
+    """
+    Encode the aggregate of the slow rows of a device over the interval
+    [start, stop) (absolute times) as the frames of a multipart message like
+    encode_sample(), with kind "minmax". The buffer holds the minimum, maximum
+    and mean of each column (NaNs ignored), one row each; the header holds the
+    number of rows aggregated, the sequence number of the last one and stop as
+    the timestamp. decode_sample() returns [timestamp, stats, count].
+    """
+    stats = np.ascontiguousarray(stats, dtype=np.float64)
+    header = {
+        "kind": "minmax",
+        "seq": seq,
+        "start": start,
+        "timestamp": stop,
+        "count": count,
+        "dtype": stats.dtype.str,
+        "shape": stats.shape,
+    }
+    return [topic.encode(), json.dumps(header, default=json_default).encode(), stats]
+
+
+def decode_topic(frames: Sequence[Union[bytes, zmq.Frame]]) -> str:
+    return _bytes(frames[0]).decode()
+
+
+def decimate_rows(
+    rows: npt.NDArray, max_rows: Optional[int], method: str = "mean"
+) -> npt.NDArray:
+    """
+    Reduce the rows of a 2-D array to at most max_rows, by averaging groups of
+    consecutive rows ("mean", NaNs ignored) or by taking every n-th row
+    ("stride").
+    """
+    if not max_rows or len(rows) <= max_rows:
+        return rows
+    step = -(-len(rows) // int(max_rows))
+    if method == "stride":
+        return rows[::step]
+    elif method != "mean":
+        raise ValueError(f"unknown decimation method {method}")
+    groups = [rows[i : i + step] for i in range(0, len(rows), step)]
+    with warnings.catch_warnings():
+        # groups of only NaNs give NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.stack([np.nanmean(group, axis=0) for group in groups])
+
+
+def encode_history(
+    header: dict, rows: npt.NDArray, chunk_rows: int = 100_000
+) -> List[Union[bytes, np.ndarray]]:
+    """
+    Encode the reply to a history request as the frames of a multipart message:
+    the json header, with the dtype, shape and number of rows of each chunk,
+    followed by the rows in chunks of at most chunk_rows rows, sent without
+    copying them.
+    """
+    rows = np.ascontiguousarray(rows)
+    chunks = [rows[i : i + chunk_rows] for i in range(0, len(rows), chunk_rows)]
+    header = dict(
+        header,
+        dtype=rows.dtype.str,
+        shape=rows.shape,
+        chunks=[len(chunk) for chunk in chunks],
+    )
+    return [json.dumps(header, default=json_default).encode()] + chunks
+
+
+def decode_history(
+    frames: Sequence[Union[bytes, zmq.Frame]],
+) -> Tuple[dict, Optional[npt.NDArray]]:
+    """
+    Decode the frames of a reply encoded with encode_history() into the header
+    and the rows (None if the request failed).
+    """
+    header = json.loads(_bytes(frames[0]))
+    if header.get("status") != "OK":
+        return header, None
+    shape = header["shape"]
+    chunks = [
+        np.frombuffer(_buffer(frame), dtype=header["dtype"]).reshape(-1, *shape[1:])
+        for frame in frames[1:]
+    ]
+    if len(chunks) == 0:
+        return header, np.zeros(shape, dtype=header["dtype"])
+    return header, np.concatenate(chunks)
+
+
+def _buffer(frame: Union[bytes, zmq.Frame]) -> Any:
+    return frame.buffer if isinstance(frame, zmq.Frame) else frame
+
+
+def _bytes(frame: Union[bytes, zmq.Frame]) -> bytes:
+    return frame.bytes if isinstance(frame, zmq.Frame) else frame
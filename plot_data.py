@@ -0,0 +1,393 @@
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import numpy.typing as npt
+
+from device import SnapshotCache
+from utils import GrowableArray
+
+
+class HDFReadCache:
+    """
+    Read access to the HDF files shared by all plots. Each file is opened once
+    (read-only, SWMR) and kept open, the columns of slow datasets already read
+    are kept in memory so that a refresh only reads the rows appended since the
+    previous one, and the most recently read fast data records are kept up to a
+    total of max_record_bytes.
+
+    The HDF_writer cannot open a file for writing while this process holds it
+    open read-only, so close() has to be called before the writer starts.
+    """
+
+    def __init__(self, max_record_bytes: int = int(100e6)):
+        self.lock = threading.RLock()
+        self.files: Dict[str, h5py.File] = {}
+        self.columns: Dict[Tuple[str, str, str], GrowableArray] = {}
+        self.records: "OrderedDict[Tuple[str, str], npt.NDArray]" = OrderedDict()
+        self.record_bytes = 0
+        self.max_record_bytes = max_record_bytes
+
+    def file(self, fname: str) -> h5py.File:
+        with self.lock:
+            f = self.files.get(fname)
+            if f is None or not f.id.valid:
+                f = h5py.File(fname, "r", libver="latest", swmr=True)
+                self.files[fname] = f
+            return f
+
+    def close(self, fname: str = None):
+        """Close one file (or all files) and drop everything read from it."""
+        with self.lock:
+            for name in list(self.files):
+                if fname is not None and name != fname:
+                    continue
+                try:
+                    self.files.pop(name).close()
+                except Exception as err:
+                    logging.warning(f"HDFReadCache: error closing {name}: {err}")
+            for key in list(self.columns):
+                if fname is None or key[0] == fname:
+                    del self.columns[key]
+            for key in list(self.records):
+                if fname is None or key[0] == fname:
+                    self.record_bytes -= self.records.pop(key).nbytes
+
+    def group_len(self, fname: str, path: str) -> int:
+        with self.lock:
+            return len(self.file(fname)[path])
+
+    def read_columns(
+        self, fname: str, path: str, columns: Sequence[str]
+    ) -> List[npt.NDArray]:
+        """
+        Return the given columns of a slow dataset, reading only the rows that
+        were appended since the last call. The returned arrays are read-only.
+        """
+        with self.lock:
+            dset = self.file(fname)[path]
+            try:
+                dset.refresh()
+            except (RuntimeError, ValueError):
+                pass
+            n_rows = dset.shape[0]
+
+            cached = [self.columns.get((fname, path, col)) for col in columns]
+            for col, arr in zip(columns, cached):
+                # the dataset was replaced by a shorter one; read it again
+                if arr is not None and len(arr) > n_rows:
+                    del self.columns[(fname, path, col)]
+
+            for col in columns:
+                arr = self.columns.get((fname, path, col))
+                if arr is None:
+                    arr = GrowableArray(dtype=dset.dtype[col], capacity=n_rows)
+                    self.columns[(fname, path, col)] = arr
+                if len(arr) < n_rows:
+                    arr.extend(dset.fields(col)[len(arr) : n_rows])
+
+            return [self.columns[(fname, path, col)].data for col in columns]
+
+    def read_record(self, fname: str, path: str) -> npt.NDArray:
+        """Return a fast data record; records do not change once written."""
+        with self.lock:
+            key = (fname, path)
+            record = self.records.get(key)
+            if record is not None:
+                self.records.move_to_end(key)
+                return record
+
+            record = self.file(fname)[path][()]
+            record.flags.writeable = False
+            self.records[key] = record
+            self.record_bytes += record.nbytes
+            while self.record_bytes > self.max_record_bytes and len(self.records) > 1:
+                _, old = self.records.popitem(last=False)
+                self.record_bytes -= old.nbytes
+            return record
+
+
+def minmax_buckets(
+    y: npt.NDArray, start: int, n_buckets: int, bucket_size: int
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """
+    Indices of the minimum and maximum of y in n_buckets consecutive buckets of
+    bucket_size samples, starting at index start. NaNs are ignored unless a
+    bucket holds nothing else.
+    """
+    stop = start + n_buckets * bucket_size
+    buckets = y[start:stop].reshape(n_buckets, bucket_size).astype(float)
+    nan = np.isnan(buckets)
+    imin = np.argmin(np.where(nan, np.inf, buckets), axis=1)
+    imax = np.argmax(np.where(nan, -np.inf, buckets), axis=1)
+    offsets = start + bucket_size * np.arange(n_buckets)
+    return imin + offsets, imax + offsets
+
+
+def tail_minmax(y: npt.NDArray, start: int) -> Tuple[int, int]:
+    """Indices of the minimum and maximum of y[start:], ignoring NaNs."""
+    tail = y[start:].astype(float)
+    if np.all(np.isnan(tail)):
+        return start, start
+    return start + np.nanargmin(tail), start + np.nanargmax(tail)
+
+
+def envelope(
+    x: npt.NDArray, y: npt.NDArray, imin: npt.NDArray, imax: npt.NDArray
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """The minimum and maximum of each bucket, in the order they occur in x."""
+    idx = np.stack([np.minimum(imin, imax), np.maximum(imin, imax)], axis=1).ravel()
+    return x[idx], y[idx]
+
+
+def decimate_minmax(
+    x: npt.NDArray, y: npt.NDArray, n_points: int
+) -> Tuple[npt.NDArray, npt.NDArray]:
+    """
+    Reduce x, y to the minimum and maximum of about n_points buckets, so that
+    all peaks of the data remain visible at a resolution of n_points pixels.
+    """
+    if len(y) <= 4 * n_points:
+        return x, y
+    bucket_size = len(y) // n_points
+    n_buckets = len(y) // bucket_size
+    imin, imax = minmax_buckets(y, 0, n_buckets, bucket_size)
+
+    # the remaining samples form one more, shorter bucket
+    tail = n_buckets * bucket_size
+    if tail < len(y):
+        tail_min, tail_max = tail_minmax(y, tail)
+        imin, imax = np.append(imin, tail_min), np.append(imax, tail_max)
+    return envelope(x, y, imin, imax)
+
+
+class MinMaxDecimator:
+    """
+    Min/max envelope of a slow data plot at the resolution of the plot,
+    maintained incrementally for data that only grows (e.g. read through the
+    HDFReadCache). The buckets hold a fixed number of samples; only the rows
+    added since the previous call are bucketed, and when there are more than
+    twice as many buckets as pixels, neighbouring buckets are merged pairwise
+    and the bucket size doubles. A zoomed range (x0, x1) is decimated from
+    scratch once and reused until the range changes.
+    """
+
+    def __init__(self, n_points: int = 1000):
+        self.n_points = n_points
+        self.zoom_key = None
+        self.zoom_data = None
+        self.reset()
+
+    def reset(self, key=None):
+        self.key = key
+        self.bucket_size = 1
+        self.imin = GrowableArray(dtype=np.int64)
+        self.imax = GrowableArray(dtype=np.int64)
+        self.last_x = None
+
+    def merge_buckets(self, y: npt.NDArray):
+        # an odd bucket out is dropped; its samples are bucketed again with the
+        # new bucket size on the next update
+        n = len(self.imin) // 2 * 2
+        y_min = np.nan_to_num(y.astype(float), nan=np.inf)
+        y_max = np.nan_to_num(y.astype(float), nan=-np.inf)
+        a, b = self.imin.data[0:n:2], self.imin.data[1:n:2]
+        new_imin = np.where(y_min[b] < y_min[a], b, a)
+        a, b = self.imax.data[0:n:2], self.imax.data[1:n:2]
+        new_imax = np.where(y_max[b] > y_max[a], b, a)
+
+        self.imin.clear()
+        self.imax.clear()
+        self.imin.extend(new_imin)
+        self.imax.extend(new_imax)
+        self.bucket_size *= 2
+
+    def update(self, y: npt.NDArray):
+        # the bucket size is only ever doubled, so the first buckets of a long
+        # run would be tiny; start with the bucket size the data already needs
+        if len(self.imin) == 0:
+            self.bucket_size = max(1, len(y) // (2 * self.n_points))
+
+        start = len(self.imin) * self.bucket_size
+        n_buckets = (len(y) - start) // self.bucket_size
+        if n_buckets > 0:
+            imin, imax = minmax_buckets(y, start, n_buckets, self.bucket_size)
+            self.imin.extend(imin)
+            self.imax.extend(imax)
+        while len(self.imin) > 2 * self.n_points:
+            self.merge_buckets(y)
+
+    def decimate(
+        self,
+        x: npt.NDArray,
+        y: npt.NDArray,
+        key=None,
+        x0: int = 0,
+        x1: int = None,
+    ) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Decimate x[x0:x1], y[x0:x1]. With a key, x and y are taken to be the
+        same data as in the previous call with that key, plus new rows at the
+        end; without a key, the data is decimated from scratch.
+        """
+        if x1 is None:
+            x1 = len(y)
+
+        # zoomed in: the range does not change while the run grows
+        if x0 > 0 or x1 < len(y):
+            zoom_key = (key, x0, x1, self.n_points)
+            if key is None or zoom_key != self.zoom_key:
+                self.zoom_key = zoom_key
+                self.zoom_data = decimate_minmax(x[x0:x1], y[x0:x1], self.n_points)
+            return self.zoom_data
+
+        if key is None or len(y) <= 4 * self.n_points:
+            self.reset()
+            return decimate_minmax(x, y, self.n_points)
+
+        # start over if the data is not the previous data with rows appended
+        n_done = len(self.imin) * self.bucket_size
+        if (
+            key != self.key
+            or len(y) < n_done
+            or (n_done > 0 and x[n_done - 1] != self.last_x)
+        ):
+            self.reset(key)
+        self.update(y)
+        n_done = len(self.imin) * self.bucket_size
+        self.last_x = x[n_done - 1] if n_done > 0 else None
+
+        # the samples after the last complete bucket
+        imin, imax = self.imin.data, self.imax.data
+        if n_done < len(y):
+            tail_min, tail_max = tail_minmax(y, n_done)
+            imin, imax = np.append(imin, tail_min), np.append(imax, tail_max)
+        return envelope(x, y, imin, imax)
+
+
+class TraceCursor:
+    """
+    Position in the stream of traces of a fast device: the sequence number of
+    the last sample taken from the snapshot cache of the device, or the number
+    of the last HDF record read.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last_seq: Optional[int] = None
+        self.last_record: Optional[int] = None
+
+    def new_entries(self, cache: SnapshotCache, max_new: int) -> Tuple[List[Any], bool]:
+        """
+        The samples pushed to the cache since the last call (at most max_new),
+        and whether they directly follow the samples returned before.
+        """
+        entries = cache.since(self.last_seq)
+        contiguous = self.last_seq is not None and (
+            not entries or entries[0][0] == self.last_seq + 1
+        )
+        if len(entries) > max_new:
+            entries = entries[-max_new:] if max_new > 0 else []
+            contiguous = False
+        if entries:
+            self.last_seq = entries[-1][0]
+        return [data for _, data in entries], contiguous
+
+    def new_records(self, last_record: int, max_new: int) -> Tuple[range, bool]:
+        """Like new_entries, for HDF records numbered from 1 up to last_record."""
+        first = last_record - max_new + 1
+        contiguous = False
+        if self.last_record is not None and last_record >= self.last_record:
+            contiguous = self.last_record + 1 >= first
+            first = max(first, self.last_record + 1)
+        self.last_record = last_record
+        return range(max(first, 1), last_record + 1), contiguous
+
+
+class TraceAverager:
+    """
+    Running averages over the most recent traces of one channel of a fast device
+    (optionally divided by a normalization channel), shared by all plots showing
+    that channel. New traces are added to a running sum for each number of
+    traces averaged, and the traces dropping out of the window are subtracted,
+    so a refresh costs O(new traces) rather than O(n_average).
+
+    The traces come either from the snapshot cache of the device
+    (update_from_queue) or from the numbered records in the HDF file (update_from_records).
+    """
+
+    # recompute the sums from the window after this many traces, so rounding
+    # errors of the running sums do not accumulate
+    resum_interval = 1000
+
+    def __init__(self, extract: Callable[[Any], npt.NDArray]):
+        self.extract = extract
+        self.lock = threading.Lock()
+        self.max_n = 1
+        self.reset()
+
+    def reset(self):
+        self.window: Deque[npt.NDArray] = deque()
+        self.sums: Dict[int, npt.NDArray] = {}
+        self.n_pushed = 0
+        self.cursor = TraceCursor()
+
+    def request(self, n: int):
+        """Make sure the window holds enough traces to average n of them."""
+        if n > self.max_n:
+            self.max_n = n
+            # read the traces from the source again, as far back as available
+            self.reset()
+
+    def push(self, trace: npt.NDArray):
+        if self.window and trace.shape != self.window[-1].shape:
+            self.clear_window()
+
+        self.window.append(trace)
+        for n, s in self.sums.items():
+            s += trace
+            if len(self.window) > n:
+                s -= self.window[-n - 1]
+        while len(self.window) > self.max_n:
+            self.window.popleft()
+
+        self.n_pushed += 1
+        if self.n_pushed % self.resum_interval == 0:
+            self.sums = {n: self.sum_last(n) for n in self.sums}
+
+    def sum_last(self, n: int) -> npt.NDArray:
+        traces = list(self.window)[-n:]
+        return np.sum(traces, axis=0, dtype=float)
+
+    def clear_window(self):
+        self.window.clear()
+        self.sums.clear()
+
+    def update_from_queue(self, cache: SnapshotCache):
+        entries, contiguous = self.cursor.new_entries(cache, self.max_n)
+        if not contiguous:
+            self.clear_window()
+        for entry in entries:
+            self.push(self.extract(entry))
+
+    def update_from_records(self, last_record: int, read: Callable[[int], Any]):
+        """Add the records up to last_record; read(i) returns record i."""
+        records, contiguous = self.cursor.new_records(last_record, self.max_n)
+        if not contiguous:
+            self.clear_window()
+        for i in records:
+            self.push(self.extract(read(i)))
+
+    def mean(self, n: int) -> Optional[npt.NDArray]:
+        """Average of the last n traces (or as many as there are)."""
+        if not self.window:
+            return None
+        n = min(n, self.max_n)
+        if n not in self.sums:
+            self.sums[n] = self.sum_last(n)
+        return self.sums[n] / min(n, len(self.window))
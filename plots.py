@@ -1,16 +1,21 @@
 import logging
 import pickle
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 import h5py
 import numpy as np
+import numpy.typing as npt
 import PyQt5
 import PyQt5.QtWidgets as qt
 import pyqtgraph as pg
 
 from config import PlotConfig
-from utils import split
+from plot_data import HDFReadCache, MinMaxDecimator, TraceAverager, TraceCursor
+from utils import Expression, GrowableArray, split
 from utils_gui import LabelFrame, ScrollableLabelFrame, update_QComboBox
 
 
@@ -19,6 +24,17 @@ class PlotsGUI(qt.QSplitter):
         super().__init__()
         self.parent = parent
         self.all_plots = {}
+
+        # open HDF files and the data already read from them, shared by all plots
+        self.hdf_cache = HDFReadCache()
+
+        # running averages of fast data traces, shared by all plots
+        self.trace_averagers = {}
+        self.trace_averagers_lock = threading.Lock()
+
+        # refreshes all running plots
+        self.scheduler = PlotScheduler(self.parent)
+
         self.place_GUI_elements()
 
         # QSplitter options
@@ -123,6 +139,11 @@ class PlotsGUI(qt.QSplitter):
         ctrls_f.addWidget(pb, 2, 4)
         pb.clicked[bool].connect(lambda val, fname=qle.text(): self.load_plots(fname))
 
+        # frame rate achieved by the plot scheduler
+        self.fps_la = qt.QLabel()
+        self.fps_la.setToolTip("Number of times per second the plots are redrawn.")
+        ctrls_f.addWidget(self.fps_la, 2, 5)
+
         # frame to place all the plots in
         box, self.plots_f = LabelFrame("Plots")
         self.addWidget(box)
@@ -170,6 +191,12 @@ class PlotsGUI(qt.QSplitter):
 
         return plot
 
+    def trace_averager(self, key, extract) -> TraceAverager:
+        with self.trace_averagers_lock:
+            if key not in self.trace_averagers:
+                self.trace_averagers[key] = TraceAverager(extract)
+            return self.trace_averagers[key]
+
     def open_file(self, sect, config, qle):
         val = qt.QFileDialog.getOpenFileName(self, "Select file")[0]
         if not val:
@@ -265,7 +292,7 @@ class PlotsGUI(qt.QSplitter):
         for col, col_plots in self.all_plots.items():
             for row, plot in col_plots.items():
                 if plot:
-                    plot.fast_y = []
+                    plot.clear_fast_y()
 
     def toggle_all_plot_controls(self):
         for col, col_plots in self.all_plots.items():
@@ -320,6 +347,10 @@ class PlotsGUI(qt.QSplitter):
 
 
 class Plotter(qt.QWidget):
+    # the data is prepared in the threads of the PlotScheduler; calls that change
+    # GUI elements are handed over to the GUI thread with this signal
+    gui_call = PyQt5.QtCore.pyqtSignal(object)
+
     def __init__(self, frame, parent):
         super().__init__()
         self.f = frame
@@ -327,7 +358,21 @@ class Plotter(qt.QWidget):
 
         self.plot = None
         self.curve = None
-        self.fast_y = []
+        # f(y) of fast data: the compiled function, its values for past traces,
+        # and the last trace it was evaluated for
+        self.fn: Optional[Expression] = None
+        self.fast_y = GrowableArray()
+        self.fast_y_cursor = TraceCursor()
+        self.fast_y_backfill = 10000
+
+        # the latest prepared frame that has not been drawn yet
+        self.frame_lock = threading.Lock()
+        self.next_frame = None
+        self.frames_dropped = 0
+        self.gui_call.connect(lambda fn: fn())
+
+        # min/max envelope of slow data at the resolution of the plot
+        self.decimator = MinMaxDecimator()
 
         self.config = PlotConfig()
 
@@ -608,19 +653,16 @@ class Plotter(qt.QWidget):
         if bool(int(self.dev.config["control_params"]["HDF_enabled"]["value"])):
             # check run is valid
             try:
-                with h5py.File(
-                    self.parent.config["files"]["plotting_hdf_fname"],
-                    "r",
-                    libver="latest",
-                    swmr=True,
-                ) as f:
-                    if self.config["run"] not in f.keys():
-                        self.stop_animation()
-                        logging.warning(
-                            "Plot error: Run not found in the HDF file:"
-                            + self.config["run"]
-                        )
-                        return False
+                f = self.parent.PlotsGUI.hdf_cache.file(
+                    self.parent.config["files"]["plotting_hdf_fname"]
+                )
+                if self.config["run"] not in f.keys():
+                    self.stop_animation()
+                    logging.warning(
+                        "Plot error: Run not found in the HDF file:"
+                        + self.config["run"]
+                    )
+                    return False
             except OSError:
                 logging.warning("Plot error: Not a valid HDF file.")
                 logging.warning(traceback.format_exc())
@@ -632,22 +674,16 @@ class Plotter(qt.QWidget):
 
             # check dataset exists in the run
             try:
-                with h5py.File(
-                    self.parent.config["files"]["plotting_hdf_fname"],
-                    "r",
-                    libver="latest",
-                    swmr=True,
-                ) as f:
-                    try:
-                        f[self.config["run"] + "/" + self.dev.config["path"]]
-                    except KeyError:
-                        logging.info(traceback.format_exc())
-                        if time.time() - self.parent.config["time_offset"] > 5:
-                            logging.warning(
-                                "Plot error: Dataset not found in this run."
-                            )
-                        self.stop_animation()
-                        return False
+                f = self.parent.PlotsGUI.hdf_cache.file(
+                    self.parent.config["files"]["plotting_hdf_fname"]
+                )
+                f[self.config["run"] + "/" + self.dev.config["path"]]
+            except KeyError:
+                logging.info(traceback.format_exc())
+                if time.time() - self.parent.config["time_offset"] > 5:
+                    logging.warning("Plot error: Dataset not found in this run.")
+                self.stop_animation()
+                return False
             except RuntimeError as error:
                 logging.warning(f"Plot error : {error}")
                 logging.warning(traceback.format_exc())
@@ -659,7 +695,7 @@ class Plotter(qt.QWidget):
         if self.config["device"] in self.parent.devices:
             self.dev = self.parent.devices[self.config["device"]]
         else:
-            self.stop_animation()
+            self.gui_call.emit(self.stop_animation)
             logging.warning("Plot error: Invalid device: " + self.config["device"])
             return False
 
@@ -679,105 +715,112 @@ class Plotter(qt.QWidget):
     def get_raw_data_from_HDF(self):
         if not self.dev.config["control_params"]["HDF_enabled"]["value"]:
             logging.warning("Plot error: cannot plot from HDF when HDF is disabled")
-            self.toggle_HDF_or_queue()
+            self.gui_call.emit(self.toggle_HDF_or_queue)
             return
 
-        with h5py.File(
-            self.parent.config["files"]["plotting_hdf_fname"],
-            "r",
-            libver="latest",
-            swmr=True,
-        ) as f:
-            grp = f[self.config["run"] + "/" + self.dev.config["path"]]
+        cache = self.parent.PlotsGUI.hdf_cache
+        fname = self.parent.config["files"]["plotting_hdf_fname"]
+        grp_path = self.config["run"] + "/" + self.dev.config["path"]
+        divide = self.config["z"] in self.param_list and self.config["z"] != "(none)"
 
-            if self.dev.config["slow_data"]:
-                dset = grp[self.dev.config["name"]]
-                x = dset[self.config["x"]]
-                y = dset[self.config["y"]]
+        if self.dev.config["slow_data"]:
+            # only the rows appended since the last refresh are read from the file
+            columns = [self.config["x"], self.config["y"]]
+            if divide:
+                columns.append(self.config["z"])
+            x, y, *z = cache.read_columns(
+                fname, grp_path + "/" + self.dev.config["name"], columns
+            )
 
-                # divide y by z (if applicable)
-                if self.config["z"] in self.param_list and self.config["z"] != "(none)":
-                    y /= dset[self.config["z"]]
+            # divide y by z (if applicable)
+            if divide:
+                y = y / z[0]
 
-            if not self.dev.config["slow_data"]:
-                # find the latest record
-                rec_num = len(grp) - 1
+        if not self.dev.config["slow_data"]:
+            # find the latest record
+            rec_num = cache.group_len(fname, grp_path) - 1
 
-                # get the latest curve
-                try:
-                    dset = grp[self.dev.config["name"] + "_" + str(rec_num)]
-                except KeyError as err:
-                    logging.warning("Plot error: not found in HDF: " + str(err))
-                    logging.warning(traceback.format_exc())
-                    return None
+            # get the latest curve
+            try:
+                dset = cache.read_record(
+                    fname, grp_path + "/" + self.dev.config["name"] + "_" + str(rec_num)
+                )
+            except KeyError as err:
+                logging.warning("Plot error: not found in HDF: " + str(err))
+                logging.warning(traceback.format_exc())
+                return None
 
-                if self.config["x"] == "(none)":
-                    x = np.arange(dset[0].shape[2])
-                else:
-                    x = dset[0][0, self.param_list.index(self.config["x"])].astype(
-                        float
-                    )
-                if self.config["y"] == "(none)":
-                    logging.warning("Plot error: y not valid.")
-                    logging.warning("Plot warning: bad parameters")
-                    return None
-                y = dset[:, self.param_list.index(self.config["y"])].astype(np.float)
+            if self.config["x"] == "(none)":
+                x = np.arange(dset[0].shape[2])
+            else:
+                x = dset[0][0, self.param_list.index(self.config["x"])].astype(float)
+            if self.config["y"] == "(none)":
+                logging.warning("Plot error: y not valid.")
+                logging.warning("Plot warning: bad parameters")
+                return None
+            iy = self.param_list.index(self.config["y"])
+            iz = self.param_list.index(self.config["z"]) if divide else None
+            y = dset[:, iy].astype(float)
 
-                # divide y by z (if applicable)
-                if self.config["z"] in self.param_list and self.config["z"] != "(none)":
-                    y = y / dset[:, self.param_list.index(self.config["z"])]
+            # divide y by z (if applicable)
+            if divide:
+                y = y / dset[:, iz]
 
-                # average sanity check
-                if self.config["n_average"] > len(grp):
-                    logging.warning(
-                        f"{self.dev.config['name']} plot error: Cannot average more traces than exist."
+            # if not averaging, return the data
+            if self.config["n_average"] < 2:
+                return x, y
+
+            # average sanity check
+            if self.config["n_average"] > rec_num:
+                logging.warning(
+                    f"{self.dev.config['name']} plot error: Cannot average more traces than exist."
+                )
+                return x, y
+
+            # average last n curves, reading only the records added since the
+            # last refresh
+            averager = self.parent.PlotsGUI.trace_averager(
+                ("HDF", fname, grp_path, self.dev.config["name"], iy, iz),
+                lambda dset: dset[:, iy] / dset[:, iz] if divide else dset[:, iy],
+            )
+            record_path = grp_path + "/" + self.dev.config["name"] + "_"
+            with averager.lock:
+                averager.request(self.config["n_average"])
+                try:
+                    averager.update_from_records(
+                        rec_num,
+                        lambda i: cache.read_record(fname, record_path + str(i)),
                     )
+                except KeyError as err:
+                    logging.warning("Plot averaging error: " + str(err))
+                    logging.warning(traceback.format_exc())
+                    averager.reset()
                     return x, y
-
-                # average last n curves (if applicable)
-                for i in range(self.config["n_average"] - 1):
-                    try:
-                        dset = grp[self.dev.config["name"] + "_" + str(rec_num - i)]
-                    except KeyError as err:
-                        logging.warning("Plot averaging error: " + str(err))
-                        logging.warning(traceback.format_exc())
-                        break
-                    if (
-                        self.config["z"] in self.param_list
-                        and self.config["z"] != "(none)"
-                    ):
-                        y += (
-                            dset[:, self.param_list.index(self.config["y"])]
-                            / dset[:, self.param_list.index(self.config["z"])]
-                        )
-                    else:
-                        y += dset[:, self.param_list.index(self.config["y"])]
-                if self.config["n_average"] > 0:
-                    y = y / self.config["n_average"]
+                y = averager.mean(self.config["n_average"])
 
         return x, y
 
     def get_raw_data_from_queue(self):
-        # for slow data: copy the queue contents into a np array
+        cache = self.dev.snapshot_cache
+
+        # for slow data: the rows already converted to floats by the cache
         if self.dev.config["slow_data"]:
-            dset = np.array(self.dev.config["plots_queue"])
-            if len(dset.shape) < 2:
+            _, _, rows = cache.arrays_since()
+            if rows is None or len(rows) == 0:
                 return None
-            x = dset[:, self.param_list.index(self.config["x"])]
-            y = dset[:, self.param_list.index(self.config["y"])]
+            x = rows[:, self.param_list.index(self.config["x"])]
+            y = rows[:, self.param_list.index(self.config["y"])]
 
             # divide y by z (if applicable)
             if self.config["z"] in self.param_list and self.config["z"] != "(none)":
-                y = y / dset[0][0, self.param_list.index(self.config["z"])]
+                y = y / rows[:, self.param_list.index(self.config["z"])]
 
         # for fast data: return only the latest value
         if not self.dev.config["slow_data"]:
-            try:
-                dset = self.dev.config["plots_queue"][-1]
-            except IndexError as e:
-                logging.warning(e)
-                logging.warning(traceback.format_exc())
+            latest = cache.latest()
+            if latest is None:
                 return None
+            _, dset = latest
             if dset == [np.nan] or dset == np.nan:
                 return None
             if self.config["x"] == "(none)":
@@ -797,7 +840,10 @@ class Plotter(qt.QWidget):
             self.dset_attrs = dset[1]
 
             # divide y by z (if applicable)
-            if self.config["z"] in self.param_list and self.config["z"] != "(none)":
+            divide = (
+                self.config["z"] in self.param_list and self.config["z"] != "(none)"
+            )
+            if divide:
                 y = y / dset[0][0, self.param_list.index(self.config["z"])]
 
             # if not averaging, return the data
@@ -812,25 +858,22 @@ class Plotter(qt.QWidget):
                 )
                 return x, y
 
-            # average last n curves (if applicable)
-            for i in range(self.config["n_average"] - 1):
-                try:
-                    dset = self.dev.config["plots_queue"][-(i + 1)]
-                except (KeyError, IndexError) as err:
-                    logging.warning(f"{self.dev.config['name']} plot averaging error: " + str(err))
-                    logging.warning(traceback.format_exc())
-                    break
-
-                if self.config["z"] in self.param_list and self.config["z"] != "(none)":
-                    y += (
-                        dset[0][0, self.param_list.index(self.config["y"])]
-                        / dset[0][0, self.param_list.index(self.config["z"])]
-                    )
-                else:
-                    y += dset[0][0, self.param_list.index(self.config["y"])]
-
-            if self.config["n_average"] > 0:
-                y = y / self.config["n_average"]
+            # average last n curves, adding only the traces pushed since the last
+            # refresh to the running sums
+            iy = self.param_list.index(self.config["y"])
+            iz = self.param_list.index(self.config["z"]) if divide else None
+            averager = self.parent.PlotsGUI.trace_averager(
+                ("queue", self.dev.config["name"], iy, iz),
+                lambda entry: (
+                    entry[0][0, iy] / entry[0][0, iz]
+                    if divide
+                    else entry[0][0, iy].astype(float)
+                ),
+            )
+            with averager.lock:
+                averager.request(self.config["n_average"])
+                averager.update_from_queue(cache)
+                y = averager.mean(self.config["n_average"])
 
         return x, y
 
@@ -842,8 +885,21 @@ class Plotter(qt.QWidget):
             or self.config["from_HDF"]
         ):
             data = self.get_raw_data_from_HDF()
+            from_HDF = True
+
+            # data read from HDF only grows, so it can be decimated incrementally
+            decimation_key = (
+                self.parent.config["files"]["plotting_hdf_fname"],
+                self.config["run"],
+                self.config["device"],
+                self.config["x"],
+                self.config["y"],
+                self.config["z"],
+            )
         else:
             data = self.get_raw_data_from_queue()
+            from_HDF = False
+            decimation_key = None
 
         try:
             x, y = data[0], data[1]
@@ -885,15 +941,20 @@ class Plotter(qt.QWidget):
 
         # if not applying f(y), return the data ...
         if not self.config["fn"]:
+            if self.dev.config["slow_data"] and not self.config["hist"]:
+                return self.decimator.decimate(x, y, decimation_key, x0, x1)
             return x[x0:x1], y[x0:x1]
 
         # ... else apply f(y) to the data
+        fn = self.fn_expression()
+        if fn is None:
+            return x[x0:x1], y[x0:x1]
 
         if self.dev.config["slow_data"]:
             # For slow data, the function evaluated on the data must return an
             # array of the same shape as the raw data.
             try:
-                y_fn = eval(self.config["f(y)"])
+                y_fn = fn(y, x=x, self=self)
                 if not x.shape == y_fn.shape:
                     raise ValueError("x.shape != y_fn.shape")
             except Exception as err:
@@ -901,42 +962,148 @@ class Plotter(qt.QWidget):
                 logging.warning(traceback.format_exc())
                 y_fn = y
             else:
-                return x[x0:x1], y_fn[x0:x1]
+                if self.config["hist"]:
+                    return x[x0:x1], y_fn[x0:x1]
+                return self.decimator.decimate(x, y_fn, None, x0, x1)
 
         if not self.dev.config["slow_data"]:
             # For fast data, the function evaluated on the data must return either
             #    (a) an array with same shape as the original data
             #    (b) a scalar value
             try:
-                y_fn = eval(self.config["f(y)"])
+                y_fn = fn(y, x=x, self=self)
                 # case (a)
-                if x.shape == y_fn.shape:
+                if np.shape(y_fn) == x.shape:
                     return x[x0:x1], y_fn[x0:x1]
 
-                # case (b)
-                else:
-                    try:
-                        float(y_fn)
-                        self.fast_y.append(y_fn)
-                        return np.arange(len(self.fast_y)), np.array(self.fast_y)
-                    except Exception as err:
-                        raise TypeError(str(err))
+                # case (b): evaluate the function on every trace that arrived
+                # since the last refresh
+                try:
+                    float(y_fn)
+                except Exception as err:
+                    raise TypeError(str(err))
+                traces = self.new_fast_traces(from_HDF)
+                if len(traces) > 0:
+                    self.fast_y.extend(fn.evaluate_batch(traces, x=x, self=self))
+                return np.arange(len(self.fast_y)), self.fast_y.data
 
             except Exception as e:
                 logging.warning(e)
                 logging.warning(traceback.format_exc())
                 return x[x0:x1], y[x0:x1]
 
-    def replot(self):
+    def fn_expression(self) -> Optional[Expression]:
+        """The compiled f(y); recompiled, and past values cleared, on change."""
+        if self.fn is None or self.fn.source != self.config["f(y)"]:
+            self.clear_fast_y()
+            try:
+                self.fn = Expression(self.config["f(y)"])
+            except SyntaxError as err:
+                logging.warning(f"Plot error: invalid f(y): {err}")
+                self.fn = None
+        return self.fn
+
+    def new_fast_traces(self, from_HDF: bool) -> npt.NDArray:
+        """
+        The traces of the y channel (divided by z, if applicable) that arrived
+        since the last call, one per row. The first call goes back as far as the
+        snapshot cache of the device, or fast_y_backfill HDF records.
+        """
+        iy = self.param_list.index(self.config["y"])
+        iz = None
+        if self.config["z"] in self.param_list and self.config["z"] != "(none)":
+            iz = self.param_list.index(self.config["z"])
+
+        traces = []
+        if from_HDF:
+            cache = self.parent.PlotsGUI.hdf_cache
+            fname = self.parent.config["files"]["plotting_hdf_fname"]
+            grp_path = self.config["run"] + "/" + self.dev.config["path"]
+            rec_num = cache.group_len(fname, grp_path) - 1
+            records, _ = self.fast_y_cursor.new_records(
+                rec_num, self.fast_y_backfill
+            )
+            for i in records:
+                dset = cache.read_record(
+                    fname, grp_path + "/" + self.dev.config["name"] + "_" + str(i)
+                )
+                if iz is not None:
+                    traces.append(dset[:, iy] / dset[:, iz])
+                else:
+                    traces.append(dset[:, iy])
+        else:
+            entries, _ = self.fast_y_cursor.new_entries(
+                self.dev.snapshot_cache, self.dev.config["plots_queue_maxlen"]
+            )
+            for entry in entries:
+                # all records of each acquisition
+                if iz is not None:
+                    traces.extend(entry[0][:, iy] / entry[0][:, iz])
+                else:
+                    traces.extend(entry[0][:, iy])
+
+        try:
+            return np.array(traces, dtype=float)
+        except ValueError:
+            # traces of different lengths
+            logging.warning(
+                f"{self.dev.config['name']} plot error: trace length changed"
+            )
+            return np.empty(0)
+
+    def clear_fast_y(self):
+        """Clear the values of f(y) computed for past traces of fast data."""
+        self.fast_y.clear()
+        self.fast_y_cursor.reset()
+
+    def prepare_frame(self):
+        """
+        Get the data and bring it into the form the curve is drawn from. Runs in
+        a PlotScheduler thread, so GUI elements may only be changed through the
+        gui_call signal.
+        """
         # check parameters
         if not self.parameters_good():
             logging.warning("Plot warning: bad parameters.")
-            return
+            return None
 
         # get data
         data = self.get_data()
         if not data:
-            return
+            return None
+
+        # bin edges for histograms
+        if self.config["hist"]:
+            bin_diffs = np.diff(data[0])
+            bins = np.append(
+                [data[0][0] - bin_diffs[0] / 2], data[0][1:] - bin_diffs / 2
+            )
+            bins = np.append(bins, [data[0][-1] + bin_diffs[-1] / 2])
+            data = (bins, data[1])
+
+        return data, self.config["hist"]
+
+    def queue_frame(self, frame):
+        """
+        Hand a prepared frame to the GUI thread. If the previous frame has not
+        been drawn yet, it is replaced (dropped).
+        """
+        with self.frame_lock:
+            if self.next_frame is not None:
+                self.frames_dropped += 1
+            self.next_frame = frame
+
+    def replot(self) -> bool:
+        """Draw the latest prepared frame; runs in the GUI thread."""
+        with self.frame_lock:
+            frame, self.next_frame = self.next_frame, None
+        if frame is None:
+            return False
+        data, hist = frame
+
+        # frame prepared before toggling the histogram mode
+        if hist != self.config["hist"]:
+            return False
 
         # plot data
         if not self.plot:
@@ -944,13 +1111,6 @@ class Plotter(qt.QWidget):
             self.plot.showGrid(True, True)
             self.f.addWidget(self.plot)
         if not self.curve:
-            if self.config["hist"]:
-                bin_diffs = np.diff(data[0])
-                bins = np.append(
-                    [data[0][0] - bin_diffs[0] / 2], data[0][1:] - bin_diffs / 2
-                )
-                bins = np.append(bins, [data[0][-1] + bin_diffs[-1] / 2])
-                data = (bins, data[1])
             self.curve = self.plot.plot(
                 *data,
                 symbol=self.config["symbol"],
@@ -958,15 +1118,15 @@ class Plotter(qt.QWidget):
             )
             self.update_labels()
         else:
-            if self.config["hist"]:
-                bin_diffs = np.diff(data[0])
-                bins = np.append(
-                    [data[0][0] - bin_diffs[0] / 2], data[0][1:] - bin_diffs / 2
-                )
-                bins = np.append(bins, [data[0][-1] + bin_diffs[-1] / 2])
-                data = (bins, data[1])
             self.curve.setData(*data)
 
+        # decimate slow data to the width of the plot in pixels
+        n_points = max(self.plot.width(), 100)
+        if n_points != self.decimator.n_points:
+            self.decimator = MinMaxDecimator(n_points)
+
+        return True
+
     def update_labels(self):
         if self.plot:
             # get units
@@ -1010,45 +1170,47 @@ class Plotter(qt.QWidget):
             else:
                 self.plot.setYRange(y0, y1)
 
-    class PlotUpdater(PyQt5.QtCore.QThread):
-        signal = PyQt5.QtCore.pyqtSignal()
-
-        def __init__(self, parent, config):
-            self.parent = parent
-            self.config = config
-            super().__init__()
-
-        def run(self):
-            while self.config["active"]:
-                self.signal.emit()
-
-                # loop delay
-                try:
-                    dt = float(self.config["dt"])
-                    if dt < 0.002:
-                        logging.warning("Plot dt too small.")
-                        raise ValueError(f"{dt} < 0.002")
-                except ValueError as e:
-                    logging.warning(e)
-                    logging.warning(traceback.format_exc())
-                    dt = float(self.parent.config["general"]["default_plot_dt"])
-                time.sleep(dt)
-            logging.info(f"PlotUpdater: {self.config['device']} stopped")
+    def refresh_interval(self) -> float:
+        try:
+            dt = float(self.config["dt"])
+            if dt < 0.002:
+                logging.warning("Plot dt too small.")
+                raise ValueError(f"{dt} < 0.002")
+        except ValueError as e:
+            logging.warning(e)
+            logging.warning(traceback.format_exc())
+            dt = float(self.parent.config["general"]["default_plot_dt"])
+        return dt
+
+    def source_state(self):
+        """
+        Everything the next frame depends on: the number of samples the device
+        has pushed, the plot settings, the resolution of the decimation, and for
+        data read from HDF while recording, the time of the last write.
+        """
+        dev = self.parent.devices.get(self.config["device"])
+        state = (
+            dev.sequence if dev else None,
+            tuple(self.config.get(key) for key in self.config.static_keys),
+            self.decimator.n_points,
+        )
+        if self.config["from_HDF"] or not self.parent.config["control_active"]:
+            HDF_writer = getattr(self.parent.ControlGUI, "HDF_writer", None)
+            if HDF_writer and HDF_writer.active.is_set():
+                state += (HDF_writer.time_last_write,)
+        return state
 
     def start_animation(self):
         # check if current hdf file and dataset exist
         if not self.hdf_good():
             return
 
-        # start animation
-        self.thread = self.PlotUpdater(self.parent, self.config)
-        self.thread.finished.connect(self.thread.deleteLater)
-        self.thread.start()
-        self.thread.signal.connect(self.replot)
-
         # update status
         self.config["active"] = True
 
+        # start animation
+        self.parent.PlotsGUI.scheduler.add(self)
+
         # change the "Start" button into a "Stop" button
         self.start_pb.setText("Stop")
         self.start_pb.disconnect()
@@ -1065,8 +1227,7 @@ class Plotter(qt.QWidget):
         self.start_pb.setText("Start")
         self.start_pb.disconnect()
         self.start_pb.clicked[bool].connect(self.start_animation)
-        self.thread.exit()
-        self.thread.wait()
+        self.parent.PlotsGUI.scheduler.remove(self)
 
     def destroy(self):
         self.stop_animation()
@@ -1138,7 +1299,7 @@ class Plotter(qt.QWidget):
             )
         else:
             self.config["fn"] = False
-            self.fast_y = []
+            self.clear_fast_y()
             self.fn_pb.setText("f(y)")
             self.fn_pb.setToolTip(
                 "Apply the specified function before plotting the data. Double click to"
@@ -1161,3 +1322,109 @@ class Plotter(qt.QWidget):
                 self.curve = None
             self.curve = None
             self.config["hist"] = None
+
+
+class PlotScheduler(PyQt5.QtCore.QObject):
+    """
+    Refreshes all running plots from a single timer. On each tick, the plots
+    that are due (according to their own dt) and whose source data or settings
+    changed since their last frame are prepared in a thread pool; the frames
+    finished since the previous tick are drawn together in one pass in the GUI
+    thread. A plot is not submitted again while its previous frame is still
+    being prepared.
+    """
+
+    def __init__(self, parent):
+        super().__init__()
+        self.parent = parent
+        self.plots = []
+
+        conf = self.parent.config["general"]
+        try:
+            self.frame_dt = float(conf.get("plot_frame_dt", 0.02))
+            n_threads = int(conf.get("plot_threads", 4))
+        except ValueError as e:
+            logging.warning(e)
+            logging.warning(traceback.format_exc())
+            self.frame_dt, n_threads = 0.02, 4
+        self.executor = ThreadPoolExecutor(
+            max_workers=n_threads, thread_name_prefix="PlotScheduler"
+        )
+
+        # per plot: time the next frame is due, state of the last frame, and the
+        # frame being prepared
+        self.next_due = {}
+        self.last_state = {}
+        self.in_progress = {}
+
+        # achieved frame rate: number of passes that drew anything, per second
+        self.fps = 0.0
+        self.frames = 0
+        self.time_fps = time.time()
+
+        self.timer = PyQt5.QtCore.QTimer()
+        self.timer.timeout.connect(self.tick)
+
+    def add(self, plot):
+        if plot not in self.plots:
+            self.plots.append(plot)
+        self.next_due[plot] = 0.0
+        self.last_state.pop(plot, None)
+        if not self.timer.isActive():
+            self.timer.start(int(1000 * self.frame_dt))
+
+    def remove(self, plot):
+        if plot in self.plots:
+            self.plots.remove(plot)
+        self.next_due.pop(plot, None)
+        self.last_state.pop(plot, None)
+
+    def prepare(self, plot):
+        try:
+            frame = plot.prepare_frame()
+            if frame:
+                plot.queue_frame(frame)
+        except Exception as e:
+            logging.warning(f"PlotScheduler: {plot.config['device']}: {e}")
+            logging.warning(traceback.format_exc())
+
+    def tick(self):
+        now = time.time()
+
+        # draw the frames prepared since the last tick
+        for plot, future in list(self.in_progress.items()):
+            if future.done():
+                del self.in_progress[plot]
+        drawn = False
+        for plot in self.plots:
+            if plot in self.in_progress:
+                continue
+            try:
+                drawn |= plot.replot()
+            except Exception as e:
+                logging.warning(f"PlotScheduler: {plot.config['device']}: {e}")
+                logging.warning(traceback.format_exc())
+
+        # start preparing the plots that are due and have new data
+        for plot in self.plots:
+            if plot in self.in_progress or now < self.next_due[plot]:
+                continue
+            self.next_due[plot] = now + plot.refresh_interval()
+            state = plot.source_state()
+            if state == self.last_state.get(plot):
+                continue
+            self.last_state[plot] = state
+            self.in_progress[plot] = self.executor.submit(self.prepare, plot)
+
+        # frame rate
+        if drawn:
+            self.frames += 1
+        if now - self.time_fps >= 1.0:
+            self.fps = self.frames / (now - self.time_fps)
+            self.frames = 0
+            self.time_fps = now
+            self.parent.PlotsGUI.fps_la.setText(f"{self.fps:.1f} fps")
+
+        if not self.plots and not self.in_progress:
+            self.timer.stop()
+            self.parent.PlotsGUI.fps_la.setText("")
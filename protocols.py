@@ -12,6 +12,7 @@ from device import Device as DeviceProtocol
 class HDF_writerProtocol(Protocol):
     active: threading.Event
     time_last_write: datetime.datetime
+    writer_lag: float
 
 
 class ControlGUIProtocol(Protocol):
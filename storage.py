@@ -0,0 +1,733 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+import multiprocessing
+import pickle
+import re
+import struct
+import time
+from pathlib import Path
+from multiprocessing.connection import Connection
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import h5py
+import numpy as np
+import numpy.typing as npt
+
+
+def rows_to_array(rows: Sequence[Sequence[Any]], dtype: np.dtype, name: str = ""):
+    """
+    Convert a list of slow data rows into a structured array of the given dtype.
+    Rows that cannot be converted are skipped and logged.
+    """
+    try:
+        return np.array([tuple(row) for row in rows], dtype=dtype)
+    except (ValueError, TypeError):
+        pass
+
+    # convert row by row to keep the good rows
+    good_rows = []
+    for row in rows:
+        try:
+            good_rows.append(np.array([tuple(row)], dtype=dtype))
+        except (ValueError, TypeError) as err:
+            logging.error(f"Error in rows_to_array: {name}; {str(err)}")
+    if len(good_rows) == 0:
+        return np.zeros((0,), dtype=dtype)
+    return np.concatenate(good_rows)
+
+
+class StorageBackend(ABC):
+    """
+    Interface between the HDF_writer and the data files on disk.
+
+    A backend stores a single run. Streams are identified by the device path and
+    name; slow data streams take rows with a fixed structured dtype, fast data
+    streams take one block (array plus attributes) per acquisition record. Each
+    stream also has an events table of (time, command, return value) strings.
+    """
+
+    def __init__(self, filename: str, run_name: str):
+        self.filename = filename
+        self.run_name = run_name
+
+    @abstractmethod
+    def open(self):
+        pass
+
+    @abstractmethod
+    def create_run(self, attrs: Dict[str, Any]):
+        pass
+
+    @abstractmethod
+    def create_stream(
+        self,
+        path: str,
+        name: str,
+        attrs: Dict[str, Any],
+        dtype: Any,
+        slow_data: bool,
+    ):
+        pass
+
+    @abstractmethod
+    def append_rows(self, path: str, name: str, rows: Sequence[Sequence[Any]]):
+        pass
+
+    @abstractmethod
+    def append_block(
+        self,
+        path: str,
+        name: str,
+        data: npt.NDArray,
+        attrs: Dict[str, Any],
+        dtype: Any = None,
+    ):
+        pass
+
+    @abstractmethod
+    def append_events(self, path: str, name: str, events: List[List[str]]):
+        pass
+
+    @abstractmethod
+    def flush(self):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HDFBackend(StorageBackend):
+    """
+    The original HDF5 layout: one group per run, one resizable dataset per slow
+    device, one dataset per acquisition record for fast devices.
+    """
+
+    def __init__(self, filename: str, run_name: str, swmr: bool = False):
+        super().__init__(filename, run_name)
+        self.file: Optional[h5py.File] = None
+
+        # switch the file to SWMR mode once opened, so that other processes can
+        # read it with swmr=True while it is written; no groups, datasets or
+        # attributes can be created then, only existing datasets resized
+        self.swmr = swmr
+
+    def open(self):
+        self.file = h5py.File(self.filename, "a", libver="latest")
+        if self.swmr:
+            self.file.swmr_mode = True
+
+    def create_run(self, attrs: Dict[str, Any]):
+        root = self.file.create_group(self.run_name)
+        for key, val in attrs.items():
+            root.attrs[key] = val
+
+    def create_stream(
+        self,
+        path: str,
+        name: str,
+        attrs: Dict[str, Any],
+        dtype: Any,
+        slow_data: bool,
+    ):
+        grp = self.file[self.run_name].require_group(path)
+
+        # create dataset for data if only one is needed
+        # (fast devices create a new dataset for each acquisition)
+        if slow_data:
+            dset = grp.create_dataset(name, (0,), maxshape=(None,), dtype=dtype)
+            for attr_name, attr in attrs.items():
+                dset.attrs[attr_name] = attr
+        else:
+            for attr_name, attr in attrs.items():
+                grp.attrs[attr_name] = attr
+
+        # create dataset for events
+        grp.create_dataset(
+            name + "_events",
+            (0, 3),
+            maxshape=(None, 3),
+            dtype=h5py.special_dtype(vlen=str),
+        )
+
+    def append_rows(self, path: str, name: str, rows: Sequence[Sequence[Any]]):
+        dset = self.file[self.run_name][path][name]
+        data = rows_to_array(rows, dset.dtype, name)
+        if len(data) == 0:
+            return
+        dset.resize(dset.shape[0] + len(data), axis=0)
+        dset[-len(data) :] = data
+
+    def append_block(
+        self,
+        path: str,
+        name: str,
+        data: npt.NDArray,
+        attrs: Dict[str, Any],
+        dtype: Any = None,
+    ):
+        grp = self.file[self.run_name][path]
+        dset = grp.create_dataset(
+            name=name + "_" + str(len(grp)),
+            data=data,
+            dtype=dtype,
+            compression=None,
+        )
+        for key, val in attrs.items():
+            dset.attrs[key] = val
+
+    def append_events(self, path: str, name: str, events: List[List[str]]):
+        events_dset = self.file[self.run_name][path][name + "_events"]
+        events_dset.resize(events_dset.shape[0] + len(events), axis=0)
+        events_dset[-len(events) :, :] = events
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, bytes):
+        return obj.decode()
+    return str(obj)
+
+
+def run_dirname(run_name: str) -> str:
+    """Run names contain a timestamp; make them safe to use as a directory name."""
+    return re.sub(r'[<>:"/\\|?*]', "_", run_name)
+
+
+class SegmentBackend(StorageBackend):
+    """
+    Append-only columnar segment files, written to a directory next to the HDF
+    file (`<hdf_fname stem>.segments`).
+
+    Every stream is a directory `<run>/<device path>/<name>/` with
+
+        stream.json     dtype, column names and attributes, written once
+        segments.jsonl  journal with one line per segment or record
+        events.jsonl    one line per event
+        c<i>.<n>.npy    column i of slow data segment n
+        r<n>.npy        fast data record n
+
+    Slow data rows are buffered in memory and written out as one `.npy` file per
+    column on `flush()`, or once `segment_rows` rows are buffered. Nothing is
+    ever rewritten, so segments can be memory-mapped while the run is recorded
+    (see `SegmentReader`).
+    """
+
+    def __init__(self, filename: str, run_name: str, segment_rows: int = 100_000):
+        super().__init__(filename, run_name)
+        self.root = Path(filename).with_suffix(".segments")
+        self.run_dir = self.root / run_dirname(run_name)
+        self.segment_rows = segment_rows
+        self.streams: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def stream_dir(self, path: str, name: str) -> Path:
+        return self.run_dir / path / name
+
+    def open(self):
+        # read the stream definitions back in when reopening an existing run
+        if not self.run_dir.is_dir():
+            return
+        for stream_file in self.run_dir.glob("**/stream.json"):
+            with open(stream_file, "r") as f:
+                info = json.load(f)
+            self.load_stream(info, stream_file.parent)
+
+    def load_stream(self, info: Dict[str, Any], directory: Path):
+        n_segments, n_records = 0, 0
+        journal = directory / "segments.jsonl"
+        if journal.is_file():
+            with open(journal, "r") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if entry["type"] == "rows":
+                        n_segments += 1
+                    else:
+                        n_records += 1
+        self.streams[(info["path"], info["name"])] = {
+            "dir": directory,
+            "slow_data": info["slow_data"],
+            "dtype": (
+                np.dtype([tuple(d) for d in info["dtype"]])
+                if info["slow_data"]
+                else np.dtype(info["dtype"])
+            ),
+            "buffer": [],
+            "n_segments": n_segments,
+            "n_records": n_records,
+        }
+
+    def create_run(self, attrs: Dict[str, Any]):
+        self.run_dir.mkdir(parents=True, exist_ok=False)
+        with open(self.run_dir / "run.json", "w") as f:
+            json.dump(
+                {"run_name": self.run_name, "attrs": attrs}, f, default=_json_default
+            )
+
+    def create_stream(
+        self,
+        path: str,
+        name: str,
+        attrs: Dict[str, Any],
+        dtype: Any,
+        slow_data: bool,
+    ):
+        directory = self.stream_dir(path, name)
+        directory.mkdir(parents=True, exist_ok=False)
+        dtype = np.dtype(dtype)
+        info = {
+            "path": path,
+            "name": name,
+            "slow_data": slow_data,
+            "dtype": dtype.descr if slow_data else dtype.str,
+            "attrs": dict(attrs),
+        }
+        with open(directory / "stream.json", "w") as f:
+            json.dump(info, f, default=_json_default)
+        self.load_stream(json.loads(json.dumps(info, default=_json_default)), directory)
+
+    def append_journal(self, stream: Dict[str, Any], entry: Dict[str, Any]):
+        with open(stream["dir"] / "segments.jsonl", "a") as f:
+            f.write(json.dumps(entry, default=_json_default) + "\n")
+
+    def append_rows(self, path: str, name: str, rows: Sequence[Sequence[Any]]):
+        stream = self.streams[(path, name)]
+        data = rows_to_array(rows, stream["dtype"], name)
+        if len(data) == 0:
+            return
+        stream["buffer"].append(data)
+        if sum(len(b) for b in stream["buffer"]) >= self.segment_rows:
+            self.write_segment(stream)
+
+    def write_segment(self, stream: Dict[str, Any]):
+        if len(stream["buffer"]) == 0:
+            return
+        data = np.concatenate(stream["buffer"])
+        stream["buffer"] = []
+        n = stream["n_segments"]
+        files = []
+        for idx, column in enumerate(data.dtype.names):
+            fname = f"c{idx}.{n:06d}.npy"
+            np.save(stream["dir"] / fname, np.ascontiguousarray(data[column]))
+            files.append(fname)
+        self.append_journal(
+            stream, {"type": "rows", "segment": n, "rows": len(data), "files": files}
+        )
+        stream["n_segments"] += 1
+
+    def append_block(
+        self,
+        path: str,
+        name: str,
+        data: npt.NDArray,
+        attrs: Dict[str, Any],
+        dtype: Any = None,
+    ):
+        stream = self.streams[(path, name)]
+        n = stream["n_records"]
+        fname = f"r{n:06d}.npy"
+        dtype = stream["dtype"] if dtype is None else dtype
+        np.save(stream["dir"] / fname, np.asarray(data, dtype=dtype))
+        self.append_journal(
+            stream, {"type": "record", "record": n, "file": fname, "attrs": attrs}
+        )
+        stream["n_records"] += 1
+
+    def append_events(self, path: str, name: str, events: List[List[str]]):
+        stream = self.streams[(path, name)]
+        with open(stream["dir"] / "events.jsonl", "a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+
+    def flush(self):
+        for stream in self.streams.values():
+            self.write_segment(stream)
+
+    def close(self):
+        self.flush()
+
+
+def make_backend(
+    kind: str, filename: str, run_name: str, swmr: bool = False
+) -> StorageBackend:
+    if kind == "hdf":
+        return HDFBackend(filename, run_name, swmr)
+    elif kind == "segments":
+        return SegmentBackend(filename, run_name)
+    else:
+        raise ValueError(f"Unknown storage backend: {kind}")
+
+
+def send_message(conn: Connection, message: Tuple[Any, ...]):
+    """
+    Send a message through a pipe. Arrays are pickled out-of-band (protocol 5),
+    so their data is written to the pipe straight from the array buffer.
+    """
+    buffers: List[pickle.PickleBuffer] = []
+    header = pickle.dumps(message, protocol=5, buffer_callback=buffers.append)
+    conn.send_bytes(struct.pack("<I", len(buffers)) + header)
+    for buffer in buffers:
+        conn.send_bytes(buffer.raw())
+
+
+def receive_message(conn: Connection) -> Tuple[Any, ...]:
+    header = conn.recv_bytes()
+    (nbuffers,) = struct.unpack("<I", header[:4])
+    buffers = [conn.recv_bytes() for _ in range(nbuffers)]
+    return pickle.loads(header[4:], buffers=buffers)
+
+
+def backend_process(
+    kind: str,
+    filename: str,
+    run_name: str,
+    conn: Connection,
+    status_conn: Connection,
+    swmr: bool = False,
+):
+    """
+    Main function of the writer process started by `ProcessBackend`: execute the
+    backend calls received through `conn`, and report back through `status_conn`.
+    """
+    backend = make_backend(kind, filename, run_name, swmr)
+    try:
+        backend.open()
+    except Exception as err:
+        status_conn.send(("error", f"open: {err}"))
+        return
+    status_conn.send(("ok", time.time()))
+
+    time_last_status = time.time()
+    while True:
+        if conn.poll(0.5):
+            try:
+                message = receive_message(conn)
+            except EOFError:
+                status_conn.send(("error", "connection to the writer thread lost"))
+                break
+            if message[0] == "close":
+                break
+            if message[0] not in ProcessBackend.forwarded:
+                status_conn.send(("error", f"invalid call {message[0]}"))
+                continue
+            try:
+                getattr(backend, message[0])(*message[1:])
+            except Exception as err:
+                logging.warning(f"HDF_writer process error: {message[0]}: {err}")
+                status_conn.send(("error", f"{message[0]}: {err}"))
+
+        # report the process is alive and writing
+        if time.time() - time_last_status > 0.5:
+            status_conn.send(("ok", time.time()))
+            time_last_status = time.time()
+
+    try:
+        backend.close()
+    except Exception as err:
+        status_conn.send(("error", f"close: {err}"))
+    status_conn.send(("closed", time.time()))
+
+
+class ProcessBackend(StorageBackend):
+    """
+    Run a storage backend in a separate process, so that h5py and disk I/O do
+    not compete with the acquisition threads for the GIL.
+
+    The calls are forwarded through a pipe; the process reports its status
+    (time of last activity and any errors) through a second pipe, which is read
+    with `poll_status()`.
+    """
+
+    forwarded = (
+        "create_run",
+        "create_stream",
+        "append_rows",
+        "append_block",
+        "append_events",
+        "flush",
+    )
+
+    def __init__(self, kind: str, filename: str, run_name: str, swmr: bool = False):
+        super().__init__(filename, run_name)
+        self.kind = kind
+        self.swmr = swmr
+        self.process: Optional[multiprocessing.Process] = None
+        self.time_last_write = time.time()
+        self.errors: List[str] = []
+
+    def open(self):
+        # already started
+        if self.process is not None:
+            return
+        child_conn, self.conn = multiprocessing.Pipe(duplex=False)
+        self.status_conn, child_status_conn = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=backend_process,
+            args=(
+                self.kind,
+                self.filename,
+                self.run_name,
+                child_conn,
+                child_status_conn,
+                self.swmr,
+            ),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        child_status_conn.close()
+
+        # wait for the process to open the file
+        if not self.status_conn.poll(30.0):
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+            raise OSError("HDF_writer process did not start")
+        status, value = self.status_conn.recv()
+        if status == "error":
+            self.process.join()
+            self.process = None
+            raise OSError(value)
+        self.time_last_write = value
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def poll_status(self) -> List[str]:
+        """Read the status messages sent by the process; return any errors."""
+        errors = []
+        try:
+            while self.status_conn.poll():
+                status, value = self.status_conn.recv()
+                if status == "error":
+                    errors.append(value)
+                else:
+                    self.time_last_write = value
+        except EOFError:
+            pass
+        self.errors += errors
+        return errors
+
+    def create_run(self, attrs: Dict[str, Any]):
+        send_message(self.conn, ("create_run", attrs))
+
+    def create_stream(
+        self,
+        path: str,
+        name: str,
+        attrs: Dict[str, Any],
+        dtype: Any,
+        slow_data: bool,
+    ):
+        send_message(self.conn, ("create_stream", path, name, attrs, dtype, slow_data))
+
+    def append_rows(self, path: str, name: str, rows: Sequence[Sequence[Any]]):
+        send_message(self.conn, ("append_rows", path, name, rows))
+
+    def append_block(
+        self,
+        path: str,
+        name: str,
+        data: npt.NDArray,
+        attrs: Dict[str, Any],
+        dtype: Any = None,
+    ):
+        send_message(self.conn, ("append_block", path, name, data, attrs, dtype))
+
+    def append_events(self, path: str, name: str, events: List[List[str]]):
+        send_message(self.conn, ("append_events", path, name, events))
+
+    def flush(self):
+        send_message(self.conn, ("flush",))
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            send_message(self.conn, ("close",))
+        except OSError as err:
+            logging.warning(f"HDF_writer process error: {err}")
+        self.process.join(timeout=60.0)
+        if self.process.is_alive():
+            logging.error("HDF_writer process did not stop; terminating")
+            self.process.terminate()
+            self.process.join()
+        self.poll_status()
+        self.conn.close()
+        self.status_conn.close()
+        self.process = None
+
+
+class SegmentReader:
+    """
+    Read access to the files written by `SegmentBackend`. Column segments are
+    opened as memory maps, so only the parts that are accessed are read from
+    disk.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def runs(self) -> List[str]:
+        runs = []
+        for run_file in sorted(self.root.glob("*/run.json")):
+            with open(run_file, "r") as f:
+                runs.append(json.load(f)["run_name"])
+        return runs
+
+    def run_attrs(self, run_name: str) -> Dict[str, Any]:
+        with open(self.root / run_dirname(run_name) / "run.json", "r") as f:
+            return json.load(f)["attrs"]
+
+    def streams(self, run_name: str) -> List[Dict[str, Any]]:
+        streams = []
+        for stream_file in sorted(
+            (self.root / run_dirname(run_name)).glob("**/stream.json")
+        ):
+            with open(stream_file, "r") as f:
+                streams.append(json.load(f))
+        return streams
+
+    def journal(self, run_name: str, path: str, name: str) -> List[Dict[str, Any]]:
+        fname = self.root / run_dirname(run_name) / path / name / "segments.jsonl"
+        if not fname.is_file():
+            return []
+        with open(fname, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def column_segments(
+        self, run_name: str, path: str, name: str, column: str
+    ) -> List[np.memmap]:
+        directory = self.root / run_dirname(run_name) / path / name
+        with open(directory / "stream.json", "r") as f:
+            names = [d[0] for d in json.load(f)["dtype"]]
+        idx = names.index(column)
+        return [
+            np.load(directory / entry["files"][idx], mmap_mode="r")
+            for entry in self.journal(run_name, path, name)
+            if entry["type"] == "rows"
+        ]
+
+    def read_column(self, run_name: str, path: str, name: str, column: str):
+        segments = self.column_segments(run_name, path, name, column)
+        if len(segments) == 0:
+            return np.array([])
+        return np.concatenate(segments)
+
+    def read_rows(self, run_name: str, path: str, name: str) -> npt.NDArray:
+        directory = self.root / run_dirname(run_name) / path / name
+        with open(directory / "stream.json", "r") as f:
+            dtype = np.dtype([tuple(d) for d in json.load(f)["dtype"]])
+        segments = []
+        for entry in self.journal(run_name, path, name):
+            if entry["type"] != "rows":
+                continue
+            segment = np.zeros(entry["rows"], dtype=dtype)
+            for column, fname in zip(dtype.names, entry["files"]):
+                segment[column] = np.load(directory / fname, mmap_mode="r")
+            segments.append(segment)
+        if len(segments) == 0:
+            return np.zeros((0,), dtype=dtype)
+        return np.concatenate(segments)
+
+    def records(
+        self, run_name: str, path: str, name: str
+    ) -> Iterator[Tuple[np.memmap, Dict[str, Any]]]:
+        directory = self.root / run_dirname(run_name) / path / name
+        for entry in self.journal(run_name, path, name):
+            if entry["type"] == "record":
+                yield np.load(directory / entry["file"], mmap_mode="r"), entry["attrs"]
+
+    def events(self, run_name: str, path: str, name: str) -> List[List[str]]:
+        fname = self.root / run_dirname(run_name) / path / name / "events.jsonl"
+        if not fname.is_file():
+            return []
+        with open(fname, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+
+def convert_to_hdf(segments_root: str, hdf_fname: str):
+    """
+    Copy all runs stored with `SegmentBackend` into an HDF file with the same
+    layout as written by `HDFBackend`.
+    """
+    reader = SegmentReader(segments_root)
+    for run_name in reader.runs():
+        logging.info(f"convert_to_hdf: {run_name}")
+        with HDFBackend(hdf_fname, run_name) as hdf:
+            hdf.create_run(reader.run_attrs(run_name))
+            for info in reader.streams(run_name):
+                path, name = info["path"], info["name"]
+                if info["slow_data"]:
+                    dtype = np.dtype([tuple(d) for d in info["dtype"]])
+                else:
+                    dtype = np.dtype(info["dtype"])
+                hdf.create_stream(path, name, info["attrs"], dtype, info["slow_data"])
+                if info["slow_data"]:
+                    rows = reader.read_rows(run_name, path, name)
+                    if len(rows) > 0:
+                        dset = hdf.file[run_name][path][name]
+                        dset.resize(len(rows), axis=0)
+                        dset[:] = rows
+                else:
+                    for data, attrs in reader.records(run_name, path, name):
+                        hdf.append_block(path, name, np.asarray(data), attrs)
+                events = reader.events(run_name, path, name)
+                if len(events) != 0:
+                    hdf.append_events(path, name, events)
+
+
+def read_slow_rows(
+    kind: str,
+    filename: str,
+    run_name: str,
+    path: str,
+    name: str,
+    start: float = -np.inf,
+    stop: float = np.inf,
+    last: Optional[int] = None,
+) -> npt.NDArray:
+    """
+    The rows of a slow data stream with the time (first column) between start
+    and stop, or the last `last` of those, as a structured array. The stream can
+    be read while the run is being recorded; for HDF files only the time column
+    and the selected rows are read.
+    """
+    if kind == "hdf":
+        with h5py.File(filename, "r", libver="latest", swmr=True) as f:
+            dset = f[run_name][path][name]
+            times = dset[dset.dtype.names[0]]
+            i0 = np.searchsorted(times, start, side="left")
+            i1 = np.searchsorted(times, stop, side="right")
+            if last is not None:
+                i0 = max(i0, i1 - last)
+            return dset[i0:i1]
+    elif kind == "segments":
+        reader = SegmentReader(str(Path(filename).with_suffix(".segments")))
+        rows = reader.read_rows(run_name, path, name)
+        times = rows[rows.dtype.names[0]]
+        i0 = np.searchsorted(times, start, side="left")
+        i1 = np.searchsorted(times, stop, side="right")
+        if last is not None:
+            i0 = max(i0, i1 - last)
+        return rows[i0:i1]
+    else:
+        raise ValueError(f"Unknown storage backend: {kind}")
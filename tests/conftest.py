@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+
+# the modules are imported from the repository root, as when running main.py,
+# and the drivers from the drivers directory
+root = Path(__file__).resolve().parent.parent
+for path in [root, root / "drivers"]:
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
@@ -0,0 +1,193 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import pytest
+
+from influxdb_writer import InfluxDBWriter, format_line
+
+
+class StubInfluxDB(HTTPServer):
+    """Accepts POST /api/v2/write like InfluxDB, unless it is set to be down."""
+
+    def __init__(self):
+        self.up = True
+        self.batches = []
+        super().__init__(("127.0.0.1", 0), StubHandler)
+
+    @property
+    def lines(self):
+        return [line for batch in self.batches for line in batch]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        if not self.server.up:
+            self.send_response(503)
+            self.end_headers()
+            return
+        assert self.path.startswith("/api/v2/write?")
+        assert self.headers["Authorization"] == "Token token"
+        self.server.batches.append(body.split("\n"))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubInfluxDB()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def writer(server, tmp_path):
+    writer = InfluxDBWriter(
+        f"127.0.0.1:{server.server_port}",
+        "org",
+        "bucket",
+        "token",
+        batch_size=100,
+        flush_interval=0.05,
+        spool_fname=str(tmp_path / "spool.txt"),
+        max_retry_interval=0.2,
+    )
+    writer.retry_interval = 0.1
+    yield writer
+    writer.active.clear()
+    if writer.is_alive():
+        writer.join()
+
+
+def write_points(writer, start, stop):
+    for i in range(start, stop):
+        writer.write("m", {"name": "device"}, {"value": float(i)}, i)
+
+
+def values(lines):
+    return [float(line.split("value=")[1].split()[0]) for line in lines]
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_format_line():
+    line = format_line(
+        "my measurement",
+        {"name": "a=1,b", "empty": ""},
+        {
+            "x": 1.5,
+            "n": np.int64(3),
+            "ok": np.bool_(True),
+            "s": 'a "quote"\nTraceback',
+            "nan": np.nan,
+        },
+        1.5,
+    )
+    assert line == (
+        "my\\ measurement,name=a\\=1\\,b x=1.5,n=3i,ok=true,"
+        's="a \\"quote\\"\\nTraceback" 1500000000'
+    )
+    assert format_line("m", {}, {"nan": np.nan}, 0) is None
+
+
+def test_batches(server, writer):
+    writer.start()
+    write_points(writer, 0, 250)
+    wait_for(lambda: len(server.lines) == 250)
+    assert all(len(batch) <= writer.batch_size for batch in server.batches)
+    assert values(server.lines) == list(range(250))
+    assert not writer.spool_file.exists()
+
+
+def test_outage_spool_replay(server, writer):
+    writer.start()
+    write_points(writer, 0, 100)
+    wait_for(lambda: len(server.lines) == 100)
+
+    # the points written while the server is down are spooled, with retries
+    # backing off up to max_retry_interval
+    server.up = False
+    write_points(writer, 100, 400)
+    wait_for(lambda: writer.count_spooled() == 300)
+    assert len(server.lines) == 100
+    wait_for(lambda: writer.retry_interval == writer.max_retry_interval)
+
+    # once the server is back, the spooled points are sent first, in order
+    server.up = True
+    write_points(writer, 400, 450)
+    wait_for(lambda: len(server.lines) == 450)
+    assert values(server.lines) == list(range(450))
+    assert not writer.spool_file.exists()
+
+
+def test_spool_on_stop(server, writer):
+    server.up = False
+    writer.start()
+    write_points(writer, 0, 10)
+    writer.active.clear()
+    writer.join()
+    assert writer.count_spooled() == 10
+
+    # a new writer replays the spool file left by the previous one
+    server.up = True
+    next_writer = InfluxDBWriter(
+        f"127.0.0.1:{server.server_port}",
+        "org",
+        "bucket",
+        "token",
+        flush_interval=0.05,
+        spool_fname=str(writer.spool_file),
+    )
+    next_writer.start()
+    write_points(next_writer, 10, 20)
+    wait_for(lambda: len(server.lines) == 20)
+    next_writer.active.clear()
+    next_writer.join()
+    assert values(server.lines) == list(range(20))
+
+
+def test_spool_cap(writer):
+    writer.max_spool_lines = 25
+    for i in range(4):
+        writer.spool([f"m value={10 * i + j}" for j in range(10)])
+        assert writer.count_spooled() <= writer.max_spool_lines
+
+    # dropped down to 90% of the limit when exceeding it, keeping the newest
+    with open(writer.spool_file) as f:
+        assert values(f) == list(range(18, 40))
+    assert writer.spool_lines == writer.count_spooled() == 22
+
+
+def test_replay_failure(writer):
+    writer.batch_size = 10
+    writer.spool([f"m value={i}" for i in range(35)])
+    sent = []
+    replies = iter([True, False, True, True, True])
+
+    def send(lines):
+        if next(replies):
+            sent.extend(lines)
+            return True
+        return False
+
+    # the batch that failed and the lines after it stay in the spool file
+    writer.send = send
+    assert not writer.replay()
+    with open(writer.spool_file) as f:
+        assert values(f) == list(range(10, 35))
+    assert writer.replay()
+    assert values(sent) == list(range(35))
+    assert not writer.spool_file.exists()
@@ -0,0 +1,155 @@
+import json
+import shutil
+import threading
+
+import numpy as np
+import pytest
+import zmq
+import zmq.auth
+
+from NetworkingClient import NetworkingClient
+
+DRIVER = """
+class FakeDriver:
+    def __init__(self, time_offset, *args):
+        pass
+
+    def get_x(self):
+        return 0
+"""
+
+
+class FakeServer(threading.Thread):
+    """
+    Answers the control requests of clients like the networking server, with
+    the metadata of FakeDriver and the reply set for the commands.
+    """
+
+    def __init__(self, context: zmq.Context, keys_dir):
+        super().__init__(daemon=True)
+        server_public, server_secret = zmq.auth.load_certificate(
+            str(keys_dir / "private_keys" / "server.key_secret")
+        )
+        self.socket = context.socket(zmq.ROUTER)
+        self.socket.curve_secretkey = server_secret
+        self.socket.curve_publickey = server_public
+        self.socket.curve_server = True
+        self.port = self.socket.bind_to_random_port("tcp://127.0.0.1")
+
+        # function of the request returning the reply to commands, bytes to
+        # send as they are, or None to not reply
+        self.reply = lambda request: {
+            "id": request["id"],
+            "run_id": "run",
+            "results": [["OK", 0]] * len(request["commands"]),
+        }
+        self.active = threading.Event()
+        self.active.set()
+
+    def run(self):
+        while self.active.is_set():
+            if not self.socket.poll(50):
+                continue
+            identity, empty, message = self.socket.recv_multipart()
+            request = json.loads(message)
+            if "metadata" in request:
+                reply = {
+                    "id": request["id"],
+                    "run_id": "run",
+                    "status": "OK",
+                    "metadata": {
+                        "verification_string": "fake",
+                        "dtype": "f",
+                        "shape": [2],
+                    },
+                }
+            else:
+                reply = self.reply(request)
+            if reply is None:
+                continue
+            if not isinstance(reply, bytes):
+                reply = json.dumps(reply).encode()
+            self.socket.send_multipart([identity, empty, reply])
+        self.socket.close(linger=0)
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # curve keys in the layout of the authentication directory
+    keys_dir = tmp_path / "authentication"
+    certificates = tmp_path / "certificates"
+    for path in [keys_dir / "public_keys", keys_dir / "private_keys", certificates]:
+        path.mkdir(parents=True)
+    for name in ["server", "client"]:
+        public_file, secret_file = zmq.auth.create_certificates(certificates, name)
+        shutil.copy(public_file, keys_dir / "public_keys")
+        shutil.copy(secret_file, keys_dir / "private_keys")
+
+    # the client loads the local copy of the driver from ./drivers
+    (tmp_path / "drivers").mkdir()
+    (tmp_path / "drivers" / "FakeDriver.py").write_text(DRIVER)
+    monkeypatch.chdir(tmp_path)
+
+    server = FakeServer(zmq.Context.instance(), keys_dir)
+    server.start()
+    client = NetworkingClient(
+        0,
+        "FakeDriver",
+        {
+            "server": "127.0.0.1",
+            "port_readout": server.port + 1,
+            "port_control": server.port,
+            "publisher_name": "test",
+            "device_name": "fake",
+            "keys_dir": str(keys_dir),
+        },
+    )
+    client.timeout = 200
+    yield client, server
+
+    client.CloseConnection()
+    server.active.clear()
+    server.join()
+
+
+def test_execute(client):
+    client, _ = client
+    assert client.verification_string == "fake"
+    assert client.ExecuteNetworkCommands(["get_x()", "get_x()"]) == [0, 0]
+
+
+def test_error_results(client):
+    client, server = client
+    server.reply = lambda request: {
+        "id": request["id"],
+        "run_id": "run",
+        "results": [["OK", 0], ["ERROR", "cannot serialize return value"]],
+    }
+    x, value = client.ExecuteNetworkCommands(["get_x()", "get_x()"])
+    assert x == 0 and np.isnan(value)
+
+
+def test_error_reply(client):
+    client, server = client
+    server.reply = lambda request: {
+        "id": request["id"],
+        "run_id": "run",
+        "status": "ERROR",
+        "message": "invalid request",
+    }
+    assert np.isnan(client.ExecuteNetworkCommands(["get_x()"])).all()
+
+
+def test_timeout(client):
+    client, server = client
+    server.reply = lambda request: None
+    values = client.ExecuteNetworkCommands(["get_x()", "get_x()"])
+    assert len(values) == 2 and np.isnan(values).all()
+    assert "no response" in client.GetWarnings()[-1][1]["message"]
+
+
+def test_invalid_reply(client):
+    client, server = client
+    # a reply that is not json cannot be matched to the request, which times out
+    server.reply = lambda request: b'{"id": %d, "results": [' % request["id"]
+    assert np.isnan(client.ExecuteNetworkCommand("get_x()"))
@@ -0,0 +1,104 @@
+"""
+Compare the time per plot refresh of reading the full x and y columns of a slow
+dataset (as the plots did before) with the incremental reads of HDFReadCache,
+while rows are appended to the dataset between refreshes.
+
+Without --dataset, a synthetic run with --rows rows is written to a temporary
+file first. With --dataset, the benchmark runs on a copy of an existing dataset,
+e.g.
+
+    python tools/benchmark_plot_hdf_reads.py data.hdf \
+        --dataset "<run>/beam_source/pressure/ig_hornet" --x time --y "IG pressure"
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from plot_data import HDFReadCache  # noqa: E402
+
+
+def write_synthetic(fname: str, rows: int) -> str:
+    dtype = np.dtype([("time", "f8"), ("x", "f8"), ("y", "f8")])
+    with h5py.File(fname, "w", libver="latest") as f:
+        dset = f.create_dataset(
+            "run/device/dev", (0,), maxshape=(None,), dtype=dtype, chunks=(10_000,)
+        )
+        chunk = 1_000_000
+        for start in range(0, rows, chunk):
+            n = min(chunk, rows - start)
+            data = np.zeros(n, dtype=dtype)
+            data["time"] = np.arange(start, start + n) * 0.1
+            data["x"] = np.random.random(n)
+            data["y"] = np.random.random(n)
+            dset.resize(start + n, axis=0)
+            dset[start:] = data
+    return "run/device/dev"
+
+
+def append_rows(dset: h5py.Dataset, n: int):
+    dset.resize(dset.shape[0] + n, axis=0)
+    dset[-n:] = dset[-2 * n : -n]
+    dset.flush()
+
+
+def full_read(fname: str, path: str, x: str, y: str):
+    with h5py.File(fname, "r", libver="latest", swmr=True) as f:
+        dset = f[path]
+        return dset[x], dset[y]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("hdf_fname", nargs="?", help="recorded HDF file")
+    parser.add_argument("--dataset", help="path of a slow dataset in the file")
+    parser.add_argument("--x", default="time")
+    parser.add_argument("--y", default="y")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--refreshes", type=int, default=20)
+    parser.add_argument("--new-rows", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = str(Path(tmp) / "benchmark.hdf")
+        if args.dataset:
+            shutil.copy(args.hdf_fname, fname)
+            path = args.dataset
+        else:
+            print(f"writing a synthetic run with {args.rows} rows ...")
+            path = write_synthetic(fname, args.rows)
+            args.x, args.y = "time", "y"
+
+        # the file is open for writing for the whole benchmark, as it is in the
+        # HDF_writer while recording
+        writer = h5py.File(fname, "a", libver="latest")
+        cache = HDFReadCache()
+        timings = {"full read": [], "HDFReadCache": []}
+        for _ in range(args.refreshes):
+            append_rows(writer[path], args.new_rows)
+
+            t0 = time.perf_counter()
+            x_full, y_full = full_read(fname, path, args.x, args.y)
+            timings["full read"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            x, y = cache.read_columns(fname, path, [args.x, args.y])
+            timings["HDFReadCache"].append(time.perf_counter() - t0)
+
+            assert np.array_equal(x, x_full) and np.array_equal(y, y_full)
+        cache.close()
+        writer.close()
+
+        print(f"{len(x_full)} rows, {args.refreshes} refreshes")
+        for name, t in timings.items():
+            # the first refresh of the cache reads the whole dataset
+            t = np.array(t[1:]) * 1e3
+            print(f"{name:>20}: median {np.median(t):8.2f} ms, max {t.max():8.2f} ms")
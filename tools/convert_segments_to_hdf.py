@@ -0,0 +1,19 @@
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from storage import convert_to_hdf  # noqa: E402
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert runs written with storage_backend = segments to HDF"
+    )
+    parser.add_argument("segments", help="path to the .segments directory")
+    parser.add_argument("hdf_fname", help="HDF file to write the runs to")
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level="INFO")
+    convert_to_hdf(arguments.segments, arguments.hdf_fname)
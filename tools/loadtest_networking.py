@@ -0,0 +1,375 @@
+"""
+Load test of the networking server: a `Networking` server publishing the data of
+DummyDataFreq (slow) and DummyDataTrace (fast) devices over the loopback
+interface, read by N subscribers while M control clients send requests to the
+devices. Reports the publish throughput, end-to-end latency percentiles (from
+the device timestamp of a sample to its reception) and the control request
+rate. CURVE keys are generated for the test, no instruments are needed, e.g.
+
+    python tools/loadtest_networking.py --subscribers 20 --control-clients 4 \
+        --slow-devices 10 --fast-devices 2 --dt 0.01 --duration 30
+
+The clients run in separate processes (--client-processes), so that they do not
+compete with the server for the interpreter lock.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List
+
+import numpy as np
+import zmq
+import zmq.auth
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.append(str(ROOT))
+
+from config import DeviceConfig  # noqa: E402
+from device import Device  # noqa: E402
+from networking import Networking  # noqa: E402
+from networking_messages import decode_sample, decode_topic  # noqa: E402
+
+
+def generate_keys(directory: Path) -> Path:
+    """Generate server and client CURVE keys in the layout of ./authentication."""
+    public_keys_dir = directory / "public_keys"
+    secret_keys_dir = directory / "private_keys"
+    public_keys_dir.mkdir()
+    secret_keys_dir.mkdir()
+    for name in ["server", "client"]:
+        public_file, secret_file = zmq.auth.create_certificates(str(directory), name)
+        Path(public_file).rename(public_keys_dir / Path(public_file).name)
+        Path(secret_file).rename(secret_keys_dir / Path(secret_file).name)
+    return directory
+
+
+def make_devices(n_slow: int, n_fast: int, dt: float) -> Dict[str, Device]:
+    devices = {}
+    for driver, n in [("DummyDataFreq", n_slow), ("DummyDataTrace", n_fast)]:
+        for i in range(n):
+            config = DeviceConfig(ROOT / "config" / "histogram_test" / f"{driver}.ini")
+            config["name"] = f"{driver}{i}"
+            config["control_params"]["enabled"]["value"] = 2
+            config["control_params"]["dt"]["value"] = str(dt)
+            devices[config["name"]] = Device(config)
+    return devices
+
+
+class Subscriber(threading.Thread):
+    """Receives everything published and records the latency of each sample."""
+
+    def __init__(self, port: int, topic: str, t_start: float, t_stop: float):
+        super().__init__(daemon=True)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.SUB)
+        self.socket.setsockopt_string(zmq.SUBSCRIBE, topic)
+        self.socket.connect(f"tcp://127.0.0.1:{port}")
+        self.t_start, self.t_stop = t_start, t_stop
+        self.latencies: List[float] = []
+        self.messages = 0
+        self.bytes = 0
+        self.missed = 0
+        self.last_seq: Dict[str, int] = {}
+
+    def run(self):
+        while time.time() < self.t_stop:
+            if (self.socket.poll(100) & zmq.POLLIN) == 0:
+                continue
+            frames = self.socket.recv_multipart(copy=False)
+            t = time.time()
+            topic = decode_topic(frames)
+            seq, sample = decode_sample(frames, 0.0)
+            last_seq = self.last_seq.get(topic)
+            self.last_seq[topic] = seq
+            if t < self.t_start:
+                continue
+            if last_seq is not None and seq > last_seq + 1:
+                self.missed += seq - last_seq - 1
+            if isinstance(sample[0], np.ndarray):
+                timestamp = sample[1][-1]["timestamp"]
+            else:
+                timestamp = sample[0]
+            self.latencies.append(t - timestamp)
+            self.messages += 1
+            self.bytes += sum(len(frame) for frame in frames)
+        self.socket.close(linger=0)
+        self.context.term()
+
+
+class ControlClient(threading.Thread):
+    """Sends requests of `batch` commands, keeping `in_flight` requests open."""
+
+    def __init__(
+        self,
+        port: int,
+        keys_dir: Path,
+        commands: List[List[str]],
+        batch: int,
+        in_flight: int,
+        t_start: float,
+        t_stop: float,
+    ):
+        super().__init__(daemon=True)
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.DEALER)
+        server_public, _ = zmq.auth.load_certificate(
+            str(keys_dir / "public_keys" / "server.key")
+        )
+        client_public, client_secret = zmq.auth.load_certificate(
+            str(keys_dir / "private_keys" / "client.key_secret")
+        )
+        self.socket.curve_secretkey = client_secret
+        self.socket.curve_publickey = client_public
+        self.socket.curve_serverkey = server_public
+        self.socket.connect(f"tcp://127.0.0.1:{port}")
+        self.commands = commands
+        self.batch = batch
+        self.in_flight = in_flight
+        self.t_start, self.t_stop = t_start, t_stop
+        self.latencies: List[float] = []
+        self.requests = 0
+        self.errors = 0
+
+    def send(self, request_id: int):
+        commands = [
+            self.commands[(request_id * self.batch + i) % len(self.commands)]
+            for i in range(self.batch)
+        ]
+        request = {"id": request_id, "commands": commands, "timeout": 10.0}
+        self.socket.send_multipart([b"", json.dumps(request).encode()])
+
+    def run(self):
+        sent = {}
+        request_id = 0
+        while time.time() < self.t_stop:
+            while len(sent) < self.in_flight:
+                self.send(request_id)
+                sent[request_id] = time.time()
+                request_id += 1
+            if (self.socket.poll(100) & zmq.POLLIN) == 0:
+                continue
+            reply = json.loads(self.socket.recv_multipart()[-1])
+            t_sent = sent.pop(reply["id"])
+            if t_sent < self.t_start:
+                continue
+            self.latencies.append(time.time() - t_sent)
+            self.requests += 1
+            self.errors += sum(status != "OK" for status, _ in reply["results"])
+        self.socket.close(linger=0)
+        self.context.term()
+
+
+def run_clients(
+    n_subscribers: int,
+    n_control: int,
+    args: argparse.Namespace,
+    keys_dir: Path,
+    commands: List[List[str]],
+    t_start: float,
+    t_stop: float,
+    results: multiprocessing.Queue,
+):
+    subscribers = [
+        Subscriber(args.port_readout, args.name, t_start, t_stop)
+        for _ in range(n_subscribers)
+    ]
+    clients = [
+        ControlClient(
+            args.port_control,
+            keys_dir,
+            commands,
+            args.batch,
+            args.in_flight,
+            t_start,
+            t_stop,
+        )
+        for _ in range(n_control)
+    ]
+    for thread in subscribers + clients:
+        thread.start()
+    for thread in subscribers + clients:
+        thread.join()
+    results.put(
+        {
+            "messages": [s.messages for s in subscribers],
+            "bytes": sum(s.bytes for s in subscribers),
+            "missed": sum(s.missed for s in subscribers),
+            "latencies": np.concatenate([[]] + [s.latencies for s in subscribers]),
+            "requests": sum(c.requests for c in clients),
+            "errors": sum(c.errors for c in clients),
+            "rpc_latencies": np.concatenate([[]] + [c.latencies for c in clients]),
+        }
+    )
+
+
+def percentiles(values: np.ndarray) -> str:
+    if len(values) == 0:
+        return "no data"
+    p = percentiles_dict(values)
+    return ", ".join(f"{key} {val:8.2f} ms" for key, val in p.items())
+
+
+def percentiles_dict(values: np.ndarray) -> Dict[str, float]:
+    if len(values) == 0:
+        return {}
+    p = np.percentile(values * 1e3, [50, 90, 99])
+    return {"p50": p[0], "p90": p[1], "p99": p[2], "max": values.max() * 1e3}
+
+
+def split_evenly(n: int, parts: int) -> List[int]:
+    return [n // parts + (i < n % parts) for i in range(parts)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--control-clients", type=int, default=2)
+    parser.add_argument("--client-processes", type=int, default=2)
+    parser.add_argument("--slow-devices", type=int, default=10)
+    parser.add_argument("--fast-devices", type=int, default=1)
+    parser.add_argument("--dt", type=float, default=0.01, help="device loop delay")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=1, help="commands per request")
+    parser.add_argument("--in-flight", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--port-readout", type=int, default=12445)
+    parser.add_argument("--port-control", type=int, default=12446)
+    parser.add_argument("--name", default="loadtest")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        keys_dir = generate_keys(Path(tmp))
+        time_offset = time.time()
+
+        devices = make_devices(args.slow_devices, args.fast_devices, args.dt)
+        parent = SimpleNamespace(
+            devices=devices,
+            config={
+                "time_offset": time_offset,
+                "files": {"hdf_fname": str(Path(tmp) / "loadtest.hdf")},
+                "networking": {
+                    "name": args.name,
+                    "workers": str(args.workers),
+                    "port_readout": str(args.port_readout),
+                    "port_control": str(args.port_control),
+                    "allowed": "127.0.0.1",
+                    "keys_dir": str(keys_dir),
+                },
+            },
+        )
+        for dev in devices.values():
+            dev.setup_connection(time_offset)
+            dev.start()
+
+        networking = Networking(parent)
+        networking.start()
+
+        # the clients connect during the warmup and are measured afterwards
+        t_start = time.time() + args.warmup
+        t_stop = t_start + args.duration
+        commands = [[name, "verification_string"] for name in devices]
+        results: multiprocessing.Queue = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=run_clients,
+                args=(
+                    n_sub,
+                    n_ctrl,
+                    args,
+                    keys_dir,
+                    commands,
+                    t_start,
+                    t_stop,
+                    results,
+                ),
+            )
+            for n_sub, n_ctrl in zip(
+                split_evenly(args.subscribers, args.client_processes),
+                split_evenly(args.control_clients, args.client_processes),
+            )
+        ]
+        for process in processes:
+            process.start()
+
+        # there is no HDF writer to empty the data queues
+        time.sleep(max(t_start - time.time(), 0))
+        cpu_start = time.process_time()
+        pushed_start = sum(dev.sequence for dev in devices.values())
+        while time.time() < t_stop:
+            time.sleep(0.5)
+            for dev in devices.values():
+                dev.clear_queues()
+        cpu = time.process_time() - cpu_start
+        pushed = sum(dev.sequence for dev in devices.values()) - pushed_start
+
+        client_results = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        networking.active.clear()
+        networking.join()
+        for dev in devices.values():
+            dev.active.clear()
+        for dev in devices.values():
+            dev.join()
+
+    messages = [n for r in client_results for n in r["messages"]]
+    latencies = np.concatenate([r["latencies"] for r in client_results])
+    rpc_latencies = np.concatenate([r["rpc_latencies"] for r in client_results])
+    requests = sum(r["requests"] for r in client_results)
+    report = {
+        "devices": {"slow": args.slow_devices, "fast": args.fast_devices},
+        "subscribers": args.subscribers,
+        "control_clients": args.control_clients,
+        "duration": args.duration,
+        "samples_pushed_per_s": pushed / args.duration,
+        "messages_received_per_s": sum(messages) / args.duration,
+        "received_per_subscriber_min": min(messages, default=0),
+        "received_per_subscriber_max": max(messages, default=0),
+        "megabytes_received_per_s": sum(r["bytes"] for r in client_results)
+        / args.duration
+        / 1e6,
+        "samples_missed": sum(r["missed"] for r in client_results),
+        "latency_ms": percentiles_dict(latencies),
+        "requests_per_s": requests / args.duration,
+        "commands_per_s": requests * args.batch / args.duration,
+        "command_errors": sum(r["errors"] for r in client_results),
+        "rpc_latency_ms": percentiles_dict(rpc_latencies),
+        "server_cpu_fraction": cpu / args.duration,
+    }
+
+    print(
+        f"{args.slow_devices} slow + {args.fast_devices} fast devices at dt ="
+        f" {args.dt} s, {args.subscribers} subscribers, {args.control_clients}"
+        f" control clients, {args.duration} s"
+    )
+    print(f"{'samples pushed':>24}: {report['samples_pushed_per_s']:10.1f} /s")
+    print(
+        f"{'messages received':>24}: {report['messages_received_per_s']:10.1f} /s,"
+        f" {report['megabytes_received_per_s']:.2f} MB/s,"
+        f" {report['samples_missed']} missed"
+    )
+    print(f"{'end-to-end latency':>24}: {percentiles(latencies)}")
+    print(
+        f"{'control requests':>24}: {report['requests_per_s']:10.1f} /s,"
+        f" {report['commands_per_s']:.1f} commands/s,"
+        f" {report['command_errors']} errors"
+    )
+    print(f"{'control latency':>24}: {percentiles(rpc_latencies)}")
+    print(f"{'server process CPU':>24}: {100 * report['server_cpu_fraction']:10.1f} %")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2, default=float)
@@ -1,5 +1,225 @@
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import numpy.typing as npt
 
 
 def split(string: str, separator: str = ",") -> List[str]:
     return [x.strip() for x in string.split(separator)]
+
+
+class GrowableArray:
+    """
+    One-dimensional NumPy buffer with amortized O(1) appends. The capacity is
+    doubled when the buffer is full, so appending n values copies O(n) values in
+    total instead of O(n^2) as when repeatedly concatenating arrays.
+
+    With max_size, only the last max_size values are kept. The buffer then grows
+    to at most twice max_size, and the values kept are moved to its start when
+    it is full, so memory stays bounded while appends remain amortized O(1).
+    """
+
+    def __init__(
+        self, dtype: Any = float, capacity: int = 1024, max_size: Optional[int] = None
+    ):
+        if max_size is not None:
+            max_size = max(int(max_size), 1)
+            capacity = min(capacity, 2 * max_size)
+        self.buffer = np.empty(max(int(capacity), 1), dtype=dtype)
+        self.max_size = max_size
+        self.start = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size - self.start
+
+    def reserve(self, capacity: int):
+        if capacity <= len(self.buffer):
+            return
+        if self.max_size is not None and capacity > 2 * self.max_size:
+            # move the values that will still be kept to the start of the buffer
+            n_new = capacity - self.size
+            keep = min(len(self), max(self.max_size - n_new, 0))
+            self.buffer[:keep] = self.buffer[self.size - keep : self.size]
+            self.start, self.size = 0, keep
+            capacity = keep + n_new
+            if capacity <= len(self.buffer):
+                return
+        new_capacity = len(self.buffer)
+        while new_capacity < capacity:
+            new_capacity *= 2
+        if self.max_size is not None:
+            new_capacity = min(new_capacity, 2 * self.max_size)
+        buffer = np.empty(new_capacity, dtype=self.buffer.dtype)
+        buffer[: self.size] = self.buffer[: self.size]
+        self.buffer = buffer
+
+    def extend(self, values: npt.ArrayLike):
+        values = np.asarray(values, dtype=self.buffer.dtype).ravel()
+        if self.max_size is not None:
+            values = values[-self.max_size :]
+        self.reserve(self.size + len(values))
+        self.buffer[self.size : self.size + len(values)] = values
+        self.size += len(values)
+        if self.max_size is not None:
+            self.start = max(self.start, self.size - self.max_size)
+
+    def append(self, value: Any):
+        self.extend([value])
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
+
+    @property
+    def data(self) -> npt.NDArray:
+        """Read-only view of the values; stays valid when the buffer grows."""
+        view = self.buffer[self.start : self.size]
+        view.flags.writeable = False
+        return view
+
+
+class Expression:
+    """
+    A Python expression of the data y (e.g. "np.min(y)") entered by the user,
+    compiled once. Further names (e.g. x) can be passed when evaluating.
+
+    evaluate_batch() computes a scalar for each row of a 2-D array of traces. If
+    the expression handles a 2-D y and returns one value per row (e.g.
+    "np.min(y, axis=-1)" or "y[:, 10:20].sum(axis=1)"), this is a single
+    vectorized evaluation; otherwise the expression is evaluated for one trace
+    at a time. Which of the two applies is checked on the first batch.
+    Expressions that only work for a 2-D y (e.g. "y[:, 10:20].sum(axis=1)") are
+    always evaluated on the whole batch.
+    """
+
+    def __init__(self, source: str, namespace: Optional[Dict[str, Any]] = None):
+        self.source = source
+        self.code = compile(source.strip(), "<expression>", "eval")
+        self.namespace = {"np": np} if namespace is None else namespace
+        self.batched: Optional[bool] = None
+
+    def __call__(self, y: Any, **names: Any) -> Any:
+        return eval(self.code, self.namespace, {"y": y, **names})
+
+    def evaluate_each(
+        self,
+        traces: npt.NDArray,
+        rows: Optional[Dict[str, npt.NDArray]] = None,
+        **names: Any,
+    ) -> npt.NDArray:
+        rows = {} if rows is None else rows
+        return np.array(
+            [
+                float(self(y, **names, **{k: v[i] for k, v in rows.items()}))
+                for i, y in enumerate(traces)
+            ],
+            dtype=float,
+        )
+
+    def evaluate_batch(
+        self,
+        traces: npt.NDArray,
+        rows: Optional[Dict[str, npt.NDArray]] = None,
+        **names: Any,
+    ) -> npt.NDArray:
+        """
+        rows are further 2-D arrays with one row per trace (e.g. the traces of a
+        normalization channel), passed whole or row by row along with y.
+        """
+        if len(traces) == 0:
+            return np.empty(0)
+        rows = {} if rows is None else rows
+
+        if self.batched is not False:
+            try:
+                result = np.asarray(self(traces, **names, **rows), dtype=float)
+            except Exception:
+                result = None
+            if result is not None and result.shape == (len(traces),):
+                if self.batched:
+                    return result
+
+                # compare with evaluating the first and last trace on their own;
+                # an expression that fails on a single trace is written for 2-D y
+                try:
+                    check = self.evaluate_each(
+                        traces[[0, -1]],
+                        {k: v[[0, -1]] for k, v in rows.items()},
+                        **names,
+                    )
+                except Exception:
+                    check = result[[0, -1]]
+                if np.allclose(result[[0, -1]], check, equal_nan=True):
+                    self.batched = True
+                    return result
+            self.batched = False
+
+        return self.evaluate_each(traces, rows, **names)
+
+
+class AsofMatcher:
+    """
+    Incremental as-of join of two timestamped streams: each timestamp of the left
+    stream (e.g. the traces of a fast device) is matched to the last row of the
+    right stream (e.g. the readings of a slow scan device) taken at or before it,
+    and at most `tolerance` seconds before it.
+
+    Rows of the right stream are added as they arrive and kept sorted by time.
+    match() finds the rows with np.searchsorted and then drops the rows before
+    the last one matched (the cursor), since later timestamps cannot match them;
+    at most max_rows rows are held if the left stream stalls.
+    """
+
+    def __init__(self, tolerance: float = np.inf, max_rows: int = 100_000):
+        self.tolerance = tolerance
+        self.max_rows = max_rows
+        self.reset()
+
+    def reset(self):
+        self.times = np.empty(0)
+        self.values: Optional[npt.NDArray] = None
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def add(self, times: npt.ArrayLike, values: npt.ArrayLike):
+        """Add rows of the right stream; values has one entry (or row) per time."""
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        if len(times) == 0:
+            return
+        if self.values is None or values.shape[1:] != self.values.shape[1:]:
+            self.times = np.empty(0)
+            self.values = np.empty((0,) + values.shape[1:])
+        elif len(self.times) > 0 and times[0] < self.times[-1]:
+            # the clock went back (e.g. the device was restarted): the old rows
+            # cannot be ordered with the new ones
+            self.times = self.times[:0]
+            self.values = self.values[:0]
+        if np.any(np.diff(times) < 0):
+            order = np.argsort(times, kind="stable")
+            times, values = times[order], values[order]
+        self.times = np.concatenate((self.times, times))[-self.max_rows :]
+        self.values = np.concatenate((self.values, values))[-self.max_rows :]
+
+    def match(self, times: npt.ArrayLike) -> Tuple[npt.NDArray, npt.NDArray]:
+        """
+        Match the left timestamps; returns a boolean mask of the timestamps that
+        matched a row, and the values of the matched rows.
+        """
+        times = np.asarray(times, dtype=float)
+        if self.values is None or len(self.times) == 0:
+            return np.zeros(len(times), dtype=bool), np.empty((0,))
+        indices = np.searchsorted(self.times, times, side="right") - 1
+        matched = indices >= 0
+        matched[matched] = (
+            times[matched] - self.times[indices[matched]] <= self.tolerance
+        )
+        values = self.values[indices[matched]]
+        if matched.any():
+            # keep the last row matched, later timestamps can still match it
+            cursor = indices[matched].max()
+            self.times = self.times[cursor:]
+            self.values = self.values[cursor:]
+        return matched, values